@@ -0,0 +1,88 @@
+"""ניתוח נתונים לצוות - שאילתות מצטברות על טבלאות ה־rollup בלבד.
+
+db_setup מחזיק טבלאות ספירה מוכנות (אתר × יום × סטטוס, קודי סיבת ביטול,
+עומס לפי סוג תור/רשומה) שמתעדכנות בכל טעינה, כך ששאלות כמו "כמה ביטולים היו
+בכל אתר בחודש שעבר" קוראות מאות שורות ולא סורקות את טבלת התורים. יש כאן
+API מובנה (aggregate) ו־text-to-SQL שרואה רק את טבלאות ה־rollup ואת sites.
+"""
+import db
+
+# The rollups db_setup builds and the columns each can be grouped and filtered by;
+# every table also has an `appointments` count
+ROLLUPS = {
+    'site_day_status': ('day', 'site_id', 'appointment_status'),
+    'cancel_reasons': ('day', 'site_id', 'cancel_reason_code'),
+    'type_load': ('day', 'site_id', 'record_type', 'appointment_type'),
+}
+MAX_ROWS = 500
+
+# Text-to-SQL for staff sees the shared rollups and site names, nothing per patient
+SCOPE = {**{f"rollup_{name}": None for name in ROLLUPS}, 'sites': None}
+
+SCHEMA = """
+rollup_site_day_status(day TEXT, site_id INTEGER, appointment_status TEXT, appointments INTEGER)
+    -- appointment_status: Canceled, TookPlace, RescheduleByAssuta, NewAppointment, WaitingForAppointment, ...
+rollup_cancel_reasons(day TEXT, site_id INTEGER, cancel_reason_code TEXT, appointments INTEGER)
+rollup_type_load(day TEXT, site_id INTEGER, record_type TEXT, appointment_type TEXT, appointments INTEGER)
+    -- record_type: בדיקה / ניתוח / ייעוץ; appointment_type בלי התאריך שבסוף הטקסט
+sites(site_id INTEGER PRIMARY KEY, site_name TEXT, site_address TEXT)
+-- day הוא 'YYYY-MM-DD' לפי UTC; appointments הוא מספר התורים בקבוצה; site_id 0 = אתר לא ידוע
+"""
+
+SQL_SYSTEM_PROMPT = f"""אתה ממיר שאלות של צוות אסותא על נתונים מצטברים לשאילתת SQLite אחת.
+הסכמה:
+{SCHEMA}
+כללים:
+- החזר משפט SELECT יחיד בלבד, בלי הסברים ובלי ```.
+- השתמש רק בטבלאות שבסכמה. ספירות מחשבים עם SUM(appointments), לא COUNT(*).
+- ערכים שמופיעים בשאלה כ־{{p0}}, {{p1}} וכו' יש להעביר כפרמטרים :p0, :p1 ולא כטקסט.
+- לטווחי זמן השווה את day למחרוזות כמו date('now', 'start of month', '-1 month').
+- להצגת שם אתר חבר את sites לפי site_id.
+- אם השאלה לא עוסקת בנתונים האלה, החזר בדיוק NONE.
+"""
+
+
+def aggregate(db_path, rollup, group_by=(), start=None, end=None, filters=None, limit=100):
+    """סכום התורים ב־rollup לפי העמודות ב־group_by, בטווח הימים [start, end).
+
+    filters ממפה עמודה לערך; קיבוץ לפי site_id מוסיף את site_name. ValueError
+    על rollup או עמודה לא מוכרים. מחזיר רשימת dicts מהגדולה לקטנה.
+    """
+    if rollup not in ROLLUPS:
+        raise ValueError(f"unknown rollup: {rollup}")
+    filters = filters or {}
+    unknown = (set(group_by) | set(filters)) - set(ROLLUPS[rollup])
+    if unknown:
+        raise ValueError(f"unknown columns for {rollup}: {', '.join(sorted(unknown))}")
+
+    columns = [f"r.{column}" for column in group_by]
+    if 'site_id' in group_by:
+        columns.append("s.site_name")
+    conditions = [f"r.{column} = :{column}" for column in filters]
+    params = {**filters, 'limit': min(int(limit), MAX_ROWS)}
+    if start:
+        conditions.append("r.day >= :start")
+        params['start'] = start
+    if end:
+        conditions.append("r.day < :end")
+        params['end'] = end
+
+    # Built only from whitelisted names, so the statement cache sees one text per shape
+    sql = f"SELECT {', '.join(columns + ['SUM(r.appointments) AS appointments'])} FROM rollup_{rollup} r"
+    if 'site_id' in group_by:
+        sql += " LEFT JOIN sites s ON s.site_id = r.site_id"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    if group_by:
+        sql += " GROUP BY " + ", ".join(f"r.{column}" for column in group_by)
+    sql += " ORDER BY appointments DESC LIMIT :limit"
+    return [dict(row) for row in db.get_connection(db_path).execute(sql, params)]
+
+
+def format_rows(rows):
+    """תוצאות שאילתה כטקסט לצ'אט - שורת כותרת ושורה לכל תוצאה"""
+    if not rows:
+        return "לא נמצאו נתונים מתאימים."
+    lines = [" | ".join(rows[0])]
+    lines += [" | ".join('' if value is None else str(value) for value in row.values()) for row in rows]
+    return "\n".join(lines)
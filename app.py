@@ -1,21 +1,53 @@
-from flask import Flask, render_template, request, jsonify
-import sqlite3
-import google.generativeai as genai
+from flask import Flask, Response, g, render_template, request, jsonify, stream_with_context
+import hmac
+import json
+import logging
 import os
-import re
-from datetime import datetime
 from dotenv import load_dotenv
 import shutil
 
+import analytics
+import db
+import llm_dispatch
+import metrics
+import patient_snapshot
+from intents import router as intent_router
+from llm_dispatch import TRY_AGAIN_REPLY, Dispatcher, SessionLocks
+from prompt_models import DEFAULT_MODEL, ModelRegistry, SystemPrompt, gemini
+from postprocess import FOLLOWUP_HOLDBACK, build_reply as format_reply, clean_reply, greeting_patterns
+from response_cache import ResponseCache
+from context_builder import build_login_context, estimate_tokens, history_tokens, login_greeting, token_budget, window_history
+from text_to_sql import SQL_SYSTEM_PROMPT, TextToSQL, UnsafeSQL, verbalize_prompt
+from session_store import create_session_store, history_to_records, records_to_history
+
 load_dotenv()
 
 app = Flask(__name__)
-
-# הגדרת מפתח API של Gemini
-genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
+app.logger.setLevel(os.environ.get('LOG_LEVEL', logging.INFO))
+
+@app.before_request
+def begin_request_metrics():
+    """פתיחת מעקב זמנים לבקשה, לפי תבנית ה־route"""
+    g.trace = metrics.begin_request(request.url_rule.rule if request.url_rule else 'unmatched')
+
+@app.after_request
+def end_request_metrics(response):
+    """רישום זמן הבקשה וסטטוס התשובה (בסטרימינג - עד שליחת הכותרות)"""
+    trace = g.pop('trace', None)
+    if trace is not None:
+        metrics.end_request(trace, response.status_code)
+    return response
+
+# מצב serverless (ברירת המחדל ב־Vercel): ה־DB שבחבילה נפתח במקומו לקריאה בלבד,
+# בלי העתקה ל־/tmp, כך שמופע חדש לא משלם על העתקת הקובץ לפני הבקשה הראשונה.
+# ה־SDK של Gemini מיובא בכל מקרה רק בבקשה הראשונה שמגיעה למודל (prompt_models.gemini).
+SERVERLESS = os.environ.get('SERVERLESS', os.environ.get('VERCEL', '')) not in ('', '0')
 
 # Determine database path - works both locally and on Vercel
-if os.path.exists('/tmp'):
+if SERVERLESS:
+    DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app_database.db')
+    db.mark_immutable(DB_PATH)
+elif os.path.exists('/tmp'):
     # On Vercel, use /tmp directory
     DB_PATH = '/tmp/app_database.db'
     # Copy database to /tmp if it doesn't exist there
@@ -27,141 +59,171 @@ else:
     # Local development
     DB_PATH = 'app_database.db'
 
-# זיכרון צ'אט בשרת
-chat_sessions = {}
+# זיכרון צ'אט בשרת - בזיכרון (LRU+TTL) או בקובץ SQLite משותף, לפי SESSION_STORE
+chat_sessions = create_session_store()
+
+# מטמון תשובות לשאלות חוזרות על אותם נתונים
+response_cache = ResponseCache(
+    max_entries=int(os.environ.get('RESPONSE_CACHE_SIZE', '2048')),
+    ttl=int(os.environ.get('RESPONSE_CACHE_TTL', '600')),
+)
+
+# ההנחיה נקראת פעם אחת ונטענת מחדש כשהקובץ משתנה; מודל אחד משותף לכל גרסה שלה
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', DEFAULT_MODEL)
+system_prompt = SystemPrompt('system_prompt.txt', check_interval=float(os.environ.get('PROMPT_RELOAD_INTERVAL', '1.0')))
+models = ModelRegistry(system_prompt, model_name=GEMINI_MODEL, cache_ttl=int(os.environ.get('PROMPT_CACHE_TTL', '0')))
+
+# תזמון הקריאות למודל - מקביליות, קצב לדקה, ניסיונות חוזרים ו־hedging (llm_dispatch)
+dispatcher = Dispatcher(
+    max_concurrency=int(os.environ.get('LLM_MAX_CONCURRENCY', '16')),
+    rpm=int(os.environ.get('LLM_RPM', '0')),
+    queue_timeout=float(os.environ.get('LLM_QUEUE_TIMEOUT', '5')),
+    deadline=float(os.environ.get('LLM_DEADLINE', '30')),
+    max_retries=int(os.environ.get('LLM_MAX_RETRIES', '2')),
+    hedge_after=float(os.environ.get('LLM_HEDGE_AFTER', '0')),
+)
+# תור אחד בכל פעם לכל שיחה; ההמתנה ארוכה מה־deadline כדי שתור קודם יספיק להסתיים
+session_locks = SessionLocks()
+SESSION_LOCK_TIMEOUT = float(os.environ.get('SESSION_LOCK_TIMEOUT', str(dispatcher.deadline + 5)))
+
+# Read at scrape time through the module globals, so swapped stores are picked up
+metrics.registry.gauge('chatbot_active_sessions', 'Chat sessions currently held by the session store',
+                       lambda: len(chat_sessions))
+metrics.registry.gauge('chatbot_response_cache_entries', 'Entries in the response cache',
+                       lambda: len(response_cache))
+metrics.registry.gauge('chatbot_llm_in_flight', 'Model calls currently running', lambda: dispatcher.in_flight)
+
+def load_system_prompt():
+    """טקסט הנחיית המערכת וגרסה (hash) שלו - FileNotFoundError אם הקובץ חסר"""
+    return system_prompt.load()
+
+@metrics.timed('model_init')
+def get_model():
+    """מודל Gemini עם הנחיית המערכת - FileNotFoundError אם הקובץ חסר"""
+    return models.get()
+
+# מצב text-to-SQL: המודל מקבל רק את תוצאות השאילתה ולא את כל נתוני המטופל
+TEXT_TO_SQL = os.environ.get('CHAT_MODE') == 'text2sql'
+_sql_models = {}
+
+def get_sql_model(system_instruction=SQL_SYSTEM_PROMPT):
+    """מודל נפרד שממיר שאלות ל־SQL, אחד לכל הנחיה"""
+    if system_instruction not in _sql_models:
+        _sql_models[system_instruction] = gemini().GenerativeModel(
+            GEMINI_MODEL,
+            system_instruction=system_instruction
+        )
+    return _sql_models[system_instruction]
+
+def generate_sql(prompt, system_instruction=SQL_SYSTEM_PROMPT):
+    """טקסט ה־SQL שהמודל מחזיר לשאלה, דרך ה־dispatcher"""
+    return dispatcher.call(
+        lambda timeout: get_sql_model(system_instruction).generate_content(prompt, request_options={'timeout': timeout})
+    ).text
+
+sql_engine = TextToSQL(generate_sql)
+
+# מצב ניתוח לצוות: מי שמזין את ANALYTICS_TOKEN במקום ת"ז שואל על נתונים מצטברים,
+# ו־/analytics מחזיר אותם כ־JSON. בלי ANALYTICS_TOKEN המצב כבוי
+ANALYTICS_TOKEN = os.environ.get('ANALYTICS_TOKEN', '')
+analytics_engine = TextToSQL(lambda prompt: generate_sql(prompt, analytics.SQL_SYSTEM_PROMPT), scope=analytics.SCOPE)
 
+def is_analytics_token(value):
+    return bool(ANALYTICS_TOKEN) and hmac.compare_digest(value.encode(), ANALYTICS_TOKEN.encode())
+
+def send_to_model(chat, user_message, **kwargs):
+    """שליחת ההודעה למודל, עם תזמון וספירת שגיאות"""
+    with metrics.span('model'):
+        try:
+            return chat.send_message(user_message, **kwargs)
+        except Exception:
+            metrics.ERRORS.inc(kind='model')
+            raise
+
+def stream_errors():
+    """השגיאות שזרם של המודל זורק באמצע - שגיאות ה־API והרשת, ותשובה שנחסמה או נקטעה"""
+    # Imported only once a stream has failed: by then the SDK is loaded anyway
+    from google.generativeai.types import BrokenResponseError, StopCandidateException
+    # chunk.text raises ValueError on a chunk that was blocked and has no text
+    return (ValueError, StopCandidateException, BrokenResponseError, *llm_dispatch.model_errors())
+
+def start_model_chat(session):
+    """פתיחת ChatSession של המודל מההיסטוריה השמורה בשיחה"""
+    return get_model().start_chat(history=records_to_history(session['history']))
+
+def model_turn(session, user_message, stream=False):
+    """שליחת ההודעה למודל דרך ה־dispatcher - מחזיר (chat, response).
+
+    כל ניסיון פותח ChatSession חדש, כך שניסיון חוזר או hedge לא מוסיפים
+    תורות כפולות להיסטוריה. בסטרימינג המקום ב־dispatcher משתחרר בטוקן הראשון.
+    """
+    def attempt(timeout):
+        chat = start_model_chat(session)
+        return chat, send_to_model(chat, user_message, stream=stream, request_options={'timeout': timeout})
+    # A streamed reply is consumed as it arrives, so only whole replies are hedged
+    return dispatcher.call(attempt, hedge=not stream)
+
+@metrics.timed('save_history')
+def save_history(session, chat):
+    """שמירת התורות החדשות בשיחה, בתוך תקציב הטוקנים של ההקשר"""
+    records = session['history'] + history_to_records(chat.history[len(session['history']):])
+    session['history'] = window_history(records, token_budget())
+
+def log_usage(session, user_message, response):
+    """רישום תשובה של המודל - היסטוגרמות הטוקנים, ולוג debug עם ההערכה המקומית"""
+    usage = getattr(response, 'usage_metadata', None)
+    metrics.ANSWERS.inc(source='model')
+    metrics.observe_usage(usage)
+    app.logger.debug(
+        "prompt_tokens=%s cached_tokens=%s response_tokens=%s estimated_prompt_tokens=%s history_records=%s",
+        getattr(usage, 'prompt_token_count', None),
+        getattr(usage, 'cached_content_token_count', None),
+        getattr(usage, 'candidates_token_count', None),
+        history_tokens(session['history']) + estimate_tokens(user_message),
+        len(session['history']),
+    )
+
+@metrics.timed('user_data')
 def get_user_data(user_id):
     """שליפת נתוני המשתמש מה־DB"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT a.*, u.user_name, u.age
-        FROM appointments a 
-        JOIN accounts u ON a.user_id = u.user_id 
-        WHERE a.user_id=?
-    """, (user_id,))
-    user_data = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return user_data
-
-def find_next_appointment(user_data):
-    """איתור התור הקרוב ביותר בעתיד"""
-    now = datetime.now()
-    next_appointment = None
-    for appt in user_data:
-        appt_date_str = appt.get('appointment_date_Time__c')
-        if not appt_date_str:
-            continue
-        try:
-            appt_date = datetime.strptime(appt_date_str, '%Y-%m-%d %H:%M:%S')
-        except ValueError:
-            continue
-        if appt_date > now:
-            if next_appointment is None:
-                next_appointment = appt
-            else:
-                cur = datetime.strptime(next_appointment.get('appointment_date_Time__c'), '%Y-%m-%d %H:%M:%S')
-                if appt_date < cur:
-                    next_appointment = appt
-    return next_appointment
-
-def format_bot_text(text):
-    """המרת טקסט רגיל עם מספור/נקודות ל־HTML <ol>/<ul> עם ניקוי כוכביות"""
-    if not text:
-        return ""
-    if any(tag in text for tag in ("<ol", "<ul", "<li")):
-        return text
-
-    # מסירים כוכביות מיותרות מהטקסט
-    text = text.replace('*', '')
-
-    lines = [ln.strip() for ln in text.splitlines()]
-    lines = [ln for ln in lines if ln]
-
-    if not lines:
-        return ""
-
-    num_re = re.compile(r'^\d+[\.\)]\s+')
-    bullet_re = re.compile(r'^([\-•])\s+')
-
-    num_hits = sum(1 for ln in lines if num_re.match(ln))
-    bullet_hits = sum(1 for ln in lines if bullet_re.match(ln))
-
-    if num_hits >= max(2, len(lines) // 2):
-        items = [num_re.sub('', ln) for ln in lines if num_re.match(ln)]
-        if items:
-            return "<ol>" + "".join(f"<li>{it}</li>" for it in items) + "</ol>"
-
-    if bullet_hits >= max(2, len(lines) // 2):
-        items = [bullet_re.sub('', ln) for ln in lines if bullet_re.match(ln)]
-        if items:
-            return "<ul>" + "".join(f"<li>{it}</li>" for it in items) + "</ul>"
-
-    return "<br>".join(lines)
-
-    # רשימה עם נקודות
-    if bullet_hits >= max(2, len(lines) // 2):
-        items = [bullet_re.sub('', ln) for ln in lines if bullet_re.match(ln)]
-        if items:
-            return "<ul>" + "".join(f"<li>{it}</li>" for it in items) + "</ul>"
-
-    # ברירת מחדל - שבירת שורות
-    return "<br>".join(lines)
-
-def should_add_followup_question(user_message, response_text):
-    """קובע אם צריך להוסיף שאלת המשך לתשובה"""
-    appointment_keywords = ['תור', 'תורים', 'בדיקה', 'בדיקות', 'appointment', 'המטולוג', 'עיניים', 'גסטרו', 'CT', 'MRI']
-    user_lower = user_message.lower()
-    response_lower = response_text.lower()
-    
-    # בדיקה אם השאלה או התשובה קשורות לתורים
-    user_has_appointment = any(keyword in user_lower for keyword in appointment_keywords)
-    response_has_appointment = any(keyword in response_lower for keyword in appointment_keywords)
-    
-    # לא מוסיפים שאלת המשך אם המשתמש כבר שאל שאלה ספציפית
-    specific_questions = ['איך', 'מה', 'מתי', 'איפה', 'כמה', 'האם', 'הגעה', 'להביא', 'צום', 'הכנה']
-    user_asked_specific = any(q in user_lower for q in specific_questions)
-    
-    return (user_has_appointment or response_has_appointment) and not user_asked_specific
-
-def generate_followup_question(user_message, response_text):
-    """יוצר שאלת המשך מתאימה בהתבסס על התשובה"""
-    user_lower = user_message.lower()
-    response_lower = response_text.lower()
-    
-    # שאלות המשך בהתבסס על סוג התשובה
-    if 'תורים' in response_lower or 'תור' in response_lower:
-        # If response lists multiple appointments
-        if 'מצאתי' in response_lower and ('1.' in response_text or 'רופא' in response_text):
-            return "האם תרצה פרטים נוספים על אחד מהתורים? 📝"
-        # If it's a single appointment with details
-        elif any(word in response_lower for word in ['המטולוג', 'עיניים', 'שינה', 'ct', 'mri', 'בדיקת']):
-            return "האם תרצה לדעת מה להביא לבדיקה או איך להגיע? 📋"
-        # If user asked about next appointment specifically
-        elif 'תור הבא' in user_lower or 'תור קרוב' in user_lower:
-            return "יש לך שאלות על ההכנות לבדיקה או הנחיות הגעה? 🗺️"
-    
-    # If no appointments found
-    if 'לא מצאתי תורים' in response_lower:
-        return "האם תרצה לקבוע תור חדש או לבדוק תורים בתאריך אחר? 📅"
-    
-    # If response contains appointment details/instructions
-    if any(word in response_lower for word in ['הצטייד', 'להביא', 'הכנה', 'הנחיות', 'צום']):
-        return "יש לך עוד שאלות על הבדיקה? 🤔"
-    
-    return None
+    return db.fetch_user_data(DB_PATH, user_id)
+
+@metrics.timed('user_version')
+def get_user_version(user_id):
+    """גרסת נתוני המשתמש - קריאה אחת לפי מפתח ראשי"""
+    return db.user_version(DB_PATH, user_id)
+
+def sync_user_data(session):
+    """וידוא שצילום נתוני המטופל בשיחה עדכני - מחזיר את גרסת הנתונים.
+
+    כשהגרסה ב־DB השתנתה הנתונים נשלפים מחדש, וההפרש מהצילום הקודם נוסף
+    להיסטוריה כתורת עדכון - המודל רואה את השינוי בלי לבנות את ההקשר מחדש.
+    """
+    snapshot = session.get('snapshot')
+    if snapshot is not None and snapshot['version'] == get_user_version(session['user_id']):
+        return snapshot['version']
+
+    fresh = patient_snapshot.take(get_user_data(session['user_id']))
+    # Sessions opened before snapshots existed just start from the current data
+    delta = patient_snapshot.diff(snapshot, fresh) if snapshot is not None else None
+    if delta:
+        metrics.DATA_UPDATES.inc()
+        if not TEXT_TO_SQL:
+            records = session['history'] + patient_snapshot.update_records(delta)
+            session['history'] = window_history(records, token_budget())
+    session['snapshot'] = fresh
+    return fresh['version']
 
 @app.route('/')
 def index():
     """עמוד ראשי"""
     return render_template('index.html')
 
-@app.route('/start', methods=['POST'])
-def start_chat():
-    """תחילת שיחה - בקשת ת"ז"""
+def open_session():
+    """יצירת שיחה חדשה - מחזיר את גוף התשובה ל־/start"""
     session_id = os.urandom(16).hex()
-    chat_sessions[session_id] = {'state': 'waiting_for_id', 'history': []}
+    chat_sessions.put(session_id, {'state': 'waiting_for_id', 'history': []})
+    metrics.SESSIONS.inc()
     
     response1 = """צהריים טובים! 👋<br>
  אני אסי, עוזר הבינה המלאכותית של אסותא 🤖. כאן כדי לעזור לך עם כל מה שקשור לתורים, בדיקות ותוצאות.<br><br>
@@ -173,134 +235,337 @@ def start_chat():
     
     response2 = 'כדי שנתחיל יש להזין את מספר ת"ז שלך'
 
-    return jsonify({'session_id': session_id, 'responses': [response1, response2]})
+    return {'session_id': session_id, 'responses': [response1, response2]}
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    """ניהול השיחה"""
-    session_id = request.json.get('session_id')
-    user_message = request.json.get('message')
+@app.route('/start', methods=['POST'])
+def start_chat():
+    """תחילת שיחה - בקשת ת"ז"""
+    return jsonify(open_session())
+
+@metrics.timed('postprocess')
+def clean_model_text(session, response_text):
+    """ניקוי תשובת המודל לפני העיצוב"""
+    return clean_reply(session.get('user_name'), response_text)
+
+@metrics.timed('format_reply')
+def build_reply(user_message, response_text):
+    """עיצוב התשובה ושאלת ההמשך - גוף התשובה ל־JSON"""
+    return format_reply(user_message, response_text)
+
+def append_turn(session, user_message, response_text):
+    """הוספת שאלה ותשובה שלא עברו במודל להיסטוריה, כדי שהמודל יכיר אותן בהמשך"""
+    records = session['history'] + [{'role': 'user', 'text': user_message}, {'role': 'model', 'text': response_text}]
+    session['history'] = window_history(records, token_budget())
+
+def previous_reply(session):
+    """תשובת המודל האחרונה בהיסטוריה - ההקשר שבו הודעה קצרה כמו "כן" נשאלת"""
+    return next((record['text'] for record in reversed(session['history']) if record['role'] == 'model'), '')
+
+def local_answer(session, user_message):
+    """מענה בלי מודל השיחה - מהמסלול המהיר, מהמטמון או ממצב הניתוח של הצוות.
+
+    מחזיר (תשובה, תג מטמון); התשובה None אם צריך את המודל. התג - גרסת נתוני
+    המטופל ותשובת המודל הקודמת - מועבר ל־remember_answer.
+    """
+    if session['state'] == 'analytics':
+        return analytics_answer(user_message), None
+    cache_tag = (sync_user_data(session), previous_reply(session))
+    with metrics.span('intent'):
+        intent, response_text = intent_router.answer(user_message, DB_PATH, session['user_id'])
+    if intent is not None:
+        metrics.ANSWERS.inc(source='intent')
+        append_turn(session, user_message, response_text)
+        return response_text, cache_tag
+
+    fingerprint, context = cache_tag
+    with metrics.span('cache'):
+        response_text = response_cache.get(session['user_id'], user_message, fingerprint, load_system_prompt()[1],
+                                           context=context)
+    if response_text is not None:
+        metrics.ANSWERS.inc(source='cache')
+        append_turn(session, user_message, response_text)
+    return response_text, cache_tag
+
+def remember_answer(session, user_message, cache_tag, response_text):
+    """שמירת תשובת המודל (אחרי ניקוי) במטמון"""
+    fingerprint, context = cache_tag
+    response_cache.put(session['user_id'], user_message, fingerprint, load_system_prompt()[1], response_text,
+                       context=context)
+
+@metrics.timed('sql')
+def sql_answer(session, user_message, cache_tag):
+    """מענה דרך text-to-SQL - טקסט התשובה, או None אם השאלה לא דורשת נתונים"""
+    try:
+        sql, rows = sql_engine.run(DB_PATH, session['user_id'], user_message)
+    except UnsafeSQL as e:
+        metrics.ERRORS.inc(kind='sql_rejected')
+        app.logger.warning("text-to-sql rejected: %s", e)
+        return None
+    if sql is None:
+        return None
+
+    if rows:
+        prompt = verbalize_prompt(user_message, rows)
+        response = dispatcher.call(lambda timeout: get_model().generate_content(prompt, request_options={'timeout': timeout}))
+        response_text = clean_model_text(session, response.text.strip())
+    else:
+        response_text = "לא מצאתי נתונים מתאימים לשאלה."
+    metrics.ANSWERS.inc(source='sql')
+    append_turn(session, user_message, response_text)
+    remember_answer(session, user_message, cache_tag, response_text)
+    return response_text
+
+ANALYTICS_HELP = (
+    "מצב ניתוח נתונים. אפשר לשאול על ביטולים, סיבות ביטול ועומס תורים לפי אתר, תאריך וסוג - "
+    "למשל: כמה ביטולים היו בכל אתר בחודש שעבר?"
+)
+
+@metrics.timed('analytics')
+def analytics_answer(user_message):
+    """שאלת צוות על נתונים מצטברים - SQL על טבלאות ה־rollup בלבד והתוצאות כטקסט"""
+    try:
+        sql, rows = analytics_engine.run(DB_PATH, None, user_message)
+    except UnsafeSQL as e:
+        metrics.ERRORS.inc(kind='sql_rejected')
+        app.logger.warning("analytics sql rejected: %s", e)
+        return "לא הצלחתי לבנות שאילתה לשאלה הזו. נסו לנסח אותה אחרת."
+    metrics.ANSWERS.inc(source='analytics')
+    if sql is None:
+        return ANALYTICS_HELP
+    return analytics.format_rows(rows)
+
+def login(session, user_message):
+    """זיהוי המשתמש לפי ת"ז ופתיחת שיחה עם המודל - מחזיר (גוף, סטטוס)"""
+    user_id = user_message.strip()
+    if is_analytics_token(user_id):
+        session['state'] = 'analytics'
+        metrics.LOGINS.inc(result='analytics')
+        return {'response': ANALYTICS_HELP}, 200
+    user_data = get_user_data(user_id)
+    if not user_data:
+        metrics.LOGINS.inc(result='unknown_user')
+        return {'response': 'לא מצאתי מטופל עם המזהה הזה. אנא נסה שוב.'}, 200
+
+    try:
+        load_system_prompt()
+    except FileNotFoundError:
+        metrics.LOGINS.inc(result='error')
+        metrics.ERRORS.inc(kind='prompt_missing')
+        return {'error': 'System prompt file not found.'}, 500
+
+    first_name = user_data[0].get('user_name')
+    greeting = login_greeting(first_name)
+
+    session['user_id'] = user_id
+    session['state'] = 'chatting'
+    session['history'] = [
+        {"role": "user", "text": build_login_context(user_id, first_name, user_data[0]['age'], None if TEXT_TO_SQL else user_data)},
+        {"role": "model", "text": greeting}
+    ]
+    session['user_name'] = first_name  # Store name separately
+    session['snapshot'] = patient_snapshot.take(user_data)
+    metrics.LOGINS.inc(result='ok')
+    return {'response': greeting}, 200
+
+@metrics.timed('session_lookup')
+def lookup_chat_session(data):
+    """קריאת session_id והודעה מגוף הבקשה - מחזיר (session_id, session, הודעה, שגיאה)"""
+    session_id = data.get('session_id')
+    user_message = data.get('message')
 
     if not session_id or not user_message:
-        return jsonify({'error': 'session_id and message are required.'}), 400
+        return None, None, None, {'error': 'session_id and message are required.'}
 
     session = chat_sessions.get(session_id)
     if not session:
-        return jsonify({'error': 'Invalid session ID.'}), 400
-    
-    # Debug: Print session info
-    print(f"Debug - Session ID: {session_id}")
-    print(f"Debug - Session keys: {session.keys()}")
-    print(f"Debug - Current state: {session.get('state')}")
+        return None, None, None, {'error': 'Invalid session ID.'}
+    return session_id, session, user_message, None
+
+def parse_chat_request():
+    """כמו lookup_chat_session, עם שגיאה מוכנה כתשובת 400.
+
+    השיחה נעולה עד סוף הבקשה (בסטרימינג - עד סוף ההזרמה), ונקראת מחדש
+    אחרי הנעילה כדי לראות את ההיסטוריה שהתור הקודם שמר.
+    """
+    session_id, session, user_message, error = lookup_chat_session(request.json)
+    if error:
+        return None, None, None, (jsonify(error), 400)
+    with metrics.span('session_wait'):
+        session_locks.acquire(session_id, SESSION_LOCK_TIMEOUT)
+    g.locked_session = session_id
+    session = chat_sessions.get(session_id) or session
+    return session_id, session, user_message, None
+
+@app.teardown_request
+def release_session_lock(error):
+    # With stream_with_context this runs once the stream is closed
+    session_id = g.pop('locked_session', None)
+    if session_id is not None:
+        session_locks.release(session_id)
+
+@app.errorhandler(llm_dispatch.Unavailable)
+def try_again(error):
+    """המודל עמוס או לא זמין - תשובת "נסו שוב" במקום שגיאת 500"""
+    metrics.ERRORS.inc(kind='overloaded' if isinstance(error, llm_dispatch.Overloaded) else 'model_unavailable')
+    app.logger.warning("model unavailable: %s", error)
+    return jsonify({'response': TRY_AGAIN_REPLY}), 503, {'Retry-After': '5'}
 
-    if session['state'] == 'waiting_for_id':
-        user_id = user_message.strip()
-        user_data = get_user_data(user_id)
-        if not user_data:
-            return jsonify({'response': 'לא מצאתי מטופל עם המזהה הזה. אנא נסה שוב.'})
+@app.route('/chat', methods=['POST'])
+def chat():
+    """ניהול השיחה"""
+    session_id, session, user_message, error = parse_chat_request()
+    if error:
+        return error
 
-        try:
-            with open('system_prompt.txt', 'r', encoding='utf-8') as f:
-                system_prompt = f.read()
-        except FileNotFoundError:
-            return jsonify({'error': 'System prompt file not found.'}), 500
-
-        first_name = user_data[0].get('user_name')
-        if first_name:
-            greeting = f'שלום {first_name}! איך אוכל לעזור לך היום?'
-        else:
-            greeting = 'תודה! איך אני יכול לעזור לך היום?'
-
-        model = genai.GenerativeModel(
-            'gemini-1.5-flash',
-            system_instruction=system_prompt
-        )
-        
-        session['user_id'] = user_id
-        session['state'] = 'chatting'
-        session['model'] = model
-        session['history'] = [
-            {"role": "user", "parts": [f"המשתמש (user_id: {user_id}, name: {first_name}, age: {user_data[0]['age']}) התחבר לצ'אט. הנתונים שלו: {user_data}. אל תחזור על השם שלו בתשובות הבאות."]},
-            {"role": "model", "parts": [greeting]}
-        ]
-        session['user_name'] = first_name  # Store name separately
-        return jsonify({'response': greeting})
+    if session['state'] == 'waiting_for_id':
+        payload, status = login(session, user_message)
+        chat_sessions.put(session_id, session)
+        return jsonify(payload), status
 
     # מצב שיחה פעילה
-    if "next appointment" in user_message.lower() or "תור קרוב" in user_message or "תור הבא" in user_message:
-        user_data = get_user_data(session['user_id'])
-        next_appointment = find_next_appointment(user_data)
-        if next_appointment:
-            response_text = f"התור הבא שלך הוא ב־{next_appointment['appointment_date_Time__c']} מסוג {next_appointment['appointment_type']}."
-        else:
-            response_text = "לא מצאתי תורים עתידיים."
+    response_text, cache_tag = local_answer(session, user_message)
+    if response_text is None and TEXT_TO_SQL:
+        response_text = sql_answer(session, user_message, cache_tag)
+    if response_text is not None:
+        chat_sessions.put(session_id, session)
     else:
-        # Debug: Print session state
-        print(f"Debug - Session state: {session.get('state')}")
-        print(f"Debug - User message: {user_message}")
-        print(f"Debug - History length: {len(session.get('history', []))}")
-        
-        chat = session["model"].start_chat(history=session["history"])
-        response = chat.send_message(user_message)
-        session["history"] = chat.history
+        chat, response = model_turn(session, user_message)
+        log_usage(session, user_message, response)
+        save_history(session, chat)
+        chat_sessions.put(session_id, session)
         response_text = response.text.strip()
-        
-        # Debug: Print response
-        print(f"Debug - Response: {response_text}")
-        
+
         # Post-process to remove unwanted repeated greetings and follow-up questions
-        if session.get('user_name'):
-            user_name = session['user_name']
-            greeting_patterns = [f"שלום {user_name}", f"שלום {user_name}!", f"{user_name} שלום"]
-            for pattern in greeting_patterns:
-                if response_text.startswith(pattern):
-                    # Remove the greeting part and continue with the rest
-                    response_text = response_text.replace(pattern, "", 1).strip()
-                    if response_text.startswith("!") or response_text.startswith(","):
-                        response_text = response_text[1:].strip()
-                    print(f"Debug - Removed greeting, new response: {response_text}")
+        response_text = clean_model_text(session, response_text)
+        remember_answer(session, user_message, cache_tag, response_text)
+
+    return jsonify(build_reply(user_message, response_text))
+
+# הזנב שמוחזק בזמן סטרימינג - מספיק ארוך כדי לכסות כל שאלת המשך שתוסר בסוף
+class StreamPreview:
+    """תצוגה מקדימה מצטברת של תשובה בסטרימינג.
+
+    ברכת הפתיחה מוסרת ברגע שאפשר להכריע לגביה, וזנב באורך FOLLOWUP_HOLDBACK
+    נשמר עד סוף התשובה. הטקסט הסופי נשלח באירוע done ומחליף את התצוגה המקדימה,
+    כך שהתוצאה זהה לזו של /chat.
+    """
+
+    def __init__(self, user_name):
+        self.patterns = greeting_patterns(user_name) if user_name else []
+        self.prefix_len = max((len(p) for p in self.patterns), default=0)
+        self.greeting_done = not self.patterns
+        self.buffer = ''
+        self.emitted = 0
+
+    def feed(self, text):
+        """מוסיף קטע מהמודל ומחזיר את הטקסט שאפשר להציג כבר עכשיו"""
+        self.buffer += text
+        if not self.greeting_done:
+            head = self.buffer.lstrip()
+            # "!" or "," may still follow the name, so wait for one extra character
+            if len(head) <= self.prefix_len + 1 and any(p.startswith(head) or head.startswith(p) for p in self.patterns):
+                return ''
+            for pattern in self.patterns:
+                if head.startswith(pattern):
+                    head = head[len(pattern):].lstrip()
+                    if head[:1] in ('!', ','):
+                        head = head[1:].lstrip()
                     break
-        
-        # Remove follow-up questions from the main response since we'll add them separately
-        followup_patterns = [
-            "האם תרצה פרטים נוספים על אחד מהתורים?",
-            "יש לך שאלות על ההכנות לבדיקה או הנחיות הגעה?",
-            "האם תרצה לדעת מה להביא לבדיקה או איך להגיע?",
-            "האם תרצה הנחיות הגעה למתקן?",
-            "האם תרצה לקבוע תור חדש או לבדוק תורים בתאריך אחר?",
-            "יש לך שאלות על ההכנות לבדיקה?",
-            "האם תרצה פרטים נוספים על",
-            "יש לך עוד שאלות?",
-            "מה עוד אוכל לעזור לך?"
-        ]
-        
-        original_response = response_text
-        for pattern in followup_patterns:
-            if pattern in response_text:
-                # Remove the follow-up question and any preceding punctuation/line breaks
-                response_text = response_text.replace(pattern, "").strip()
-                response_text = response_text.rstrip("?📝🗺️📋📅").strip()
-                # Clean up multiple line breaks or trailing punctuation
-                response_text = response_text.rstrip("<br>").rstrip("\n").strip()
-                if response_text != original_response:
-                    print(f"Debug - Removed follow-up question from main response")
-                    break
-
-    # בדיקה אם התשובה מכילה מידע על תורים ודורשת שאלת המשך
-    responses = []
-    formatted_response = format_bot_text(response_text)
-    responses.append(formatted_response)
-    
-    # הוספת שאלת המשך אוטומטית לתשובות על תורים
-    if should_add_followup_question(user_message, response_text):
-        followup_question = generate_followup_question(user_message, response_text)
-        if followup_question:
-            responses.append(followup_question)
-    
-    if len(responses) == 1:
-        return jsonify({'response': responses[0]})
-    else:
-        return jsonify({'responses': responses})
+            self.buffer = head
+            self.greeting_done = True
+
+        end = len(self.buffer) - FOLLOWUP_HOLDBACK
+        if end <= self.emitted:
+            return ''
+        delta = self.buffer[self.emitted:end]
+        self.emitted = end
+        return delta
+
+def sse_event(event, data):
+    """אירוע Server-Sent Events עם גוף JSON"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """ניהול השיחה עם הזרמת התשובה כ־SSE"""
+    session_id, session, user_message, error = parse_chat_request()
+    if error:
+        return error
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+    # תשובות שלא דורשות את המודל נשלחות כאירוע done יחיד
+    if session['state'] == 'waiting_for_id':
+        payload, status = login(session, user_message)
+        chat_sessions.put(session_id, session)
+        if status != 200:
+            return jsonify(payload), status
+        return Response(sse_event('done', payload), mimetype='text/event-stream', headers=headers)
+
+    response_text, cache_tag = local_answer(session, user_message)
+    if response_text is None and TEXT_TO_SQL:
+        response_text = sql_answer(session, user_message, cache_tag)
+    if response_text is not None:
+        chat_sessions.put(session_id, session)
+        payload = build_reply(user_message, response_text)
+        return Response(sse_event('done', payload), mimetype='text/event-stream', headers=headers)
+
+    chat, response = model_turn(session, user_message, stream=True)
+
+    def generate():
+        preview = StreamPreview(session.get('user_name'))
+        try:
+            with metrics.span('model_stream'):
+                for chunk in response:
+                    delta = preview.feed(chunk.text)
+                    if delta:
+                        yield sse_event('token', {'text': delta})
+        except stream_errors() as e:
+            metrics.ERRORS.inc(kind='stream')
+            app.logger.warning("stream failed: %s", type(e).__name__)
+            yield sse_event('error', {'error': 'Streaming failed.'})
+            return
+
+        log_usage(session, user_message, response)
+        save_history(session, chat)
+        chat_sessions.put(session_id, session)
+        response_text = clean_model_text(session, response.text.strip())
+        remember_answer(session, user_message, cache_tag, response_text)
+        yield sse_event('done', build_reply(user_message, response_text))
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=headers)
+
+def analytics_query(rollup, args, authorization):
+    """בקשת /analytics: בדיקת ההרשאה ושאילתת aggregate לפי פרמטרי ה־URL - מחזיר (גוף, סטטוס)"""
+    if not ANALYTICS_TOKEN:
+        return {'error': 'Analytics is disabled.'}, 404
+    if not is_analytics_token((authorization or '').removeprefix('Bearer ')):
+        return {'error': 'Unauthorized.'}, 401
+    args = dict(args)
+    group_by = [column for column in args.pop('group_by', '').split(',') if column]
+    start, end, limit = args.pop('start', None), args.pop('end', None), args.pop('limit', 100)
+    try:
+        rows = analytics.aggregate(DB_PATH, rollup, group_by, start, end, filters=args, limit=limit)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    return {'rollup': rollup, 'rows': rows}, 200
+
+@app.route('/analytics/<rollup>')
+def analytics_endpoint(rollup):
+    """נתונים מצטברים לצוות, למשל /analytics/site_day_status?group_by=site_id&appointment_status=Canceled"""
+    payload, status = analytics_query(rollup, request.args, request.headers.get('Authorization'))
+    return jsonify(payload), status
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """מדדים בפורמט Prometheus"""
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/stats')
+def stats():
+    """נתוני המסלול המהיר והמטמון - כמה בקשות נענו בלי המודל"""
+    return jsonify({**intent_router.stats(), 'response_cache': response_cache.stats(), 'text_to_sql': sql_engine.stats(),
+                    'analytics': analytics_engine.stats(), 'model': models.stats(), 'dispatcher': dispatcher.stats()})
 
 # For Vercel deployment
 app = app
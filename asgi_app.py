@@ -0,0 +1,259 @@
+"""שרת ASGI לאפליקציה - אותם /start, /chat, /chat/stream ו־/analytics כמו ב־app.py.
+
+קריאות Gemini הן async (send_message_async) וגישה ל־DB רצה ב־thread pool,
+כך שתהליך אחד מחזיק מאות שיחות פתוחות במקביל בלי thread לכל בקשה.
+
+    hypercorn asgi_app:app --bind 0.0.0.0:5000
+"""
+import asyncio
+
+from quart import Quart, Response, g, jsonify, render_template, request
+
+import llm_dispatch
+import metrics
+from app import (
+    SESSION_LOCK_TIMEOUT,
+    TEXT_TO_SQL,
+    TRY_AGAIN_REPLY,
+    StreamPreview,
+    analytics_engine,
+    analytics_query,
+    build_reply,
+    chat_sessions,
+    clean_model_text,
+    dispatcher,
+    intent_router,
+    local_answer,
+    log_usage,
+    login,
+    lookup_chat_session,
+    models,
+    open_session,
+    remember_answer,
+    response_cache,
+    save_history,
+    session_locks,
+    sql_answer,
+    sql_engine,
+    sse_event,
+    start_model_chat,
+    stream_errors,
+)
+
+app = Quart(__name__)
+
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+class LockedStream:
+    """גוף תשובה בסטרימינג שמחזיק את נעילת השיחה עד שהוא נסגר.
+
+    Quart סוגר את הגוף (aclose) בסוף השליחה, גם כשהלקוח התנתק באמצע; אם
+    השליחה לא התחילה כלל - למשל כשהבקשה בוטלה לפני כן - הנעילה משתחררת אחרי
+    SESSION_LOCK_TIMEOUT, כדי שהשיחה לא תישאר נעולה.
+    """
+
+    def __init__(self, session_id, body):
+        self.session_id = session_id
+        self.body = body
+        self.started = False
+        self.released = False
+        self._timer = asyncio.get_running_loop().call_later(SESSION_LOCK_TIMEOUT, self._release_unstarted)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._timer.cancel()
+            session_locks.release(self.session_id)
+
+    def _release_unstarted(self):
+        if not self.started:
+            self.release()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.started:
+            if self.released:
+                raise StopAsyncIteration
+            self.started = True
+        return await self.body.__anext__()
+
+    async def aclose(self):
+        try:
+            await self.body.aclose()
+        finally:
+            self.release()
+
+
+@app.before_request
+async def begin_request_metrics():
+    """פתיחת מעקב זמנים לבקשה, לפי תבנית ה־route"""
+    g.trace = metrics.begin_request(request.url_rule.rule if request.url_rule else 'unmatched')
+
+
+@app.after_request
+async def end_request_metrics(response):
+    """רישום זמן הבקשה וסטטוס התשובה (בסטרימינג - עד שליחת הכותרות)"""
+    trace = g.pop('trace', None)
+    if trace is not None:
+        metrics.end_request(trace, response.status_code)
+    return response
+
+
+@app.teardown_request
+async def release_session_lock(error):
+    # Runs before a streamed body is sent, so /chat/stream hands the lock to a LockedStream
+    session_id = g.pop('locked_session', None)
+    if session_id is not None:
+        session_locks.release(session_id)
+
+
+@app.errorhandler(llm_dispatch.Unavailable)
+async def try_again(error):
+    """המודל עמוס או לא זמין - תשובת "נסו שוב" במקום שגיאת 500"""
+    metrics.ERRORS.inc(kind='overloaded' if isinstance(error, llm_dispatch.Overloaded) else 'model_unavailable')
+    app.logger.warning("model unavailable: %s", error)
+    return jsonify({'response': TRY_AGAIN_REPLY}), 503, {'Retry-After': '5'}
+
+
+async def send_to_model(chat, user_message, **kwargs):
+    """שליחת ההודעה למודל, עם תזמון וספירת שגיאות"""
+    with metrics.span('model'):
+        try:
+            return await chat.send_message_async(user_message, **kwargs)
+        except Exception:
+            metrics.ERRORS.inc(kind='model')
+            raise
+
+
+async def model_turn(session, user_message, stream=False):
+    """שליחת ההודעה למודל דרך ה־dispatcher - מחזיר (chat, response), כמו ב־app.py"""
+    async def attempt(timeout):
+        chat = start_model_chat(session)
+        return chat, await send_to_model(chat, user_message, stream=stream, request_options={'timeout': timeout})
+    return await dispatcher.call_async(attempt, hedge=not stream)
+
+
+@app.route('/')
+async def index():
+    """עמוד ראשי"""
+    return await render_template('index.html')
+
+
+@app.route('/start', methods=['POST'])
+async def start_chat():
+    """תחילת שיחה - בקשת ת"ז"""
+    return jsonify(open_session())
+
+
+async def parse_chat_request():
+    """קריאת הבקשה ונעילת השיחה - מחזיר (session_id, session, הודעה, שגיאה) כמו ב־app.py"""
+    session_id, session, user_message, error = lookup_chat_session(await request.get_json())
+    if error:
+        return None, None, None, (jsonify(error), 400)
+    with metrics.span('session_wait'):
+        await session_locks.acquire_async(session_id, SESSION_LOCK_TIMEOUT)
+    g.locked_session = session_id
+    session = chat_sessions.get(session_id) or session
+    return session_id, session, user_message, None
+
+
+@app.route('/chat', methods=['POST'])
+async def chat():
+    """ניהול השיחה"""
+    session_id, session, user_message, error = await parse_chat_request()
+    if error:
+        return error
+
+    if session['state'] == 'waiting_for_id':
+        payload, status = await asyncio.to_thread(login, session, user_message)
+        chat_sessions.put(session_id, session)
+        return jsonify(payload), status
+
+    response_text, cache_tag = await asyncio.to_thread(local_answer, session, user_message)
+    if response_text is None and TEXT_TO_SQL:
+        response_text = await asyncio.to_thread(sql_answer, session, user_message, cache_tag)
+    if response_text is not None:
+        chat_sessions.put(session_id, session)
+    else:
+        chat, response = await model_turn(session, user_message)
+        log_usage(session, user_message, response)
+        save_history(session, chat)
+        chat_sessions.put(session_id, session)
+        response_text = clean_model_text(session, response.text.strip())
+        remember_answer(session, user_message, cache_tag, response_text)
+
+    return jsonify(build_reply(user_message, response_text))
+
+
+@app.route('/chat/stream', methods=['POST'])
+async def chat_stream():
+    """ניהול השיחה עם הזרמת התשובה כ־SSE"""
+    session_id, session, user_message, error = await parse_chat_request()
+    if error:
+        return error
+
+    if session['state'] == 'waiting_for_id':
+        payload, status = await asyncio.to_thread(login, session, user_message)
+        chat_sessions.put(session_id, session)
+        if status != 200:
+            return jsonify(payload), status
+        return Response(sse_event('done', payload), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+    response_text, cache_tag = await asyncio.to_thread(local_answer, session, user_message)
+    if response_text is None and TEXT_TO_SQL:
+        response_text = await asyncio.to_thread(sql_answer, session, user_message, cache_tag)
+    if response_text is not None:
+        chat_sessions.put(session_id, session)
+        payload = build_reply(user_message, response_text)
+        return Response(sse_event('done', payload), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+    chat, response = await model_turn(session, user_message, stream=True)
+
+    async def generate():
+        preview = StreamPreview(session.get('user_name'))
+        try:
+            with metrics.span('model_stream'):
+                async for chunk in response:
+                    delta = preview.feed(chunk.text)
+                    if delta:
+                        yield sse_event('token', {'text': delta})
+        except stream_errors() as e:
+            metrics.ERRORS.inc(kind='stream')
+            app.logger.warning("stream failed: %s", type(e).__name__)
+            yield sse_event('error', {'error': 'Streaming failed.'})
+            return
+
+        log_usage(session, user_message, response)
+        save_history(session, chat)
+        chat_sessions.put(session_id, session)
+        response_text = clean_model_text(session, response.text.strip())
+        remember_answer(session, user_message, cache_tag, response_text)
+        yield sse_event('done', build_reply(user_message, response_text))
+
+    # The lock now belongs to the body, which releases it when it is closed
+    stream = LockedStream(session_id, generate())
+    g.pop('locked_session')
+    return Response(stream, mimetype='text/event-stream', headers=SSE_HEADERS)
+
+
+@app.route('/analytics/<rollup>')
+async def analytics_endpoint(rollup):
+    """נתונים מצטברים לצוות - כמו ב־app.py"""
+    payload, status = await asyncio.to_thread(analytics_query, rollup, request.args, request.headers.get('Authorization'))
+    return jsonify(payload), status
+
+
+@app.route('/metrics')
+async def metrics_endpoint():
+    """מדדים בפורמט Prometheus"""
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/stats')
+async def stats():
+    """נתוני המסלול המהיר והמטמון - כמה בקשות נענו בלי המודל"""
+    return jsonify({**intent_router.stats(), 'response_cache': response_cache.stats(), 'text_to_sql': sql_engine.stats(),
+                    'analytics': analytics_engine.stats(), 'model': models.stats(), 'dispatcher': dispatcher.stats()})
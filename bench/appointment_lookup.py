@@ -0,0 +1,87 @@
+"""מדידת זמן חיפוש "התור הבא" כפונקציה של מספר התורים למטופל.
+
+משווה את הגישה הישנה (שליפת כל שורות המטופל וסריקה ב־Python עם strptime)
+לשאילתה המאונדקסת ב־db.next_appointment ולגרסה המרוכזת לכמה מטופלים. זמן
+הסריקה גדל ליניארית עם מספר התורים, והשאילתה נשארת כמעט קבועה.
+
+    python -m bench.appointment_lookup --sizes 10 100 1000 10000 --users 200
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import UTC, datetime, timedelta
+
+import db
+import db_setup
+
+NOW = datetime(2025, 6, 1, tzinfo=UTC)
+
+
+def build_database(path, users, per_user):
+    """DB סינתטי עם per_user תורים לכל מטופל, פזורים שנתיים סביב NOW"""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    db_setup.create_schema(cursor)
+    cursor.execute("INSERT INTO sites (site_id, site_name) VALUES (1, 'אסותא')")
+    rows = []
+    for u in range(users):
+        for i in range(per_user):
+            when = NOW + timedelta(minutes=random.randint(-525600, 525600))
+            rows.append((f"u{u}-{i}", f"u{u}", 'בדיקה', when.strftime('%Y-%m-%d %H:%M:%S+00:00'),
+                         'NewAppointment', None, None, 1,
+                         int(when.timestamp()), when.strftime('%Y-%m-%dT%H:%M:%SZ'), None))
+    cursor.executemany(db_setup.UPSERT_SQL, rows)
+    conn.commit()
+    conn.close()
+
+
+def scan_next_appointment(db_path, user_id):
+    """הגישה הקודמת: כל השורות של המטופל ו־strptime לכל השוואה"""
+    now = NOW.replace(tzinfo=None)
+    best = None
+    rows = db.get_connection(db_path).execute("SELECT * FROM appointments WHERE user_id=?", (user_id,))
+    for appt in rows:
+        appt_date = datetime.strptime(appt['appointment_date_time'][:19], '%Y-%m-%d %H:%M:%S')
+        if appt_date > now and (
+            best is None or appt_date < datetime.strptime(best['appointment_date_time'][:19], '%Y-%m-%d %H:%M:%S')
+        ):
+            best = appt
+    return best
+
+
+def timed(fn, user_ids):
+    start = time.perf_counter()
+    for user_id in user_ids:
+        fn(user_id)
+    return (time.perf_counter() - start) / len(user_ids) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000], help='appointments per patient')
+    parser.add_argument('--users', type=int, default=200)
+    args = parser.parse_args()
+
+    now = int(NOW.timestamp())
+    print(f"{'per patient':>12} {'scan µs':>10} {'indexed µs':>11} {'batched µs':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for per_user in args.sizes:
+            path = os.path.join(tmp, f'bench_{per_user}.db')
+            users = max(1, min(args.users, 2_000_000 // per_user))
+            build_database(path, users, per_user)
+            user_ids = [f"u{u}" for u in range(users)]
+
+            scan = timed(lambda user_id, path=path: scan_next_appointment(path, user_id), user_ids[:20])
+            indexed = timed(lambda user_id, path=path: db.next_appointment(path, user_id, now), user_ids)
+            start = time.perf_counter()
+            db.next_appointments(path, user_ids, now)
+            batched = (time.perf_counter() - start) / len(user_ids) * 1e6
+            print(f"{per_user:>12} {scan:>10.1f} {indexed:>11.1f} {batched:>11.1f}")
+            db.close_connections()
+
+
+if __name__ == '__main__':
+    main()
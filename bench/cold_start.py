@@ -0,0 +1,105 @@
+"""מדידת cold start: זמן הייבוא של app.py והבקשות הראשונות בתהליך חדש.
+
+כל הרצה היא תהליך Python חדש שמייבא את האפליקציה ושולח /, /start והזדהות
+(הגישה הראשונה ל־DB), ואז בונה את מודל Gemini (הייבוא של ה־SDK, בלי רשת).
+המדידה נעשית במצב legacy (העתקת ה־DB ל־/tmp) ובמצב serverless (פתיחה במקום
+עם immutable=1); לפני כל הרצה ב־legacy העותק ב־/tmp נמחק, כמו במופע חדש.
+עם --app-dir אפשר למדוד checkout אחר, למשל גרסה קודמת להשוואה.
+
+    python -m bench.cold_start --runs 5
+    python -m bench.cold_start --app-dir /tmp/before --modes legacy
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+
+import db_setup
+
+LEGACY_COPY = '/tmp/app_database.db'
+
+# Runs in a fresh interpreter inside the app directory and prints one JSON line
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+timings = {'import': time.perf_counter() - start}
+client = app.app.test_client()
+for name, call in [
+    ('index', lambda: client.get('/')),
+    ('start', lambda: client.post('/start')),
+]:
+    start = time.perf_counter()
+    rv = call()
+    assert rv.status_code == 200, (name, rv.status_code)
+    timings[name] = time.perf_counter() - start
+timings['sdk_loaded_before_login'] = 'google.generativeai' in sys.modules
+session_id = client.post('/start').get_json()['session_id']
+start = time.perf_counter()
+rv = client.post('/chat', json={'session_id': session_id, 'message': sys.argv[1]})
+assert rv.status_code == 200 and 'error' not in rv.get_json(), rv.get_json()
+timings['login'] = time.perf_counter() - start
+start = time.perf_counter()
+app.get_model()
+timings['model_init'] = time.perf_counter() - start
+print(json.dumps(timings))
+"""
+
+STEPS = ['import', 'index', 'start', 'login', 'model_init']
+
+
+def first_user_id(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT user_id FROM accounts ORDER BY user_id LIMIT 1").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def probe(app_dir, mode, user_id):
+    """הרצה אחת בתהליך חדש - מחזיר את הזמנים בשניות"""
+    env = dict(os.environ, SERVERLESS='1' if mode == 'serverless' else '0', LOG_LEVEL='WARNING')
+    env.pop('VERCEL', None)
+    if mode == 'legacy' and os.path.exists(LEGACY_COPY):
+        os.remove(LEGACY_COPY)
+    out = subprocess.run([sys.executable, '-c', PROBE, user_id], cwd=app_dir, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--modes', nargs='+', default=['legacy', 'serverless'], choices=['legacy', 'serverless'])
+    parser.add_argument('--app-dir', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help='checkout to measure (default: this one)')
+    args = parser.parse_args()
+
+    app_dir = os.path.abspath(args.app_dir)
+    bundled = os.path.join(app_dir, 'app_database.db')
+    built = not os.path.exists(bundled)
+    if built:
+        with contextlib.redirect_stdout(io.StringIO()):
+            db_setup.setup_database(os.path.join(app_dir, 'data/appointments_cleaned_for_bigquery.csv'), bundled)
+    try:
+        user_id = first_user_id(bundled)
+        print(f"{'mode':<12}" + ''.join(f"{step + ' ms':>14}" for step in STEPS) + f"{'SDK at login':>14}")
+        for mode in args.modes:
+            runs = [probe(app_dir, mode, user_id) for _ in range(args.runs)]
+            medians = [statistics.median(run[step] for run in runs) * 1000 for step in STEPS]
+            sdk = sum(run['sdk_loaded_before_login'] for run in runs)
+            print(f"{mode:<12}" + ''.join(f"{value:>14.1f}" for value in medians) + f"{sdk:>11}/{len(runs)}")
+    finally:
+        if built:
+            os.remove(bundled)
+        if os.path.exists(LEGACY_COPY):
+            os.remove(LEGACY_COPY)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""מודל Gemini מדומה להרצת בנצ'מרקים ובדיקות עומס בלי רשת ובלי מפתח API.
+
+מחקה את הממשק של GenerativeModel/ChatSession שהאפליקציה משתמשת בו:
+start_chat, send_message ו־send_message_async (עם stream), generate_content
+ו־usage_metadata. התשובות דטרמיניסטיות - מחרוזת קבועה, פונקציה של ההודעה,
+או ברירת המחדל שבוחרת תשובה מתוך REPLIES לפי hash של ההודעה. זמן התגובה
+מורכב מהשהיה עד הטוקן הראשון ועוד השהיה לכל chunk נוסף. עם fail_every=N
+כל קריאה N־ית נכשלת בשגיאה חולפת (503), כמו עומס אצל הספק.
+"""
+import asyncio
+import threading
+import time
+import zlib
+
+from google.api_core.exceptions import ServiceUnavailable
+
+# תשובות בסגנון של המודל האמיתי - עם ברכה, רשימות ושאלות המשך שהעיבוד מסיר
+REPLIES = [
+    "מצאתי תור אחד לבדיקת שינה.",
+    "שלום יוסי! הבדיקה הבאה שלך היא MRI ב־14/06/2022 בשעה 08:30 באסותא רמת החייל.\nהאם תרצה הנחיות הגעה למתקן?",
+    "לבדיקה יש להצטייד ב:\n- תעודה מזהה\n- הפניה מהרופא המטפל\n- טופס 17 בתוקף\nיש לך שאלות על ההכנות לבדיקה?",
+    (
+        "מצאתי 2 תורים:\n1. ייעוץ המטולוגיה - 02/06/2022 10:00\n2. בדיקת עיניים - 15/06/2022 12:30\n"
+        "האם תרצה פרטים נוספים על אחד מהתורים?"
+    ),
+    "לפני בדיקת CT עם חומר ניגוד יש לצום 4 שעות. מותר לשתות מים עד שעתיים לפני הבדיקה.",
+    "לביטול או שינוי תור אפשר לפנות למוקד הזימונים או לאתר אסותא. מה עוד אוכל לעזור לך?",
+]
+CHUNK_CHARS = 12
+
+
+def hashed_reply(message):
+    """תשובה קבועה לכל הודעה, מתוך REPLIES"""
+    return REPLIES[zlib.crc32(message.encode('utf-8')) % len(REPLIES)]
+
+
+class FakeServiceUnavailable(ServiceUnavailable):
+    """ServiceUnavailable של google.api_core - שגיאה חולפת עם code 503"""
+
+
+class FakeUsage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.cached_content_token_count = None
+        self.candidates_token_count = candidates_token_count
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeResponse:
+    """תשובה של המודל המדומה; בסטרימינג האיטרציה מחזירה chunks עם השהיה ביניהם"""
+
+    def __init__(self, text, prompt_text, chunk_delay=0.0, stream=False):
+        self.text = text
+        self.usage_metadata = FakeUsage(len(prompt_text) // 3 + 1, len(text) // 3 + 1)
+        self.chunk_delay = chunk_delay
+        self._chunks = [text[i:i + CHUNK_CHARS] for i in range(0, len(text), CHUNK_CHARS)] if stream else []
+
+    def __iter__(self):
+        for i, chunk in enumerate(self._chunks):
+            if i:
+                time.sleep(self.chunk_delay)
+            yield FakeChunk(chunk)
+
+    async def __aiter__(self):
+        for i, chunk in enumerate(self._chunks):
+            if i:
+                await asyncio.sleep(self.chunk_delay)
+            yield FakeChunk(chunk)
+
+
+class FakeChat:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history)
+
+    def _record(self, message, stream):
+        reply = self.model.reply_for(message)
+        prompt_text = "".join(str(part) for entry in self.history for part in _parts(entry)) + message
+        self.history += [
+            {"role": "user", "parts": [message]},
+            {"role": "model", "parts": [reply]},
+        ]
+        return FakeResponse(reply, prompt_text, self.model.chunk_delay, stream)
+
+    def send_message(self, message, stream=False, request_options=None):
+        self.model.count_call()
+        response = self._record(message, stream)
+        # Streaming returns after the first token; the rest arrives while iterating
+        time.sleep(self.model.latency if stream else self.model.total_latency(response.text))
+        return response
+
+    async def send_message_async(self, message, stream=False, request_options=None):
+        self.model.count_call()
+        response = self._record(message, stream)
+        await asyncio.sleep(self.model.latency if stream else self.model.total_latency(response.text))
+        return response
+
+
+def _parts(entry):
+    return entry["parts"] if isinstance(entry, dict) else [part.text for part in entry.parts]
+
+
+class FakeModel:
+    """מודל מדומה עם תשובות דטרמיניסטיות והשהיה ניתנת להגדרה.
+
+    reply הוא מחרוזת קבועה, פונקציה message -> טקסט, או None לבחירה מ־REPLIES.
+    latency היא ההשהיה עד הטוקן הראשון ו־chunk_delay ההשהיה לכל chunk נוסף.
+    fail_every=N מכשיל כל קריאה N־ית (0 - אף פעם).
+    """
+
+    def __init__(self, reply="מצאתי תור אחד לבדיקת שינה.", latency=0.5, chunk_delay=0.0, fail_every=0):
+        self.reply = reply
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.fail_every = fail_every
+        self.calls = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def count_call(self):
+        with self._lock:
+            self.calls += 1
+            failed = bool(self.fail_every) and self.calls % self.fail_every == 0
+            self.failures += failed
+        if failed:
+            raise FakeServiceUnavailable('503 The model is overloaded. Please try again later.')
+
+    def reply_for(self, message):
+        if self.reply is None:
+            return hashed_reply(message)
+        return self.reply(message) if callable(self.reply) else self.reply
+
+    def total_latency(self, text):
+        chunks = max(1, -(-len(text) // CHUNK_CHARS))
+        return self.latency + (chunks - 1) * self.chunk_delay
+
+    def start_chat(self, history):
+        return FakeChat(self, history)
+
+    def generate_content(self, prompt, stream=False, request_options=None):
+        self.count_call()
+        text = self.reply_for(prompt)
+        response = FakeResponse(text, prompt, self.chunk_delay, stream)
+        time.sleep(self.latency if stream else self.total_latency(text))
+        return response
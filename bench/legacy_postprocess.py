@@ -0,0 +1,157 @@
+"""מימוש העיבוד של תשובות המודל כפי שהיה ב־app.py לפני postprocess.py.
+
+נשמר כמו שהוא (בלי הדפסות הדיבאג) כנקודת ייחוס: הבנצ'מרק משווה אליו את
+הזמנים, והבדיקות מוודאות ש־postprocess מחזיר בדיוק את אותה תוצאה.
+"""
+import re
+
+
+def format_bot_text(text):
+    """המרת טקסט רגיל עם מספור/נקודות ל־HTML <ol>/<ul> עם ניקוי כוכביות"""
+    if not text:
+        return ""
+    if any(tag in text for tag in ("<ol", "<ul", "<li")):
+        return text
+
+    # מסירים כוכביות מיותרות מהטקסט
+    text = text.replace('*', '')
+
+    lines = [ln.strip() for ln in text.splitlines()]
+    lines = [ln for ln in lines if ln]
+
+    if not lines:
+        return ""
+
+    num_re = re.compile(r'^\d+[\.\)]\s+')
+    bullet_re = re.compile(r'^([\-•])\s+')
+
+    num_hits = sum(1 for ln in lines if num_re.match(ln))
+    bullet_hits = sum(1 for ln in lines if bullet_re.match(ln))
+
+    if num_hits >= max(2, len(lines) // 2):
+        items = [num_re.sub('', ln) for ln in lines if num_re.match(ln)]
+        if items:
+            return "<ol>" + "".join(f"<li>{it}</li>" for it in items) + "</ol>"
+
+    if bullet_hits >= max(2, len(lines) // 2):
+        items = [bullet_re.sub('', ln) for ln in lines if bullet_re.match(ln)]
+        if items:
+            return "<ul>" + "".join(f"<li>{it}</li>" for it in items) + "</ul>"
+
+    return "<br>".join(lines)
+
+    # רשימה עם נקודות
+    if bullet_hits >= max(2, len(lines) // 2):
+        items = [bullet_re.sub('', ln) for ln in lines if bullet_re.match(ln)]
+        if items:
+            return "<ul>" + "".join(f"<li>{it}</li>" for it in items) + "</ul>"
+
+    # ברירת מחדל - שבירת שורות
+    return "<br>".join(lines)
+
+def should_add_followup_question(user_message, response_text):
+    """קובע אם צריך להוסיף שאלת המשך לתשובה"""
+    appointment_keywords = ['תור', 'תורים', 'בדיקה', 'בדיקות', 'appointment', 'המטולוג', 'עיניים', 'גסטרו', 'CT', 'MRI']
+    user_lower = user_message.lower()
+    response_lower = response_text.lower()
+    
+    # בדיקה אם השאלה או התשובה קשורות לתורים
+    user_has_appointment = any(keyword in user_lower for keyword in appointment_keywords)
+    response_has_appointment = any(keyword in response_lower for keyword in appointment_keywords)
+    
+    # לא מוסיפים שאלת המשך אם המשתמש כבר שאל שאלה ספציפית
+    specific_questions = ['איך', 'מה', 'מתי', 'איפה', 'כמה', 'האם', 'הגעה', 'להביא', 'צום', 'הכנה']
+    user_asked_specific = any(q in user_lower for q in specific_questions)
+    
+    return (user_has_appointment or response_has_appointment) and not user_asked_specific
+
+def generate_followup_question(user_message, response_text):
+    """יוצר שאלת המשך מתאימה בהתבסס על התשובה"""
+    user_lower = user_message.lower()
+    response_lower = response_text.lower()
+    
+    # שאלות המשך בהתבסס על סוג התשובה
+    if 'תורים' in response_lower or 'תור' in response_lower:
+        # If response lists multiple appointments
+        if 'מצאתי' in response_lower and ('1.' in response_text or 'רופא' in response_text):
+            return "האם תרצה פרטים נוספים על אחד מהתורים? 📝"
+        # If it's a single appointment with details
+        elif any(word in response_lower for word in ['המטולוג', 'עיניים', 'שינה', 'ct', 'mri', 'בדיקת']):
+            return "האם תרצה לדעת מה להביא לבדיקה או איך להגיע? 📋"
+        # If user asked about next appointment specifically
+        elif 'תור הבא' in user_lower or 'תור קרוב' in user_lower:
+            return "יש לך שאלות על ההכנות לבדיקה או הנחיות הגעה? 🗺️"
+    
+    # If no appointments found
+    if 'לא מצאתי תורים' in response_lower:
+        return "האם תרצה לקבוע תור חדש או לבדוק תורים בתאריך אחר? 📅"
+    
+    # If response contains appointment details/instructions
+    if any(word in response_lower for word in ['הצטייד', 'להביא', 'הכנה', 'הנחיות', 'צום']):
+        return "יש לך עוד שאלות על הבדיקה? 🤔"
+    
+    return None
+
+FOLLOWUP_PATTERNS = [
+    "האם תרצה פרטים נוספים על אחד מהתורים?",
+    "יש לך שאלות על ההכנות לבדיקה או הנחיות הגעה?",
+    "האם תרצה לדעת מה להביא לבדיקה או איך להגיע?",
+    "האם תרצה הנחיות הגעה למתקן?",
+    "האם תרצה לקבוע תור חדש או לבדוק תורים בתאריך אחר?",
+    "יש לך שאלות על ההכנות לבדיקה?",
+    "האם תרצה פרטים נוספים על",
+    "יש לך עוד שאלות?",
+    "מה עוד אוכל לעזור לך?"
+]
+
+def greeting_patterns(user_name):
+    """ברכות פתיחה עם שם המשתמש שלא רוצים לחזור עליהן"""
+    return [f"שלום {user_name}", f"שלום {user_name}!", f"{user_name} שלום"]
+
+def strip_greeting(user_name, response_text):
+    """הסרת ברכה חוזרת עם שם המשתמש מתחילת התשובה"""
+    if not user_name:
+        return response_text
+    for pattern in greeting_patterns(user_name):
+        if response_text.startswith(pattern):
+            # Remove the greeting part and continue with the rest
+            response_text = response_text.replace(pattern, "", 1).strip()
+            if response_text.startswith("!") or response_text.startswith(","):
+                response_text = response_text[1:].strip()
+            break
+    return response_text
+
+def strip_followups(response_text):
+    """הסרת שאלת המשך שהמודל הוסיף בעצמו"""
+    original_response = response_text
+    for pattern in FOLLOWUP_PATTERNS:
+        if pattern in response_text:
+            # Remove the follow-up question and any preceding punctuation/line breaks
+            response_text = response_text.replace(pattern, "").strip()
+            response_text = response_text.rstrip("?📝🗺️📋📅").strip()
+            # Clean up multiple line breaks or trailing punctuation
+            response_text = response_text.rstrip("<br>").rstrip("\n").strip()
+            if response_text != original_response:
+                break
+    return response_text
+
+def build_reply(user_message, response_text):
+    """עיצוב התשובה והוספת שאלת המשך - מחזיר את גוף התשובה ל־JSON"""
+    # בדיקה אם התשובה מכילה מידע על תורים ודורשת שאלת המשך
+    responses = []
+    formatted_response = format_bot_text(response_text)
+    responses.append(formatted_response)
+
+    # הוספת שאלת המשך אוטומטית לתשובות על תורים
+    if should_add_followup_question(user_message, response_text):
+        followup_question = generate_followup_question(user_message, response_text)
+        if followup_question:
+            responses.append(followup_question)
+
+    if len(responses) == 1:
+        return {'response': responses[0]}
+    return {'responses': responses}
+
+
+def clean_reply(user_name, response_text):
+    return strip_followups(strip_greeting(user_name, response_text))
@@ -0,0 +1,239 @@
+"""בדיקת עומס מקומית: מטופלים מדומים מול אפליקציית Flask, בלי רשת ובלי מפתח API.
+
+כל מטופל פותח שיחה (/start), מזדהה עם user_id מתוך ה־DB ומנהל שיחה מתוסרטת
+בעברית. המודל הוא bench.fake_llm עם תשובות דטרמיניסטיות והשהיה ניתנת
+להגדרה. בסוף מודפסים תפוקה ו־p50/p95/p99 לכל endpoint ולכל שלב בטיפול
+בבקשה; עם --json התוצאות נשמרות לקובץ להשוואה בין גרסאות. קוד היציאה שונה
+מאפס אם בקשה כלשהי נכשלה.
+
+    python -m bench.load_test --patients 50 --concurrency 10 --latency 0.3
+    python -m bench.load_test --stream --chunk-delay 0.02
+    python -m bench.load_test --fail-every 10 --llm-concurrency 4
+"""
+import argparse
+import contextlib
+import functools
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import app as app_module
+import db_setup
+import llm_dispatch
+from bench.fake_llm import FakeModel
+from llm_dispatch import Dispatcher
+from response_cache import ResponseCache
+
+# שיחה טיפוסית: חלק מהשאלות נענות במסלול המהיר, חלק במודל
+SCRIPT = [
+    'מתי התור הבא שלי?',
+    'אילו תורים יש לי?',
+    'מה צריך להביא לבדיקה?',
+    'איך מגיעים לשם?',
+    'אפשר להזיז את התור?',
+    'תודה רבה',
+]
+
+# Functions in app.py timed as stages; the routes look them up as module globals
+STAGES = {
+    'login': 'login',
+    'user_data': 'get_user_data',
+    'local_answer': 'local_answer',
+    'sql_answer': 'sql_answer',
+    'save_history': 'save_history',
+    'clean': 'clean_model_text',
+    'build_reply': 'build_reply',
+}
+
+
+def percentile(values, q):
+    """אחוזון לפי nearest-rank מרשימה ממוינת"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(q * len(values)) - 1))]
+
+
+class Recorder:
+    """דגימות זמן לפי שם, בטוח לשימוש מכמה threads"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.samples[name].append(seconds)
+
+    def timed(self, name, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+        return wrapper
+
+    def summary(self):
+        rows = {}
+        for name, values in self.samples.items():
+            values = sorted(values)
+            rows[name] = {
+                'n': len(values),
+                'p50_ms': percentile(values, 0.50) * 1000,
+                'p95_ms': percentile(values, 0.95) * 1000,
+                'p99_ms': percentile(values, 0.99) * 1000,
+            }
+        return rows
+
+
+def instrument(stages, model):
+    """עטיפת השלבים ב־app.py והמודל במדידת זמן"""
+    for stage, attr in STAGES.items():
+        setattr(app_module, attr, stages.timed(stage, getattr(app_module, attr)))
+
+    start_model_chat = app_module.start_model_chat
+
+    def timed_chat(session):
+        chat = start_model_chat(session)
+        # Streaming returns at the first token, so this is time-to-first-token there
+        chat.send_message = stages.timed('model', chat.send_message)
+        return chat
+
+    app_module.start_model_chat = timed_chat
+    app_module.get_model = lambda: model
+
+
+def user_ids(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return [row[0] for row in conn.execute("SELECT user_id FROM accounts ORDER BY user_id")]
+    finally:
+        conn.close()
+
+
+def run_patient(user_id, turns, stream, endpoints):
+    """שיחה אחת מלאה; מחזיר את מספר הבקשות ואת מספר הכישלונות"""
+    requests = failures = 0
+    with app_module.app.test_client() as client:
+        start = time.perf_counter()
+        rv = client.post('/start')
+        endpoints.record('/start', time.perf_counter() - start)
+        requests += 1
+        if rv.status_code != 200:
+            return requests, failures + 1
+        session_id = rv.get_json()['session_id']
+
+        for i, message in enumerate([user_id] + turns):
+            name = '/chat (login)' if i == 0 else '/chat/stream' if stream else '/chat'
+            start = time.perf_counter()
+            if stream and i:
+                rv = client.post('/chat/stream', json={'session_id': session_id, 'message': message}, buffered=False)
+                body = b''
+                for chunk in rv.response:
+                    if not body:
+                        endpoints.record('/chat/stream first event', time.perf_counter() - start)
+                    body += chunk
+                ok = rv.status_code == 200 and b'event: done' in body
+                rv.close()
+            else:
+                rv = client.post('/chat', json={'session_id': session_id, 'message': message})
+                ok = rv.status_code == 200 and 'error' not in rv.get_json()
+            endpoints.record(name, time.perf_counter() - start)
+            requests += 1
+            failures += not ok
+    return requests, failures
+
+
+def print_table(title, rows):
+    print(f"\n{title:<26} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, row in rows.items():
+        print(f"{name:<26} {row['n']:>6} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--patients', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--turns', type=int, default=len(SCRIPT), help='scripted messages per patient after login')
+    parser.add_argument('--latency', type=float, default=0.3, help='fake model time to first token, seconds')
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help='fake model delay per extra streamed chunk')
+    parser.add_argument('--stream', action='store_true', help='send turns to /chat/stream instead of /chat')
+    parser.add_argument('--fail-every', type=int, default=0, help='fail every Nth model call with a transient 503')
+    parser.add_argument('--llm-concurrency', type=int, help="the dispatcher's concurrent model calls (default: the app's)")
+    parser.add_argument('--no-cache', action='store_true', help='disable the response cache')
+    parser.add_argument('--db', help='database to use (default: build one from the bundled CSV)')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help="keep the app's own output and logs")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db
+        if db_path is None:
+            db_path = os.path.join(tmp, 'app_database.db')
+            db_setup.setup_database(db_path=db_path)
+        app_module.DB_PATH = db_path
+        if args.no_cache:
+            app_module.response_cache = ResponseCache(max_entries=0)
+
+        if args.llm_concurrency:
+            app_module.dispatcher = Dispatcher(max_concurrency=args.llm_concurrency)
+        model = FakeModel(reply=None, latency=args.latency, chunk_delay=args.chunk_delay, fail_every=args.fail_every)
+        stages, endpoints = Recorder(), Recorder()
+        instrument(stages, model)
+
+        ids = user_ids(db_path)
+        turns = (SCRIPT * (args.turns // len(SCRIPT) + 1))[:args.turns]
+        start = time.perf_counter()
+        with contextlib.ExitStack() as quiet, ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            if not args.verbose:
+                quiet.enter_context(contextlib.redirect_stdout(quiet.enter_context(open(os.devnull, 'w'))))
+                app_module.app.logger.setLevel(logging.WARNING)
+            results = list(pool.map(
+                lambda i: run_patient(ids[i % len(ids)], turns, args.stream, endpoints), range(args.patients)
+            ))
+        elapsed = time.perf_counter() - start
+
+    requests = sum(r for r, _ in results)
+    failures = sum(f for _, f in results)
+    fast_path = app_module.intent_router.stats()
+    report = {
+        'patients': args.patients,
+        'concurrency': args.concurrency,
+        'latency': args.latency,
+        'stream': args.stream,
+        'requests': requests,
+        'failures': failures,
+        'seconds': elapsed,
+        'requests_per_second': requests / elapsed,
+        'model_calls': model.calls,
+        'model_failures': model.failures,
+        'retries': llm_dispatch.RETRIES.value(),
+        'fast_path_hits': fast_path['fast_path_hits'],
+        'response_cache': app_module.response_cache.stats(),
+        'endpoints': endpoints.summary(),
+        'stages': stages.summary(),
+    }
+
+    print(f"{args.patients} patients x {len(turns) + 1} turns, concurrency {args.concurrency}, "
+          f"model latency {args.latency}s{' (streaming)' if args.stream else ''}")
+    print(f"{requests} requests in {elapsed:.2f}s - {requests / elapsed:.1f} req/s, {failures} failed")
+    print(f"model calls {model.calls} ({model.failures} failed, {report['retries']} retried), "
+          f"fast path {fast_path['fast_path_hits']}, cache hits {report['response_cache']['hits']}")
+    print_table('endpoint', report['endpoints'])
+    print_table('stage', report['stages'])
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
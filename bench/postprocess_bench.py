@@ -0,0 +1,69 @@
+"""זמני העיבוד של תשובות המודל: postprocess מול המימוש הקודם.
+
+מריץ את השלבים (ניקוי, עיצוב, עיצוב עם שאלת המשך, והצינור המלא) על קורפוס
+התשובות ב־bench/reply_corpus.jsonl, מוודא שהפלט זהה ומדפיס זמן ממוצע לתשובה.
+
+    python -m bench.postprocess_bench --repeat 2000
+"""
+import argparse
+import json
+import pathlib
+import time
+
+import postprocess
+from bench import legacy_postprocess
+
+CORPUS = pathlib.Path(__file__).with_name('reply_corpus.jsonl')
+
+
+def load_corpus(path=CORPUS):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def stages(impl):
+    """(שם, פונקציה על רשומת קורפוס) לכל שלב ולצינור המלא"""
+    def full(entry):
+        return impl.build_reply(entry['message'], impl.clean_reply(entry['user_name'], entry['reply']))
+
+    return [
+        ('clean', lambda e: impl.clean_reply(e['user_name'], e['reply'])),
+        ('format', lambda e: impl.format_bot_text(e['reply'])),
+        ('reply', lambda e: impl.build_reply(e['message'], e['reply'])),
+        ('pipeline', full),
+    ]
+
+
+def time_stage(fn, corpus, repeat, rounds=5):
+    """זמן ממוצע לתשובה במיקרו־שניות, הטוב מבין כמה סבבים"""
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for entry in corpus:
+                fn(entry)
+        best = min(best, time.perf_counter() - start)
+    return best / (repeat * len(corpus)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=CORPUS, type=pathlib.Path)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    old_stages, new_stages = stages(legacy_postprocess), stages(postprocess)
+    for entry in corpus:
+        assert old_stages[-1][1](entry) == new_stages[-1][1](entry), entry
+
+    print(f"{len(corpus)} replies x {args.repeat}")
+    print(f"{'stage':>10} {'legacy µs':>10} {'new µs':>8} {'speedup':>8}")
+    for (name, old), (_, new) in zip(old_stages, new_stages):
+        old_us = time_stage(old, corpus, args.repeat)
+        new_us = time_stage(new, corpus, args.repeat)
+        print(f"{name:>10} {old_us:>10.2f} {new_us:>8.2f} {old_us / new_us:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""השוואת תפוקה בין שרת ה־WSGI הסינכרוני לשרת ה־ASGI מול מודל מדומה.
+
+ה־WSGI מדומה כ־N workers סינכרוניים (כמו gunicorn -w N) שכל אחד מחזיק בקשה
+אחת בזמן ההמתנה למודל; ה־ASGI מריץ את כל הבקשות בתהליך אחד. לבנצ'מרק יש
+dispatcher משלו עם --llm-concurrency מקומות (ברירת מחדל: מספר הבקשות), כדי
+שהמגבלה של האפליקציה לא תמדוד את עצמה; בקשות שבכל זאת נדחו (503) נספרות.
+
+    python -m bench.serving_compare --requests 200 --workers 4 --latency 0.5
+"""
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app as app_module
+import asgi_app as asgi_module
+from app import app as wsgi_app
+from app import chat_sessions
+from asgi_app import app as asgi_app
+from bench.fake_llm import FakeModel
+from llm_dispatch import Dispatcher
+
+MESSAGE = 'אילו בדיקות יש לי?'
+
+
+def make_sessions(count, latency):
+    model = FakeModel(latency=latency)
+    app_module.get_model = lambda: model
+    app_module.get_user_data = lambda user_id: []
+    session_ids = []
+    for _ in range(count):
+        # A distinct user per session so the response cache never short-circuits the model
+        session_id = os.urandom(16).hex()
+        chat_sessions.put(session_id, {'state': 'chatting', 'user_id': session_id, 'user_name': 'יוסי', 'history': []})
+        session_ids.append(session_id)
+    return session_ids
+
+
+def use_dispatcher(max_concurrency):
+    """dispatcher חדש לשני השרתים - asgi_app מחזיק הפניה משלו לזה של app"""
+    app_module.dispatcher = asgi_module.dispatcher = Dispatcher(max_concurrency=max_concurrency)
+
+
+def run_wsgi(session_ids, workers):
+    """(זמן כולל, מספר תשובות 503)"""
+    def one(session_id):
+        with wsgi_app.test_client() as client:
+            rv = client.post('/chat', json={'session_id': session_id, 'message': MESSAGE})
+            assert rv.status_code in (200, 503), rv.status_code
+            return rv.status_code == 503
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        rejected = sum(pool.map(one, session_ids))
+    return time.perf_counter() - start, rejected
+
+
+async def run_asgi(session_ids):
+    """(זמן כולל, מספר תשובות 503)"""
+    client = asgi_app.test_client()
+
+    async def one(session_id):
+        rv = await client.post('/chat', json={'session_id': session_id, 'message': MESSAGE})
+        assert rv.status_code in (200, 503), rv.status_code
+        return rv.status_code == 503
+
+    start = time.perf_counter()
+    rejected = sum(await asyncio.gather(*(one(session_id) for session_id in session_ids)))
+    return time.perf_counter() - start, rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=4, help='sync workers for the WSGI path')
+    parser.add_argument('--latency', type=float, default=0.5, help='fake model latency in seconds')
+    parser.add_argument('--llm-concurrency', type=int,
+                        help="the dispatcher's concurrent model calls (default: --requests, so none wait for a slot)")
+    args = parser.parse_args()
+
+    use_dispatcher(args.llm_concurrency or args.requests)
+    wsgi_time, wsgi_rejected = run_wsgi(make_sessions(args.requests, args.latency), args.workers)
+    asgi_time, asgi_rejected = asyncio.run(run_asgi(make_sessions(args.requests, args.latency)))
+
+    print(f"{args.requests} concurrent /chat requests, model latency {args.latency}s")
+    print(f"WSGI ({args.workers} workers): {wsgi_time:6.2f}s  {args.requests / wsgi_time:8.1f} req/s  {wsgi_rejected} x 503")
+    print(f"ASGI (1 process):  {asgi_time:6.2f}s  {args.requests / asgi_time:8.1f} req/s  {asgi_rejected} x 503")
+    print(f"speed-up: {wsgi_time / asgi_time:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,224 @@
+"""הרצת שאלות באצווה מול המודל, להערכה אופליין של שינויים בהנחיה.
 
-import sqlite3
-import google.generativeai as genai
+הקלט הוא JSONL עם שורה לכל שאלה - {"id": ..., "user_id": ..., "question": ...}
+(בלי id משמש מספר השורה). הקלט נקרא בחלונות: בכל חלון השאלות מקובצות לפי
+מטופל, נתוני המטופל נשלפים פעם אחת להקשר הכניסה (כמו ב־login של האפליקציה),
+והשאלות נשלחות במקביל דרך Dispatcher עם מגבלת מקביליות וניסיונות חוזרים.
+
+כל תשובה נכתבת מיד כשורת JSONL עם התשובה הגולמית, התשובה כפי שהאפליקציה
+הייתה מחזירה, זמן ומספרי טוקנים. הרצה שנקטעה ממשיכה מאותו מקום: שאלות שכבר
+יש להן תשובה מאותה גרסת הנחיה בקובץ הפלט מדולגות, ושאלות שנכשלו נשלחות שוב
+(השורה האחרונה לכל id קובעת).
+
+    python chatbot.py questions.jsonl results.jsonl --concurrency 8
+"""
+import argparse
+import itertools
+import json
 import os
 import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+import db
+from context_builder import build_login_context, login_greeting
+from llm_dispatch import Dispatcher, Unavailable, model_errors
+from postprocess import build_reply, clean_reply
+from prompt_models import DEFAULT_MODEL, ModelRegistry, SystemPrompt
+from session_store import records_to_history
+
+DEFAULT_WINDOW = 1000
+# Patient contexts kept across windows, so an input sorted by user reads each patient once
+CONTEXT_CACHE_SIZE = 4096
+# Errors that another run would repeat, so a resumed run doesn't ask again
+PERMANENT_ERRORS = {'unknown_user'}
+
+
+def read_questions(path):
+    """שאלות מקובץ JSONL, אחת בכל פעם - (id, user_id, שאלה)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            yield str(item.get('id', line_no)), str(item['user_id']), item['question']
+
+
+def completed_ids(path, prompt_version):
+    """ה־ids שכבר יש להם תשובה מגרסת ההנחיה הזו; שורה אחרונה שנקטעה באמצע נחתכת"""
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            # A crash mid-write leaves a partial line; drop it so appends start clean
+            f.truncate(data.rfind(b'\n') + 1)
+            data = data[:data.rfind(b'\n') + 1]
+    done = set()
+    for line in data.decode('utf-8').splitlines():
+        result = json.loads(line)
+        if result.get('prompt_version') != prompt_version:
+            continue
+        if result.get('error') in PERMANENT_ERRORS or not result.get('error'):
+            done.add(result['id'])
+        else:
+            done.discard(result['id'])
+    return done
+
+
+class PatientContexts:
+    """הקשר הכניסה לכל מטופל (היסטוריה ושם), עם מטמון LRU"""
+
+    def __init__(self, db_path, max_entries=CONTEXT_CACHE_SIZE):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.fetches = 0
+
+    def get(self, user_id):
+        """(רשומות היסטוריה, שם פרטי), או None למטופל שלא קיים"""
+        if user_id in self._entries:
+            self._entries.move_to_end(user_id)
+            return self._entries[user_id]
+        self.fetches += 1
+        user_data = db.fetch_user_data(self.db_path, user_id)
+        context = None
+        if user_data:
+            first_name = user_data[0].get('user_name')
+            records = [
+                {'role': 'user', 'text': build_login_context(user_id, first_name, user_data[0]['age'], user_data)},
+                {'role': 'model', 'text': login_greeting(first_name)},
+            ]
+            context = (records, first_name)
+        self._entries[user_id] = context
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return context
+
+
+def answer(model, dispatcher, context, question_id, user_id, question, prompt_version):
+    """שאלה אחת מול המודל - מחזיר את שורת התוצאה"""
+    result = {'id': question_id, 'user_id': user_id, 'question': question, 'prompt_version': prompt_version}
+    if context is None:
+        return {**result, 'error': 'unknown_user'}
+    records, first_name = context
+
+    def attempt(timeout):
+        chat = model.start_chat(history=records_to_history(records))
+        return chat.send_message(question, request_options={'timeout': timeout})
+
+    start = time.perf_counter()
+    try:
+        response = dispatcher.call(attempt)
+    except (Unavailable, OSError, *model_errors()) as e:
+        # Left for a resumed run; anything else is a bug and stops the batch
+        error = str(e) if isinstance(e, Unavailable) else f'{type(e).__name__}: {e}'
+        return {**result, 'error': error, 'latency_ms': (time.perf_counter() - start) * 1000}
+    latency = time.perf_counter() - start
+
+    text = response.text.strip()
+    usage = getattr(response, 'usage_metadata', None)
+    return {
+        **result,
+        'answer': text,
+        'reply': build_reply(question, clean_reply(first_name, text)),
+        'latency_ms': latency * 1000,
+        'prompt_tokens': getattr(usage, 'prompt_token_count', None),
+        'cached_tokens': getattr(usage, 'cached_content_token_count', None),
+        'response_tokens': getattr(usage, 'candidates_token_count', None),
+    }
+
+
+def run_batch(questions_path, output_path, model, prompt_version, db_path='app_database.db',
+              concurrency=8, window=DEFAULT_WINDOW, dispatcher=None, log=sys.stderr):
+    """הרצת כל השאלות שעוד אין להן תשובה - מחזיר סיכום של ההרצה"""
+    dispatcher = dispatcher or Dispatcher(max_concurrency=concurrency, queue_timeout=float('inf'))
+    done = completed_ids(output_path, prompt_version)
+    contexts = PatientContexts(db_path)
+    latencies = []
+    stats = {'answered': 0, 'errors': 0, 'unknown_users': 0, 'skipped': 0, 'prompt_tokens': 0, 'response_tokens': 0}
+
+    start = time.perf_counter()
+    questions = read_questions(questions_path)
+    with open(output_path, 'a', encoding='utf-8') as out, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            batch = list(itertools.islice(questions, window))
+            if not batch:
+                break
+            pending = [item for item in batch if item[0] not in done]
+            stats['skipped'] += len(batch) - len(pending)
+            # Grouping by patient means each context is built once per window
+            pending.sort(key=lambda item: item[1])
+            futures = [
+                pool.submit(answer, model, dispatcher, contexts.get(user_id), question_id, user_id, question,
+                            prompt_version)
+                for question_id, user_id, question in pending
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                out.write(json.dumps(result, ensure_ascii=False) + '\n')
+                out.flush()
+                if result.get('error') in PERMANENT_ERRORS:
+                    stats['unknown_users'] += 1
+                    continue
+                if result.get('error'):
+                    stats['errors'] += 1
+                    continue
+                done.add(result['id'])
+                stats['answered'] += 1
+                latencies.append(result['latency_ms'])
+                stats['prompt_tokens'] += result['prompt_tokens'] or 0
+                stats['response_tokens'] += result['response_tokens'] or 0
+            print(f"{stats['answered']} answered, {stats['errors']} failed, {stats['skipped']} skipped",
+                  file=log, flush=True)
+
+    latencies.sort()
+    elapsed = time.perf_counter() - start
+    stats.update({
+        'seconds': elapsed,
+        'patients_fetched': contexts.fetches,
+        'p50_ms': latencies[len(latencies) // 2] if latencies else 0.0,
+        'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0,
+    })
+    return stats
 
-def get_user_data(user_id):
-    conn = sqlite3.connect('app_database.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM appointments WHERE user_id=?", (user_id,))
-    user_data = cursor.fetchall()
-    conn.close()
-    return user_data
 
 def main():
-    # Configure the Gemini API key
-    genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('questions', help='JSONL file with user_id and question per line')
+    parser.add_argument('output', help='JSONL results file; an existing file is resumed')
+    parser.add_argument('--db', default='app_database.db', help='SQLite database file')
+    parser.add_argument('--prompt', default='system_prompt.txt', help='system prompt to evaluate')
+    parser.add_argument('--model', default=os.environ.get('GEMINI_MODEL', DEFAULT_MODEL))
+    parser.add_argument('--concurrency', type=int, default=8, help='model calls in flight')
+    parser.add_argument('--rpm', type=int, default=0, help='model calls per minute (0 = unlimited)')
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW, help='questions read and grouped at a time')
+    parser.add_argument('--dry-run', action='store_true', help='answer with the offline fake model instead of Gemini')
+    args = parser.parse_args()
+
     try:
-        with open('system_prompt.txt', 'r', encoding='utf-8') as f:
-            system_prompt = f.read()
+        prompt = SystemPrompt(args.prompt)
+        _, prompt_version = prompt.load()
     except FileNotFoundError:
-        print("Error: system_prompt.txt not found.")
-        return
+        print(f"Error: {args.prompt} not found.", file=sys.stderr)
+        raise SystemExit(1)
+
+    if args.dry_run:
+        from bench.fake_llm import FakeModel
+        model = FakeModel(reply=None, latency=0)
+    else:
+        model = ModelRegistry(prompt, model_name=args.model).get()
+    dispatcher = Dispatcher(max_concurrency=args.concurrency, rpm=args.rpm, queue_timeout=float('inf'))
 
-    model = genai.GenerativeModel(
-        'gemini-1.5-flash',
-        system_instruction=system_prompt
-    )
+    stats = run_batch(args.questions, args.output, model, prompt_version, db_path=args.db,
+                      concurrency=args.concurrency, window=args.window, dispatcher=dispatcher)
+    print(json.dumps(stats, ensure_ascii=False))
+    raise SystemExit(1 if stats['errors'] else 0)
 
-    prompt = f"The user with user_id {user_id} has the following appointments: {user_data}. Question: {user_question}. Answer:"
-    response = model.generate_content(prompt)
-    print(response.text)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,147 @@
+"""בניית ההקשר שנשלח למודל בתקציב טוקנים.
+
+נתוני המטופל מקודדים בצורה דחוסה - טבלת אתרים ללא כפילויות ומפתחות קצרים
+לכל תור - וההיסטוריה נשמרת בתוך התקציב: תורות ישנות מוחלפות בסיכום קצר של
+הנושאים שהמשתמש שאל עליהם. תורות עדכון של נתוני המטופל (update) לא מסוכמות
+אלא נשמרות, כי המידע בהן עדיין בתוקף.
+"""
+import json
+import os
+
+DEFAULT_TOKEN_BUDGET = 4000
+
+# תורות ראשונות שתמיד נשמרות: הקשר הכניסה עם נתוני המטופל ותשובת הברכה
+PINNED_RECORDS = 2
+
+MAX_SUMMARY_TOPICS = 8
+TOPIC_CHARS = 40
+
+# Short keys for appointment fields; everything else in the row is dropped
+APPOINTMENT_FIELDS = {
+    'appointment_type': 't',
+    'appointment_date_time': 'd',
+    'appointment_status': 's',
+    'cancel_reason_code': 'c',
+    'record_type': 'r',
+}
+# The instructions for getting to a site stay out of the context; the directions
+# intent reads them from the sites table when the patient asks
+SITE_FIELDS = ('site_name', 'site_address')
+
+LEGEND = "מקרא: t=סוג התור, d=מועד, s=סטטוס, c=קוד סיבת ביטול, r=סוג רשומה, site=מזהה אתר בטבלת sites"
+
+
+def token_budget():
+    return int(os.environ.get('CONTEXT_TOKEN_BUDGET', str(DEFAULT_TOKEN_BUDGET)))
+
+
+def estimate_tokens(text):
+    """הערכה גסה של מספר הטוקנים - בעברית יוצא בערך טוקן לכל 3 תווים"""
+    return len(text) // 3 + 1
+
+
+def _present(value):
+    return value not in (None, '', 'NaT', 'nan')
+
+
+def encode_appointment(row):
+    """תור אחד במפתחות הקצרים, עם מזהה האתר שלו בטבלת sites"""
+    appointment = {short: row[field] for field, short in APPOINTMENT_FIELDS.items() if _present(row.get(field))}
+    if _present(row.get('site_name')):
+        appointment['site'] = f"S{row['site_id']}"
+    return appointment
+
+
+def encode_site(row):
+    return {key: row[field] for field, key in zip(SITE_FIELDS, ('name', 'address')) if _present(row.get(field))}
+
+
+def encode_user_data(user_data):
+    """קידוד דחוס של התורים: טבלת אתרים אחת ושורה קצרה לכל תור"""
+    sites = {}
+    appointments = []
+    for row in user_data:
+        appointment = encode_appointment(row)
+        if 'site' in appointment:
+            sites.setdefault(appointment['site'], encode_site(row))
+        appointments.append(appointment)
+
+    data = json.dumps({'sites': sites, 'appointments': appointments}, ensure_ascii=False, separators=(',', ':'))
+    return f"{LEGEND}\n{data}"
+
+
+def encode_update(delta):
+    """הודעת עדכון עם ההפרש בלבד מאז הנתונים שהמודל כבר ראה, באותו מקרא"""
+    data = json.dumps(delta, ensure_ascii=False, separators=(',', ':'))
+    return (
+        "עדכון בנתוני המשתמש מה־DB (added=תורים חדשים, changed=לפני ואחרי, removed=תורים שנמחקו, "
+        f"sites=אתרים חדשים): {data}. הנתונים המעודכנים גוברים על הקודמים."
+    )
+
+
+def build_login_context(user_id, first_name, age, user_data):
+    """הודעת ההקשר הראשונה בשיחה - מי המשתמש ומה הנתונים שלו.
+
+    בלי user_data (מצב text-to-SQL) הנתונים לא נכנסים להקשר אלא נשלפים לפי שאלה.
+    """
+    if user_data is None:
+        data = "יישלפו מה־DB לפי הצורך"
+    else:
+        data = encode_user_data(user_data)
+    return (
+        f"המשתמש (user_id: {user_id}, name: {first_name}, age: {age}) התחבר לצ'אט. "
+        f"הנתונים שלו: {data}. אל תחזור על השם שלו בתשובות הבאות."
+    )
+
+
+def login_greeting(first_name):
+    """תשובת הברכה אחרי הכניסה - התורה השנייה שנשמרת בהיסטוריה"""
+    if first_name:
+        return f'שלום {first_name}! איך אוכל לעזור לך היום?'
+    return 'תודה! איך אני יכול לעזור לך היום?'
+
+
+def history_tokens(records):
+    return sum(estimate_tokens(record['text']) for record in records)
+
+
+def window_history(records, budget):
+    """שמירת ההיסטוריה בתקציב: ההקשר הקבוע, סיכום של תורות ישנות והתורות האחרונות.
+
+    התקציב הוא של ההיסטוריה שאחרי ההקשר הקבוע, שגודלו תלוי במספר התורים של
+    המטופל; זוג התורות האחרון נשמר תמיד כלשונו.
+    """
+    head, rest = records[:PINNED_RECORDS], records[PINNED_RECORDS:]
+    topics = []
+    if rest and rest[0].get('summary'):
+        topics = list(rest[0]['topics'])
+        rest = rest[2:]
+
+    # The summary turn can grow to MAX_SUMMARY_TOPICS topics, so reserve that up front
+    used = estimate_tokens('x' * (MAX_SUMMARY_TOPICS * (TOPIC_CHARS + 2) + 40))
+    # The latest exchange is kept whatever it costs, so a follow-up sees the reply it answers
+    keep_from = max(0, len(rest) - 2)
+    used += history_tokens(rest[keep_from:])
+    while keep_from >= 2:
+        cost = history_tokens(rest[keep_from - 2:keep_from])
+        if used + cost > budget:
+            break
+        used += cost
+        keep_from -= 2
+
+    dropped, kept = rest[:keep_from], rest[keep_from:]
+    # Data updates are still in force after the turns around them are summarized
+    updates = [record for record in dropped if record.get('update')]
+    topics += [
+        record['text'][:TOPIC_CHARS] for record in dropped if record['role'] == 'user' and not record.get('update')
+    ]
+    if not topics:
+        return head + updates + kept
+
+    topics = topics[-MAX_SUMMARY_TOPICS:]
+    summary = [
+        {'role': 'user', 'text': "סיכום השיחה עד כה - המשתמש שאל על: " + "; ".join(topics),
+         'summary': True, 'topics': topics},
+        {'role': 'model', 'text': "הבנתי."},
+    ]
+    return head + summary + updates + kept
@@ -0,0 +1,207 @@
+"""שכבת גישה ל־SQLite - חיבורי קריאה בלבד ארוכי חיים, אחד לכל thread"""
+import json
+import pathlib
+import sqlite3
+import threading
+
+# sqlite3 keeps a per-connection LRU of prepared statements keyed by the SQL
+# text, so long-lived connections plus constant query strings give us
+# statement reuse for free.
+STATEMENT_CACHE_SIZE = 128
+MMAP_SIZE = 64 * 1024 * 1024
+CACHE_SIZE_KB = 8 * 1024
+
+# Appointment rows reference their site by site_id; the name and address come from
+# the sites table (a primary-key lookup per row). The instructions are left out and
+# fetched with site_instructions only when the patient asks how to get there.
+USER_DATA_SQL = """
+    SELECT a.*, s.site_name, s.site_address, u.user_name, u.age, u.data_version
+    FROM appointments a
+    JOIN accounts u ON a.user_id = u.user_id
+    LEFT JOIN sites s ON s.site_id = a.site_id
+    WHERE a.user_id=?
+"""
+
+# accounts.data_version changes whenever ingest touches one of the patient's
+# appointments (see db_setup), so this one-row read says whether data is stale
+USER_VERSION_SQL = "SELECT data_version FROM accounts WHERE user_id=?"
+
+_local = threading.local()
+# Files opened with immutable=1 - see mark_immutable
+_immutable = set()
+
+
+def mark_immutable(db_path):
+    """סימון קובץ DB שלא משתנה כל עוד התהליך רץ (למשל ה־DB שבחבילת הפריסה).
+
+    חיבורים אליו נפתחים עם immutable=1: בלי נעילות, בלי קבצי -wal/-shm וכך
+    גם מתיקייה לקריאה בלבד. SQLite לא רואה שינויים בקובץ כזה, וגם לא תוכן
+    שנשאר בקובץ -wal - ה־DB צריך להיות סגור (אחרי checkpoint) לפני האריזה.
+    """
+    _immutable.add(pathlib.Path(db_path).resolve())
+
+
+def _readonly_uri(db_path):
+    path = pathlib.Path(db_path).resolve()
+    return path.as_uri() + ('?mode=ro&immutable=1' if path in _immutable else '?mode=ro')
+
+
+def connect_readonly(db_path):
+    """חיבור חדש לקריאה בלבד עם ה־pragmas של האפליקציה"""
+    conn = sqlite3.connect(
+        _readonly_uri(db_path),
+        uri=True,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only=ON")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    return conn
+
+
+def get_connection(db_path):
+    """מחזיר חיבור קריאה בלבד של ה־thread הנוכחי, ופותח אותו בפעם הראשונה"""
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(db_path)
+    if conn is None:
+        conn = conns[db_path] = connect_readonly(db_path)
+    return conn
+
+
+def close_connections():
+    """סגירת החיבורים של ה־thread הנוכחי (לבדיקות ולכיבוי)"""
+    conns = getattr(_local, 'conns', None) or {}
+    for conn in conns.values():
+        conn.close()
+    conns.clear()
+
+
+def fetch_user_data(db_path, user_id):
+    """כל התורים של המטופל יחד עם פרטי החשבון שלו"""
+    rows = get_connection(db_path).execute(USER_DATA_SQL, (user_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def user_version(db_path, user_id):
+    """גרסת הנתונים הנוכחית של המטופל, או None אם אין חשבון כזה"""
+    row = get_connection(db_path).execute(USER_VERSION_SQL, (user_id,)).fetchone()
+    return row[0] if row else None
+
+
+# Date lookups go through appointment_epoch (UTC seconds, NULL when the source date
+# was missing), computed once at ingest and indexed together with user_id, so each
+# query is an index seek plus at most `limit` rows - independent of how many
+# appointments the patient has. All `now`/`start`/`end` arguments are epoch seconds.
+APPOINTMENT_SELECT = """
+    SELECT a.*, s.site_name, s.site_address
+    FROM appointments a
+    LEFT JOIN sites s ON s.site_id = a.site_id
+"""
+
+NEXT_APPOINTMENT_SQL = APPOINTMENT_SELECT + """
+    WHERE a.user_id=? AND a.appointment_epoch>=?
+    ORDER BY a.appointment_epoch
+    LIMIT 1
+"""
+
+APPOINTMENTS_BETWEEN_SQL = APPOINTMENT_SELECT + """
+    WHERE a.user_id=? AND a.appointment_epoch>=? AND a.appointment_epoch<?
+    ORDER BY a.appointment_epoch
+    LIMIT ?
+"""
+
+PAST_APPOINTMENTS_SQL = APPOINTMENT_SELECT + """
+    WHERE a.user_id=? AND a.appointment_epoch<?
+    ORDER BY a.appointment_epoch DESC
+    LIMIT ?
+"""
+
+LATEST_WITH_STATUS_SQL = APPOINTMENT_SELECT + """
+    WHERE a.user_id=? AND a.appointment_status=? AND a.appointment_epoch IS NOT NULL
+    ORDER BY a.appointment_epoch DESC
+    LIMIT 1
+"""
+
+RECENT_APPOINTMENTS_SQL = APPOINTMENT_SELECT + """
+    WHERE a.user_id=? AND a.appointment_epoch IS NOT NULL
+    ORDER BY a.appointment_epoch DESC
+    LIMIT ?
+"""
+
+# One statement for a whole batch of patients: the user_ids arrive as a JSON array,
+# and the correlated subquery does the same single index seek per patient as
+# NEXT_APPOINTMENT_SQL.
+NEXT_APPOINTMENTS_BATCH_SQL = """
+    SELECT a.*, s.site_name, s.site_address FROM json_each(?) AS ids
+    JOIN appointments a ON a.row_id = (
+        SELECT row_id FROM appointments
+        WHERE user_id=ids.value AND appointment_epoch>=?
+        ORDER BY appointment_epoch
+        LIMIT 1
+    )
+    LEFT JOIN sites s ON s.site_id = a.site_id
+"""
+
+USER_SITES_SQL = """
+    SELECT s.site_id, s.site_name, s.site_address, MAX(a.appointment_epoch) AS last_epoch
+    FROM appointments a
+    JOIN sites s ON s.site_id = a.site_id
+    WHERE a.user_id=?
+    GROUP BY s.site_id
+    ORDER BY last_epoch DESC
+"""
+
+SITE_INSTRUCTIONS_SQL = """
+    SELECT instructions, transport, car, parking, accessibility FROM sites WHERE site_id=?
+"""
+
+
+def _dicts(rows):
+    return [dict(row) for row in rows]
+
+
+def next_appointment(db_path, user_id, now):
+    """התור הקרוב ביותר מ־now והלאה, או None"""
+    row = get_connection(db_path).execute(NEXT_APPOINTMENT_SQL, (user_id, now)).fetchone()
+    return dict(row) if row else None
+
+
+def appointments_between(db_path, user_id, start, end, limit=20):
+    """תורים בטווח [start, end) לפי סדר כרונולוגי"""
+    return _dicts(get_connection(db_path).execute(APPOINTMENTS_BETWEEN_SQL, (user_id, start, end, limit)))
+
+
+def past_appointments(db_path, user_id, now, limit=10):
+    """limit התורים האחרונים שלפני now, מהחדש לישן"""
+    return _dicts(get_connection(db_path).execute(PAST_APPOINTMENTS_SQL, (user_id, now, limit)))
+
+
+def latest_appointment_with_status(db_path, user_id, status):
+    """התור המאוחר ביותר של המטופל בסטטוס status (כולל עתידיים), או None"""
+    row = get_connection(db_path).execute(LATEST_WITH_STATUS_SQL, (user_id, status)).fetchone()
+    return dict(row) if row else None
+
+
+def recent_appointments(db_path, user_id, limit=10):
+    """התורים האחרונים (כולל עתידיים), מהחדש לישן"""
+    return _dicts(get_connection(db_path).execute(RECENT_APPOINTMENTS_SQL, (user_id, limit)))
+
+
+def next_appointments(db_path, user_ids, now):
+    """התור הקרוב של כל אחד מהמטופלים בשאילתה אחת - {user_id: תור}; מי שאין לו תור לא מופיע"""
+    rows = get_connection(db_path).execute(NEXT_APPOINTMENTS_BATCH_SQL, (json.dumps(list(user_ids)), now))
+    return {row['user_id']: dict(row) for row in rows}
+
+
+def user_sites(db_path, user_id):
+    """האתרים שבהם יש למטופל תורים, מהאחרון שביקר בו"""
+    return _dicts(get_connection(db_path).execute(USER_SITES_SQL, (user_id,)))
+
+
+def site_instructions(db_path, site_id):
+    """הנחיות ההגעה לאתר - הטקסט המלא והפרקים שלו, או None"""
+    row = get_connection(db_path).execute(SITE_INSTRUCTIONS_SQL, (site_id,)).fetchone()
+    return dict(row) if row else None
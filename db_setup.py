@@ -1,25 +1,138 @@
-import pandas as pd
-import sqlite3
+import argparse
+import hashlib
+import html
 import random
+import re
+import sqlite3
+import time
+
+import pandas as pd
 
-def setup_database():
-    # Read the CSV file into a pandas DataFrame
-    df = pd.read_csv('data/appointments_cleaned_for_bigquery.csv')
+# Source columns we load, keyed by their normalized (stripped, lower-cased) CSV header
+SOURCE_COLUMNS = {
+    'row_id': 'row_id',
+    'user_id': 'user_id',
+    'appoitment_type': 'appointment_type',
+    'appointment_date_time_c': 'appointment_date_time',
+    'appointment_date_time__c': 'appointment_date_time',
+    'appointment_status': 'appointment_status',
+    'cancel_reason_code': 'cancel_reason_code',
+    'record_type': 'record_type',
+    'site_name': 'site_name',
+    'site_address': 'site_address',
+    'site_instructions': 'site_instructions',
+}
 
-    # Data Cleaning and Preprocessing
-    df.columns = df.columns.str.strip()
-    df = df.drop_duplicates()
+APPOINTMENT_COLUMNS = [
+    'row_id', 'user_id', 'appointment_type', 'appointment_date_time', 'appointment_status',
+    'cancel_reason_code', 'record_type', 'site_id',
+]
+DERIVED_COLUMNS = ['appointment_epoch', 'appointment_ts', 'content_hash']
+# Site text that older databases kept on every appointment row
+LEGACY_SITE_COLUMNS = ['site_name', 'site_address', 'site_instructions']
 
-    # Convert date column to datetime objects
-    df['appointment_date_time_c'] = pd.to_datetime(df['appointment_date_time_c'], errors='coerce')
+UPSERT_SQL = f'''
+INSERT INTO appointments ({", ".join(APPOINTMENT_COLUMNS + DERIVED_COLUMNS)})
+VALUES ({", ".join("?" * len(APPOINTMENT_COLUMNS + DERIVED_COLUMNS))})
+ON CONFLICT(row_id) DO UPDATE SET
+    {", ".join(f"{col}=excluded.{col}" for col in APPOINTMENT_COLUMNS[1:] + DERIVED_COLUMNS)}
+WHERE appointments.content_hash IS NOT excluded.content_hash
+'''
 
-    # Create a connection to the SQLite database
-    conn = sqlite3.connect('app_database.db')
-    cursor = conn.cursor()
+# Each site is stored once: the instructions as plain text, and the parts of
+# them a patient usually asks about split out in advance
+SITE_SECTIONS = ['transport', 'car', 'parking', 'accessibility']
+
+SITE_UPSERT_SQL = f'''
+INSERT INTO sites (site_name, site_address, instructions, {", ".join(SITE_SECTIONS)}, content_hash)
+VALUES (?, ?, ?, {", ".join("?" * len(SITE_SECTIONS))}, ?)
+ON CONFLICT(site_name) DO UPDATE SET
+    {", ".join(f"{col}=excluded.{col}" for col in ['site_address', 'instructions'] + SITE_SECTIONS + ['content_hash'])}
+WHERE sites.content_hash IS NOT excluded.content_hash
+'''
 
-    # Drop tables if they exist
-    cursor.execute("DROP TABLE IF EXISTS appointments")
-    cursor.execute("DROP TABLE IF EXISTS accounts")
+# Paragraphs, list items and line breaks each become a line; all other tags are dropped
+LINE_BREAK_RE = re.compile(r'<\s*(?:br|/p|/div|/li|li)\b[^>]*>', re.IGNORECASE)
+TAG_RE = re.compile(r'<[^>]*>')
+# The pre-stripped export lost its line breaks: headings, sentences and "למגיעים מ..."
+# items run into each other, so those boundaries are put back. A final-form letter
+# (ם ן ץ ף ך) or a number directly followed by a word also marks a lost break.
+GLUED_HEADING_RE = re.compile(
+    r'((?:דרכי|הנחיות) הגעה ב(?:תחבורה ציבורית|רכב פרטי):?'
+    r'|(?<![א-ת])(?:דרכי הגעה|הגעה בתחבורה ציבורית|הסדרי חניה|רגלית|רכבת|אוטובוס|מוניות|רכבים פרטיים|ברכב'
+    r'|לידיעה)\s*:|(?<!ב)תחבורה ציבורית\s*:)'
+)
+GLUED_LINE_RE = re.compile(
+    r'(?<=[^\s\d][.])(?=[^\s\d."\'])|(?<=\d[.])(?=[א-ת])|(?<=\S)(?=למגיעים)'
+    r'|(?<=[םןץףך])(?=[א-ת])|(?<=\d)(?=[א-ת]{2})'
+)
+SEPARATOR_RE = re.compile(r'^[\s_\-=*]*$')
+
+# A short line matching one of these is a heading; it starts a section, or ends the
+# current one for headings without a section of their own (walking, general notes)
+MAX_HEADING_CHARS = 40
+SECTION_HEADINGS = [
+    ('parking', re.compile(r'הסדרי חני|^חני(?:ה|יה)\b')),
+    ('transport', re.compile(r'תחבורה ציבורית|^(?:רכבת|אוטובוס|מוניות)\b')),
+    ('car', re.compile(r'רכב פרטי|רכבים פרטיים|כניסת רכבים|^ברכב\b')),
+    (None, re.compile(r'רגלית|^דרכי הגעה:?$|^לידיעה')),
+]
+HEADED_SECTIONS = {section for section, _ in SECTION_HEADINGS if section}
+# Topics found by keyword: a line under a heading belongs to that section alone, so
+# "turn right into the car park" stays in the driving directions. Only lines no
+# heading has claimed, or topics that never get a heading of their own, are matched.
+SECTION_KEYWORDS = {
+    'parking': re.compile(r'חני(?:ה|יה|ון)|להחנות'),
+    'accessibility': re.compile(r'נגיש|נכים|נכה|כיסא גלגלים|כסא גלגלים'),
+}
+
+# A fresh random token rather than a counter, so a full rebuild never hands out a
+# version some session already holds for different data
+NEW_VERSION_SQL = "lower(hex(randomblob(8)))"
+
+# Pre-aggregated appointment counts for staff analytics, so aggregate questions read a
+# few hundred rows instead of scanning appointments. Each rollup maps its key columns
+# to expressions over an appointment row ({row} is NEW/OLD in the triggers and
+# appointments in the backfill) and counts only the rows its condition accepts.
+# Keys start with the (UTC) day, so a date range is a seek into the primary key;
+# site_id 0 and '' stand for a missing site or value.
+ROLLUP_DAY_SQL = "date({row}.appointment_epoch, 'unixepoch')"
+ROLLUPS = {
+    'rollup_site_day_status': ({
+        'day': ROLLUP_DAY_SQL,
+        'site_id': "IFNULL({row}.site_id, 0)",
+        'appointment_status': "IFNULL({row}.appointment_status, '')",
+    }, "{row}.appointment_epoch IS NOT NULL"),
+    'rollup_cancel_reasons': ({
+        'day': ROLLUP_DAY_SQL,
+        'site_id': "IFNULL({row}.site_id, 0)",
+        'cancel_reason_code': "{row}.cancel_reason_code",
+    }, "{row}.appointment_epoch IS NOT NULL AND {row}.cancel_reason_code IS NOT NULL"),
+    # appointment_type often ends with the date of the visit ('עש מותני-CT 21/12/2022'),
+    # which is stripped so the same kind of visit is counted together
+    'rollup_type_load': ({
+        'day': ROLLUP_DAY_SQL,
+        'site_id': "IFNULL({row}.site_id, 0)",
+        'record_type': "IFNULL({row}.record_type, '')",
+        'appointment_type': "IFNULL(rtrim({row}.appointment_type, ' 0123456789/.-'), '')",
+    }, "{row}.appointment_epoch IS NOT NULL"),
+}
+
+HEBREW_NAMES = ["יוסי", "דוד", "משה", "אברהם", "יצחק", "יעקב", "שלמה", "אהרון", "שמואל", "אליהו"]
+
+
+def create_schema(cursor):
+    # Create the sites table
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS sites (
+        site_id INTEGER PRIMARY KEY,
+        site_name TEXT UNIQUE NOT NULL,
+        site_address TEXT,
+        instructions TEXT,
+        {" ".join(f"{section} TEXT," for section in SITE_SECTIONS)}
+        content_hash TEXT
+    )
+    ''')
 
     # Create the appointments table
     cursor.execute('''
@@ -31,40 +144,270 @@ def setup_database():
         appointment_status TEXT,
         cancel_reason_code TEXT,
         record_type TEXT,
-        site_name TEXT,
-        site_address TEXT,
-        site_instructions TEXT
+        site_id INTEGER REFERENCES sites (site_id),
+        appointment_epoch INTEGER,
+        appointment_ts TEXT,
+        content_hash TEXT
     )
     ''')
 
+    # Databases built before the derived columns existed get them added in place
+    existing = {row[1] for row in cursor.execute("PRAGMA table_info(appointments)")}
+    for column, column_type in zip(['site_id'] + DERIVED_COLUMNS, ('INTEGER', 'INTEGER', 'TEXT', 'TEXT')):
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE appointments ADD COLUMN {column} {column_type}")
+    if 'site_instructions' in existing:
+        migrate_site_columns(cursor)
+
+    # Lookups are always by patient, usually ordered by date: (user_id, epoch) turns
+    # "next/last/in range" into one index seek plus a short ordered walk
+    cursor.execute("DROP INDEX IF EXISTS idx_appointments_user_date")
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_appointments_user_epoch
+    ON appointments (user_id, appointment_epoch)
+    ''')
+
     # Create the accounts table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS accounts (
         user_id TEXT PRIMARY KEY,
         user_name TEXT,
-        age INTEGER
+        age INTEGER,
+        data_version TEXT
     )
     ''')
+    if 'data_version' not in {row[1] for row in cursor.execute("PRAGMA table_info(accounts)")}:
+        cursor.execute("ALTER TABLE accounts ADD COLUMN data_version TEXT")
+        cursor.execute(f"UPDATE accounts SET data_version={NEW_VERSION_SQL}")
+
+    # Any write to a patient's appointments gives them a new data_version, so a chat
+    # session can tell with one primary-key read whether its copy of the data is stale
+    for event, user_ids in [('INSERT', 'NEW.user_id'), ('UPDATE', 'OLD.user_id, NEW.user_id'),
+                            ('DELETE', 'OLD.user_id')]:
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS appointments_{event.lower()}_version AFTER {event} ON appointments
+        BEGIN
+            UPDATE accounts SET data_version={NEW_VERSION_SQL} WHERE user_id IN ({user_ids});
+        END
+        ''')
+
+
+def _rollup_values(keys, row):
+    """The key expressions of a rollup for one appointment row (NEW, OLD or appointments)"""
+    return ", ".join(expression.format(row=row) for expression in keys.values())
+
+
+def create_rollups(cursor):
+    """Create the rollup tables and the triggers that keep them current; a missing table is filled from appointments"""
+    existing = {name for name, in cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    for table, (keys, condition) in ROLLUPS.items():
+        columns = ", ".join(keys)
+        cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            {" ".join(f"{key} {'INTEGER' if key == 'site_id' else 'TEXT'} NOT NULL," for key in keys)}
+            appointments INTEGER NOT NULL,
+            PRIMARY KEY ({columns})
+        ) WITHOUT ROWID
+        ''')
+        if table not in existing:
+            cursor.execute(f'''
+            INSERT INTO {table} ({columns}, appointments)
+            SELECT {_rollup_values(keys, 'appointments')}, COUNT(*) FROM appointments
+            WHERE {condition.format(row='appointments')}
+            GROUP BY {", ".join(str(position) for position in range(1, len(keys) + 1))}
+            ''')
+
+        # An update moves the row from its old bucket to its new one; empty buckets are removed
+        add = f'''
+            INSERT INTO {table} ({columns}, appointments)
+            SELECT {_rollup_values(keys, 'NEW')}, 1 WHERE {condition.format(row='NEW')}
+            ON CONFLICT ({columns}) DO UPDATE SET appointments = appointments + 1;
+        '''
+        remove = f'''
+            UPDATE {table} SET appointments = appointments - 1
+            WHERE ({columns}) = ({_rollup_values(keys, 'OLD')}) AND {condition.format(row='OLD')};
+            DELETE FROM {table} WHERE ({columns}) = ({_rollup_values(keys, 'OLD')}) AND appointments = 0;
+        '''
+        for event, body in [('INSERT', add), ('UPDATE', remove + add), ('DELETE', remove)]:
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()} AFTER {event} ON appointments
+            BEGIN {body} END
+            ''')
+
 
-    # Insert data into the appointments table
-    for _, row in df.iterrows():
-        cursor.execute('''
-        INSERT OR REPLACE INTO appointments (row_id, user_id, appointment_type, appointment_date_time, appointment_status, cancel_reason_code, record_type, site_name, site_address, site_instructions)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (row['row_id'], row['user_id'], row['appoitment_type'], str(row['appointment_date_time_c']), row['appointment_status'], row['cancel_reason_code'], row['record_type'], row['site_name'], row['site_address'], row['site_instructions']))
-
-    # Insert unique user_ids and random names into the accounts table
-    hebrew_names = ["יוסי", "דוד", "משה", "אברהם", "יצחק", "יעקב", "שלמה", "אהרון", "שמואל", "אליהו"]
-    unique_user_ids = df['user_id'].unique()
-    for user_id in unique_user_ids:
-        cursor.execute('''
-        INSERT OR REPLACE INTO accounts (user_id, user_name, age)
-        VALUES (?, ?, ?)
-        ''', (user_id, random.choice(hebrew_names), random.randint(10, 90)))
+def clean_instructions(raw):
+    """Plain text from the HTML site instructions: entities decoded, one line per paragraph or list item"""
+    if not isinstance(raw, str):
+        return None
+    text = html.unescape(TAG_RE.sub('', LINE_BREAK_RE.sub('\n', raw)))
+    text = GLUED_HEADING_RE.sub('\n\\1\n', GLUED_LINE_RE.sub('\n', text))
+    lines = [' '.join(line.split()) for line in text.splitlines()]
+    return '\n'.join(line for line in lines if not SEPARATOR_RE.match(line)) or None
+
+
+def _heading(line):
+    """The section a heading line starts (None for headings without one), or False for a regular line"""
+    if len(line) > MAX_HEADING_CHARS:
+        return False
+    for section, pattern in SECTION_HEADINGS:
+        if pattern.search(line):
+            return section
+    return False
+
+
+def split_sections(text):
+    """The cleaned instructions split into SITE_SECTIONS - {section: text or None}"""
+    sections = {section: [] for section in SITE_SECTIONS}
+    current = None
+    for line in (text or '').splitlines():
+        # "כניסת רכבים - מרחוב ..." is a heading with its whole section on the same line
+        label, dash, _ = line.partition(' - ')
+        if dash and _heading(label) is not False:
+            owner = _heading(label)
+        else:
+            heading = _heading(line)
+            if heading is not False:
+                current = heading
+                continue
+            owner = current
+        if owner:
+            sections[owner].append(line)
+        for section, pattern in SECTION_KEYWORDS.items():
+            if section != owner and (not owner or section not in HEADED_SECTIONS) and pattern.search(line):
+                sections[section].append(line)
+    return {section: '\n'.join(lines) or None for section, lines in sections.items()}
+
+
+def upsert_sites(cursor, sites):
+    """Insert or update sites from {site_name: (address, raw instructions)} - returns {site_name: site_id}"""
+    site_ids = {}
+    for name, (address, raw) in sites.items():
+        instructions = clean_instructions(raw)
+        sections = split_sections(instructions)
+        content_hash = hashlib.sha1(f"{address}\x1f{raw}".encode()).hexdigest()
+        cursor.execute(SITE_UPSERT_SQL, (name, address, instructions, *(sections[s] for s in SITE_SECTIONS), content_hash))
+        site_ids[name], = cursor.execute("SELECT site_id FROM sites WHERE site_name=?", (name,)).fetchone()
+    return site_ids
+
+
+def migrate_site_columns(cursor):
+    """Move the site text of an older database from the appointment rows into the sites table"""
+    rows = cursor.execute('''
+    SELECT site_name, MAX(site_address), MAX(site_instructions) FROM appointments
+    WHERE site_name IS NOT NULL GROUP BY site_name
+    ''').fetchall()
+    upsert_sites(cursor, {name: (address, raw) for name, address, raw in rows})
+    cursor.execute("UPDATE appointments SET site_id=(SELECT site_id FROM sites WHERE sites.site_name=appointments.site_name)")
+    for column in LEGACY_SITE_COLUMNS:
+        cursor.execute(f"ALTER TABLE appointments DROP COLUMN {column}")
+
+
+def read_chunks(csv_path, chunksize):
+    """Stream the CSV in chunks, keeping only the columns we load (db.csv has thousands)"""
+    header = pd.read_csv(csv_path, nrows=0).columns
+    positions = {}
+    for position, name in enumerate(header):
+        column = SOURCE_COLUMNS.get(name.strip().lower())
+        if column and column not in positions:
+            positions[column] = position
+    names = {position: column for column, position in positions.items()}
+
+    for chunk in pd.read_csv(csv_path, usecols=list(names), dtype=str, chunksize=chunksize):
+        # usecols keeps file order, so columns line up with the sorted positions
+        chunk.columns = [names[position] for position in sorted(names)]
+        yield chunk.dropna(subset=['row_id'])
+
+
+def chunk_sites(chunk):
+    """The sites in a chunk - {site_name: (address, raw instructions)}, first non-empty value of each"""
+    first = chunk.groupby('site_name')[['site_address', 'site_instructions']].first()
+    first = first.astype(object).where(first.notna(), None)
+    return {name: (address, raw) for name, address, raw in first.itertuples(name=None)}
+
+
+def prepare_rows(chunk, site_ids):
+    """Turn a chunk into insert tuples with the site id, precomputed datetime columns and a content hash"""
+    # Text column keeps its historical format ('2020-01-16 07:00:00+00:00', or 'NaT')
+    timestamps = pd.to_datetime(chunk['appointment_date_time'], errors='coerce', utc=True)
+    chunk = chunk.astype(object).where(chunk.notna(), None)
+    chunk['appointment_date_time'] = timestamps.dt.strftime('%Y-%m-%d %H:%M:%S+00:00').fillna('NaT')
+    chunk['site_id'] = [site_ids.get(name) for name in chunk['site_name']]
+
+    rows = []
+    for values, ts in zip(chunk[APPOINTMENT_COLUMNS].itertuples(index=False, name=None), timestamps):
+        content_hash = hashlib.sha1('\x1f'.join('' if v is None else str(v) for v in values).encode()).hexdigest()
+        if pd.isna(ts):
+            rows.append(values + (None, None, content_hash))
+        else:
+            rows.append(values + (int(ts.timestamp()), ts.strftime('%Y-%m-%dT%H:%M:%SZ'), content_hash))
+    return rows
+
+
+def setup_database(csv_path='data/appointments_cleaned_for_bigquery.csv', db_path='app_database.db',
+                   incremental=False, chunksize=5000):
+    start = time.perf_counter()
+
+    # Create a connection to the SQLite database
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    # WAL lets the app's long-lived read-only connections keep reading while we write
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+
+    # A full rebuild starts from empty tables; incremental mode upserts into what is there
+    if not incremental:
+        cursor.execute("DROP TABLE IF EXISTS appointments")
+        cursor.execute("DROP TABLE IF EXISTS accounts")
+        cursor.execute("DROP TABLE IF EXISTS sites")
+        for table in ROLLUPS:
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    create_schema(cursor)
+    # An incremental load keeps the rollups current through their triggers; a full
+    # rebuild aggregates once after loading, which is far cheaper than per row
+    if incremental:
+        create_rollups(cursor)
+    conn.commit()
+
+    # Everything below runs in a single transaction
+    total = 0
+    changed = 0
+    user_ids = set()
+    site_ids = {}
+    for chunk in read_chunks(csv_path, chunksize):
+        # Each site is cleaned and written once per run, the first time a chunk mentions it
+        new_sites = {name: site for name, site in chunk_sites(chunk).items() if name not in site_ids}
+        site_ids.update(upsert_sites(cursor, new_sites))
+        rows = prepare_rows(chunk, site_ids)
+        cursor.executemany(UPSERT_SQL, rows)
+        # rowcount leaves out the writes the data_version triggers make to accounts
+        changed += cursor.rowcount
+        user_ids.update(row[1] for row in rows if row[1])
+        total += len(rows)
+
+    # New patients get a random name and age; existing accounts are left as they are
+    cursor.executemany(f'''
+    INSERT OR IGNORE INTO accounts (user_id, user_name, age, data_version)
+    VALUES (?, ?, ?, {NEW_VERSION_SQL})
+    ''', [(user_id, random.choice(HEBREW_NAMES), random.randint(10, 90)) for user_id in sorted(user_ids)])
+    if not incremental:
+        create_rollups(cursor)
 
     # Commit the changes and close the connection
     conn.commit()
     conn.close()
 
+    elapsed = time.perf_counter() - start
+    print(f"Ingested {total} rows from {csv_path} ({changed} inserted/updated) "
+          f"in {elapsed:.2f}s - {total / elapsed:,.0f} rows/sec")
+    return total, changed
+
+
 if __name__ == '__main__':
-    setup_database()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Load appointment CSV exports into the SQLite database.')
+    parser.add_argument('--source', default='data/appointments_cleaned_for_bigquery.csv', help='CSV export to load')
+    parser.add_argument('--db', default='app_database.db', help='SQLite database file')
+    parser.add_argument('--incremental', action='store_true', help='upsert changed rows instead of rebuilding')
+    parser.add_argument('--chunksize', type=int, default=5000)
+    args = parser.parse_args()
+    setup_database(args.source, args.db, incremental=args.incremental, chunksize=args.chunksize)
@@ -0,0 +1,284 @@
+"""מענה מהיר לשאלות נפוצות ישירות מה־DB, בלי סבב מול המודל.
+
+כל כוונה (intent) רשומה עם רשימת ביטויים בעברית ובאנגלית ו־handler שמחזיר
+טקסט תשובה. כל הביטויים מאוחדים לביטוי רגולרי אחד עם קבוצה בשם לכל כוונה,
+כך שהודעה נסרקת פעם אחת; הכוונה שהביטוי שלה מופיע ראשון בהודעה מנצחת.
+"""
+import re
+import threading
+from collections import Counter
+from datetime import UTC, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import db
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Dates are stored in UTC and shown to the patient in clinic time
+LOCAL_TZ = ZoneInfo('Asia/Jerusalem')
+
+STATUS_NAMES = {
+    'Canceled': 'בוטל',
+    'TookPlace': 'התקיים',
+    'RescheduleByAssuta': 'נקבע מחדש על ידי אסותא',
+    'NewAppointment': 'תור חדש',
+    'WaitingForAppointment': 'ממתין לתור',
+}
+
+# English spellings of site names, mapped to the Hebrew part of site_name
+SITE_ALIASES = {
+    'hashalom': 'השלום',
+    'beer sheva': 'באר שבע',
+    "be'er sheva": 'באר שבע',
+    'ashdod': 'אשדוד',
+    'haifa': 'חיפה',
+    'jerusalem': 'ירושלים',
+    'rishon': 'ראשל"צ',
+    'ramat hachayal': 'רמת החייל',
+    'raanana': 'רעננה',
+}
+
+# Which part of a site's instructions a directions question asks about; checked in
+# order, so "ברכבת" is public transport before it can look like "ברכב"
+DIRECTION_TOPICS = [
+    ('parking', re.compile(r'parking|park\b|חני(?:ה|יה|ון)|להחנות', re.IGNORECASE)),
+    ('accessibility', re.compile(r'accessib|wheelchair|disabled|נגיש|כיסא גלגלים|כסא גלגלים|נכים', re.IGNORECASE)),
+    ('transport', re.compile(r'\bbus|train|public transport|אוטובוס|רכבת|תחבורה ציבורית', re.IGNORECASE)),
+    ('car', re.compile(r'\bcar\b|\bdriv|ברכב|רכב פרטי|בנסיעה', re.IGNORECASE)),
+]
+
+
+class IntentRouter:
+    """נתב כוונות - רישום handlers, התאמה בסריקה אחת ומונה פגיעות"""
+
+    def __init__(self):
+        self._intents = {}
+        self._pattern = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hits = Counter()
+
+    def intent(self, name, patterns, unless=None):
+        """דקורטור לרישום handler(db_path, user_id, message) עבור כוונה.
+
+        unless - ביטוי רגולרי; הודעה שמתאימה לו לא נענית בכוונה הזו וממשיכה למודל.
+        handler שמחזיר None מעביר את ההודעה למודל גם הוא.
+        """
+        def register(handler):
+            self._intents[name] = (patterns, handler, unless and re.compile(unless, re.IGNORECASE))
+            self._pattern = None
+            return handler
+        return register
+
+    def _compiled(self):
+        if self._pattern is None:
+            self._pattern = re.compile('|'.join(
+                f"(?P<{name}>{'|'.join(patterns)})" for name, (patterns, _, _) in self._intents.items()
+            ), re.IGNORECASE)
+        return self._pattern
+
+    def match(self, message):
+        """שם הכוונה שמתאימה להודעה, או None"""
+        m = self._compiled().search(message)
+        if m is None:
+            return None
+        unless = self._intents[m.lastgroup][2]
+        return None if unless and unless.search(message) else m.lastgroup
+
+    def answer(self, message, db_path, user_id):
+        """מחזיר (כוונה, תשובה) אם יש התאמה, אחרת (None, None)"""
+        name = self.match(message)
+        text = None
+        if name is not None:
+            _, handler, _ = self._intents[name]
+            text = handler(db_path, user_id, message)
+        with self._lock:
+            self.requests += 1
+            if text is not None:
+                self.hits[name] += 1
+        if text is None:
+            return None, None
+        return name, text
+
+    def stats(self):
+        """כמה מהבקשות נענו במסלול המהיר, בסך הכל ולפי כוונה"""
+        with self._lock:
+            hits = sum(self.hits.values())
+            return {
+                'requests': self.requests,
+                'fast_path_hits': hits,
+                'fast_path_ratio': hits / self.requests if self.requests else 0.0,
+                'by_intent': dict(self.hits),
+            }
+
+
+router = IntentRouter()
+
+
+def _now():
+    return datetime.now(UTC)
+
+
+def _epoch(dt):
+    return int(dt.timestamp())
+
+
+def format_date(value):
+    """'2020-01-16 07:00:00+00:00' -> '16/01/2020 09:00' (שעון ישראל)"""
+    try:
+        when = datetime.strptime(value[:19], DATE_FORMAT).replace(tzinfo=UTC)
+        return when.astimezone(LOCAL_TZ).strftime('%d/%m/%Y %H:%M')
+    except (TypeError, ValueError):
+        return value
+
+
+def describe(appt):
+    """שורה אחת שמתארת תור"""
+    status = STATUS_NAMES.get(appt.get('appointment_status'), appt.get('appointment_status'))
+    parts = [appt.get('appointment_type'), format_date(appt.get('appointment_date_time'))]
+    if appt.get('site_name'):
+        parts.append(appt['site_name'])
+    text = " - ".join(str(part) for part in parts if part)
+    return f"{text} ({status})" if status else text
+
+
+def date_range(message):
+    """טווח תאריכים שמוזכר בהודעה: (התחלה, סוף, תיאור) או None"""
+    now = _now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    week_start = today - timedelta(days=(today.weekday() + 1) % 7)  # weeks start on Sunday
+    month_start = today.replace(day=1)
+    next_month = (month_start + timedelta(days=32)).replace(day=1)
+    if re.search(r'בשבוע הבא|next week', message, re.IGNORECASE):
+        return week_start + timedelta(days=7), week_start + timedelta(days=14), 'בשבוע הבא'
+    if re.search(r'השבוע|this week', message, re.IGNORECASE):
+        return week_start, week_start + timedelta(days=7), 'השבוע'
+    if re.search(r'בחודש הבא|next month', message, re.IGNORECASE):
+        return next_month, (next_month + timedelta(days=32)).replace(day=1), 'בחודש הבא'
+    if re.search(r'החודש|this month', message, re.IGNORECASE):
+        return month_start, next_month, 'החודש'
+    if re.search(r'עתידי|הקרובים|upcoming|future', message, re.IGNORECASE):
+        return now, now.replace(year=now.year + 100), 'בעתיד'
+    return None
+
+
+# Questions about results, documents or payments mention places and statuses too,
+# but the answer is never an address or an appointment's status
+NOT_ABOUT_APPOINTMENTS = (
+    r'תוצא|מסמכ|טופס|טפסים|משלוח|לשלוח|תשלום|לשלם|חשבונית|מרשם'
+    r'|result|document|\bforms?\b|\bmail|\bsend|\bpay|invoice|receipt|prescription'
+)
+# Words a place question names the place with - "איפה" alone could be about anything
+PLACE_WORDS = r'(?:ה?תור|ה?בדיק(?:ה|ת)|ה?מכון|בית החולים|ה?סניף|ה?מרפאה|אסותא|ה?חני(?:ה|יה|ון))'
+ENGLISH_PLACE_WORDS = r'(?:appointment|test|exam|clinic|hospital|institute|branch|site|assuta|parking)'
+# "התור שלי לרופא עיניים", "appointment for an MRI": the handlers can't filter by
+# type, so a question naming one goes to the model
+APPOINTMENT_QUALIFIER_RE = re.compile(
+    r'(?:תור|בדיק(?:ה|ת)|appointment|test)\S*(?:\s+(?:הבא|הקרוב|שלי|next|my))*'
+    r'\s+(?:(?:ל|אצל |עם )(?!י\b|ך\b)[א-ת]|(?:for|with) )',
+    re.IGNORECASE,
+)
+
+
+@router.intent('site_directions', [
+    r'how (?:do i |can i |to )?get to', r'directions', rf'where is (?:my |the )?(?:\w+ )?{ENGLISH_PLACE_WORDS}',
+    rf'address of (?:my |the )?(?:\w+ )?{ENGLISH_PLACE_WORDS}', r'parking', r'wheelchair access',
+    r'איך (?:מגיעים|להגיע|אגיע|מגיע)', r'(?:הנחיות|דרכי) הגעה', rf'איפה (?:נמצא(?:ת|ים)? |יש )?{PLACE_WORDS}',
+    rf'כתובת (?:של )?{PLACE_WORDS}', r'חני(?:ה|ון)', r'נגישות',
+], unless=NOT_ABOUT_APPOINTMENTS)
+def site_directions(db_path, user_id, message):
+    sites = db.user_sites(db_path, user_id)
+    if not sites:
+        return "לא מצאתי אתר שבו יש לך תורים."
+    lowered = message.lower()
+    wanted = [hebrew for alias, hebrew in SITE_ALIASES.items() if alias in lowered]
+    site = next((s for s in sites if any(w in s['site_name'] for w in wanted)), None)
+    if site is None:
+        site = next((s for s in sites if s['site_name'].replace('אסותא', '').strip() in message), None)
+    if site is None:
+        upcoming = db.next_appointment(db_path, user_id, _epoch(_now()))
+        name = upcoming['site_name'] if upcoming else sites[0]['site_name']
+        site = next(s for s in sites if s['site_name'] == name)
+
+    # The instructions are read only now, and only the part the question is about
+    lines = [f"{site['site_name']}: {site['site_address']}"]
+    details = db.site_instructions(db_path, site['site_id']) or {}
+    topic = next((name for name, pattern in DIRECTION_TOPICS if pattern.search(message)), None)
+    text = details.get(topic) or details.get('instructions')
+    if text:
+        lines.append(text)
+    return "\n".join(lines)
+
+
+CANCELLATION_RE = re.compile(r'בוטל|cancel', re.IGNORECASE)
+
+
+@router.intent('appointment_status', [
+    r'status of (?:my |the )?(?:appointment|test|exam)', r'appointment status',
+    r'was (?:my |the )?(?:appointment|test) cancel+ed', r'why was .{0,40}cancel+ed',
+    r'סטטוס (?:של )?(?:ה)?(?:תור|בדיקה)', r'מצב (?:ה)?(?:תור|בדיקה)',
+    r'האם (?:התור |הבדיקה )?(?:בוטל|בוטלה|התקיים|התקיימה)', r'למה (?:התור |הבדיקה )?(?:בוטל|בוטלה)',
+], unless=NOT_ABOUT_APPOINTMENTS)
+def appointment_status(db_path, user_id, message):
+    if APPOINTMENT_QUALIFIER_RE.search(message):
+        return None
+    if CANCELLATION_RE.search(message):
+        # "Why was it canceled" is about the last cancellation, not the next appointment
+        appt = db.latest_appointment_with_status(db_path, user_id, 'Canceled')
+        if appt is None:
+            return "לא מצאתי תורים שבוטלו."
+        text = f"התור האחרון שבוטל: {appt['appointment_type']} ב־{format_date(appt['appointment_date_time'])}."
+        if appt.get('cancel_reason_code'):
+            text += f" קוד סיבת הביטול: {appt['cancel_reason_code']}."
+        return text
+
+    appt = db.next_appointment(db_path, user_id, _epoch(_now()))
+    if appt is None:
+        past = db.past_appointments(db_path, user_id, _epoch(_now()), limit=1)
+        appt = past[0] if past else None
+    if appt is None:
+        return "לא מצאתי תורים."
+    text = f"סטטוס התור {appt['appointment_type']} ב־{format_date(appt['appointment_date_time'])}: " \
+        f"{STATUS_NAMES.get(appt['appointment_status'], appt['appointment_status'])}."
+    if appt.get('cancel_reason_code') and appt['appointment_status'] == 'Canceled':
+        text += f" קוד סיבת הביטול: {appt['cancel_reason_code']}."
+    return text
+
+
+# Asking to cancel, move or prepare for the next appointment needs an action or an
+# explanation, not the appointment's details again
+NEXT_APPOINTMENT_ACTIONS = (
+    r'לבטל|ביטול|להזיז|לשנות|לדחות|להקדים|להביא|לצום|צום|להתכונן|הכנה'
+    r'|cancel|change|reschedul|move|postpone|bring|\bfast|prepar|' + NOT_ABOUT_APPOINTMENTS
+)
+
+
+@router.intent('next_appointment', [
+    r'next appointment', r'upcoming appointment', r'תור (?:ה)?(?:קרוב|הבא)', r'מתי התור',
+], unless=NEXT_APPOINTMENT_ACTIONS)
+def next_appointment(db_path, user_id, message):
+    if APPOINTMENT_QUALIFIER_RE.search(message):
+        return None
+    appt = db.next_appointment(db_path, user_id, _epoch(_now()))
+    if appt:
+        return f"התור הבא שלך הוא ב־{format_date(appt['appointment_date_time'])} מסוג {appt['appointment_type']}."
+    return "לא מצאתי תורים עתידיים."
+
+
+@router.intent('list_appointments', [
+    r'(?:list|show|all) (?:of )?my appointments', r'my appointments', r'appointments (?:this|next) (?:week|month)',
+    r'(?:אילו|איזה|כל ה|רשימת ה?)\s*תורים', r'התורים שלי', r'תורים (?:ב)?(?:השבוע|החודש|בשבוע הבא|בחודש הבא)',
+])
+def list_appointments(db_path, user_id, message):
+    window = date_range(message)
+    if window:
+        start, end, label = window
+        appointments = db.appointments_between(db_path, user_id, _epoch(start), _epoch(end))
+        if not appointments:
+            return f"לא מצאתי תורים {label}."
+        header = f"מצאתי {len(appointments)} תורים {label}:"
+    else:
+        appointments = db.recent_appointments(db_path, user_id)
+        if not appointments:
+            return "לא מצאתי תורים."
+        header = f"מצאתי {len(appointments)} תורים אחרונים:"
+    return "\n".join([header] + [f"{i}. {describe(appt)}" for i, appt in enumerate(appointments, 1)])
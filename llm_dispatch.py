@@ -0,0 +1,363 @@
+"""שכבת התזמון של הקריאות ל־Gemini.
+
+Dispatcher מגביל את מספר הקריאות שרצות במקביל ואת קצב הקריאות לדקה, מנסה
+שוב שגיאות חולפות (429, 5xx, timeout) עם backoff אקראי בתוך deadline אחד
+לכל הקריאה, ויכול לשלוח עותק נוסף (hedge) של קריאה שמתעכבת ולהחזיר את
+התשובה הראשונה. כשאין מקום בתוך queue_timeout, או שהניסיונות נגמרו, נזרקת
+Unavailable והאפליקציה עונה בהודעת "נסו שוב" במקום שגיאת 500.
+
+כל ניסיון הוא פונקציה attempt(timeout) שבונה את הקריאה מחדש (ChatSession
+חדש מההיסטוריה השמורה), כך שניסיון חוזר או hedge לא נוגעים בהיסטוריה של
+ניסיון אחר. timeout הוא הזמן שנשאר עד ה־deadline, להעברה ל־request_options.
+
+SessionLocks מבטיח תור אחד בכל פעם לכל session_id, כדי ששתי בקשות על אותה
+שיחה לא ידרסו זו את ההיסטוריה של זו. המגבלות הן לכל תהליך, ומשותפות לקוראים
+סינכרוניים (threads) ואסינכרוניים: coroutine שממתין למקום נרדם על future
+ומתעורר כשמקום משתחרר, בלי polling.
+"""
+import asyncio
+import contextlib
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import metrics
+
+TRY_AGAIN_REPLY = "יש כרגע עומס על המערכת ולא הצלחתי לענות. אנא נסו שוב בעוד כמה רגעים."
+
+# HTTP statuses google.api_core errors carry in .code that are worth another attempt
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+
+RETRIES = metrics.registry.counter('chatbot_llm_retries_total', 'Model calls retried after a transient error')
+HEDGES = metrics.registry.counter('chatbot_llm_hedges_total', 'Hedged duplicate model calls by result', ['result'])
+SHED = metrics.registry.counter('chatbot_llm_shed_total', 'Model calls given up on, by reason', ['reason'])
+
+
+class Unavailable(Exception):
+    """המודל לא זמין כרגע - הניסיונות או ה־deadline נגמרו"""
+
+
+class Overloaded(Unavailable):
+    """אין מקום פנוי (מקביליות, קצב או השיחה עסוקה) בתוך זמן ההמתנה"""
+
+
+class _Waiters:
+    """coroutines שממתינים ל־semaphore או lock של threading - מתעוררים אחד אחד כשמשהו משתחרר"""
+
+    def __init__(self):
+        self._queue = deque()  # (loop, future)
+        self._lock = threading.Lock()
+
+    def _discard(self, waiter):
+        with self._lock, contextlib.suppress(ValueError):
+            self._queue.remove(waiter)
+
+    def wake_one(self):
+        """לקרוא אחרי כל שחרור, מכל thread"""
+        with self._lock:
+            if not self._queue:
+                return
+            loop, future = self._queue.popleft()
+        loop.call_soon_threadsafe(self._wake, future)
+
+    def _wake(self, future):
+        if future.done():
+            # Its waiter gave up meanwhile; the freed place goes to the next one
+            self.wake_one()
+        else:
+            future.set_result(None)
+
+    async def wait(self, try_acquire, timeout):
+        """try_acquire() עד שמצליח או שעבר timeout - True אם הצליח"""
+        give_up = time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        while True:
+            # Queued before trying, so a release between the try and the wait still wakes us
+            waiter = (loop, loop.create_future())
+            with self._lock:
+                self._queue.append(waiter)
+            leaving = False
+            try:
+                if try_acquire():
+                    return True
+                leaving = True
+                remaining = give_up - time.monotonic()
+                if remaining <= 0:
+                    return False
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(waiter[1], remaining)
+                leaving = False
+            finally:
+                self._discard(waiter)
+                if leaving and waiter[1].done() and not waiter[1].cancelled():
+                    # Woken but leaving anyway (cancelled): the freed place goes to the next one
+                    self.wake_one()
+
+
+def model_errors():
+    """השגיאות שקריאה למודל זורקת כשמשהו בדרך נכשל - שגיאות ה־API, timeout וחיבור"""
+    # Imported only once a call has failed: by then the SDK is loaded anyway
+    from google.api_core.exceptions import GoogleAPICallError
+    return (GoogleAPICallError, TimeoutError, ConnectionError)
+
+
+def is_retryable(error):
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):
+        return code in RETRYABLE_CODES
+    return isinstance(error, (TimeoutError, ConnectionError))
+
+
+class Dispatcher:
+    """מגביל מקביליות וקצב, עם ניסיונות חוזרים ו־hedging.
+
+    max_concurrency - קריאות במקביל; rpm - קריאות לדקה (0 ללא הגבלה);
+    queue_timeout - המתנה מקסימלית למקום; deadline - זמן כולל לקריאה כולל
+    ניסיונות חוזרים; hedge_after - אחרי כמה שניות לשלוח עותק נוסף (0 כבוי).
+    """
+
+    def __init__(self, max_concurrency=16, rpm=0, queue_timeout=5.0, deadline=30.0,
+                 max_retries=2, backoff_base=0.5, backoff_max=4.0, hedge_after=0.0):
+        self.max_concurrency = max_concurrency
+        self.rpm = rpm
+        self.queue_timeout = queue_timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._waiters = _Waiters()
+        self._lock = threading.Lock()
+        self._tokens = float(rpm)
+        self._refilled_at = time.monotonic()
+        self.in_flight = 0
+        self._pool = None
+
+    def _take_token(self):
+        """0 אם נלקח אישור קצב, אחרת כמה שניות לחכות עד שיתפנה"""
+        if not self.rpm:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rpm, self._tokens + (now - self._refilled_at) * self.rpm / 60)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) * 60 / self.rpm
+
+    def _try_admit(self):
+        if not self._slots.acquire(blocking=False):
+            return False
+        if self._take_token():
+            self._release_slot()
+            return False
+        with self._lock:
+            self.in_flight += 1
+        return True
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._release_slot()
+
+    def _admit(self, deadline):
+        give_up = min(time.monotonic() + self.queue_timeout, deadline)
+        if not self._slots.acquire(timeout=max(0.0, give_up - time.monotonic())):
+            SHED.inc(reason='concurrency')
+            raise Overloaded('no free model slot')
+        while True:
+            wait_for = self._take_token()
+            if not wait_for:
+                break
+            if time.monotonic() + wait_for > give_up:
+                self._release_slot()
+                SHED.inc(reason='rate')
+                raise Overloaded('model rate limit reached')
+            time.sleep(wait_for)
+        with self._lock:
+            self.in_flight += 1
+
+    async def _admit_async(self, deadline):
+        give_up = min(time.monotonic() + self.queue_timeout, deadline)
+        if not await self._waiters.wait(lambda: self._slots.acquire(blocking=False), give_up - time.monotonic()):
+            SHED.inc(reason='concurrency')
+            raise Overloaded('no free model slot')
+        while True:
+            wait_for = self._take_token()
+            if not wait_for:
+                break
+            if time.monotonic() + wait_for > give_up:
+                self._release_slot()
+                SHED.inc(reason='rate')
+                raise Overloaded('model rate limit reached')
+            await asyncio.sleep(wait_for)
+        with self._lock:
+            self.in_flight += 1
+
+    def _release_slot(self):
+        self._slots.release()
+        self._waiters.wake_one()
+
+    def _backoff(self, attempt):
+        # Full jitter keeps a burst of failed calls from retrying in lockstep
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _retry_delay(self, error, attempt, deadline):
+        """זמן ההמתנה לפני ניסיון נוסף; זורק אם אין טעם לנסות שוב"""
+        if isinstance(error, Unavailable) or not is_retryable(error):
+            raise error
+        delay = self._backoff(attempt)
+        if attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+            SHED.inc(reason='retries')
+            raise Unavailable(f'model call failed: {type(error).__name__}') from error
+        RETRIES.inc()
+        return delay
+
+    def call(self, attempt, hedge=True, deadline=None):
+        """הרצת attempt(timeout) עם כל המגבלות - מחזיר את התוצאה הראשונה שהצליחה"""
+        deadline = time.monotonic() + (deadline or self.deadline)
+        for n in range(self.max_retries + 1):
+            try:
+                return self._call_once(attempt, hedge and self.hedge_after > 0, deadline)
+            except model_errors() as e:
+                time.sleep(self._retry_delay(e, n, deadline))
+
+    async def call_async(self, attempt, hedge=True, deadline=None):
+        """כמו call, עבור attempt אסינכרוני"""
+        deadline = time.monotonic() + (deadline or self.deadline)
+        for n in range(self.max_retries + 1):
+            try:
+                return await self._call_once_async(attempt, hedge and self.hedge_after > 0, deadline)
+            except model_errors() as e:
+                await asyncio.sleep(self._retry_delay(e, n, deadline))
+
+    def _run(self, attempt, deadline):
+        try:
+            return attempt(max(0.0, deadline - time.monotonic()))
+        finally:
+            self._release()
+
+    def _call_once(self, attempt, hedge, deadline):
+        self._admit(deadline)
+        if not hedge:
+            return self._run(attempt, deadline)
+
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='llm')
+        futures = {self._pool.submit(self._run, attempt, deadline)}
+        done, _ = wait(futures, timeout=min(self.hedge_after, max(0.0, deadline - time.monotonic())))
+        if not done and self._try_admit():
+            futures.add(self._pool.submit(self._run, attempt, deadline))
+        hedged = len(futures) > 1
+
+        error = None
+        while futures:
+            done, futures = wait(futures, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                # The calls keep running in the pool and release their slots when they return
+                raise TimeoutError('model call deadline exceeded')
+            for future in done:
+                if future.exception() is None:
+                    if hedged:
+                        HEDGES.inc(result='used' if futures else 'last')
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _run_async(self, attempt, deadline):
+        try:
+            return await attempt(max(0.0, deadline - time.monotonic()))
+        finally:
+            self._release()
+
+    async def _call_once_async(self, attempt, hedge, deadline):
+        await self._admit_async(deadline)
+        task = asyncio.ensure_future(self._run_async(attempt, deadline))
+        if not hedge:
+            try:
+                return await asyncio.wait_for(task, timeout=max(0.0, deadline - time.monotonic()))
+            except TimeoutError:
+                raise TimeoutError('model call deadline exceeded') from None
+
+        tasks = {task}
+        done, _ = await asyncio.wait(tasks, timeout=min(self.hedge_after, max(0.0, deadline - time.monotonic())))
+        if not done and self._try_admit():
+            tasks.add(asyncio.ensure_future(self._run_async(attempt, deadline)))
+        hedged = len(tasks) > 1
+
+        error = None
+        try:
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic()),
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise TimeoutError('model call deadline exceeded')
+                for finished in done:
+                    if finished.exception() is None:
+                        if hedged:
+                            HEDGES.inc(result='used' if tasks else 'last')
+                        return finished.result()
+                    error = finished.exception()
+            raise error
+        finally:
+            for pending in tasks:
+                pending.cancel()
+
+    def stats(self):
+        return {'in_flight': self.in_flight, 'max_concurrency': self.max_concurrency, 'rpm': self.rpm}
+
+
+class SessionLocks:
+    """נעילה לכל session_id - תור אחד בכל פעם לכל שיחה"""
+
+    def __init__(self):
+        self._locks = {}  # session_id -> [lock, holders and waiters, waiting coroutines]
+        self._guard = threading.Lock()
+
+    def _enter(self, session_id):
+        with self._guard:
+            entry = self._locks.setdefault(session_id, [threading.Lock(), 0, _Waiters()])
+            entry[1] += 1
+            return entry
+
+    def _leave(self, session_id, entry):
+        with self._guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[session_id]
+
+    def acquire(self, session_id, timeout):
+        """המתנה לתור הקודם באותה שיחה - Overloaded אם לא הסתיים בתוך timeout"""
+        entry = self._enter(session_id)
+        if not entry[0].acquire(timeout=timeout):
+            self._leave(session_id, entry)
+            SHED.inc(reason='session_busy')
+            raise Overloaded('session is busy')
+
+    async def acquire_async(self, session_id, timeout):
+        entry = self._enter(session_id)
+        if not await entry[2].wait(lambda: entry[0].acquire(blocking=False), timeout):
+            self._leave(session_id, entry)
+            SHED.inc(reason='session_busy')
+            raise Overloaded('session is busy')
+
+    def release(self, session_id):
+        with self._guard:
+            entry = self._locks[session_id]
+        entry[0].release()
+        entry[2].wake_one()
+        self._leave(session_id, entry)
+
+    @contextlib.contextmanager
+    def hold(self, session_id, timeout):
+        self.acquire(session_id, timeout)
+        try:
+            yield
+        finally:
+            self.release(session_id)
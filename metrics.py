@@ -0,0 +1,228 @@
+"""מדדים בזיכרון התהליך, בפורמט הטקסט של Prometheus.
+
+מונים, מדדים (gauges) והיסטוגרמות, ו־span לתזמון שלבים בטיפול בבקשה. כל
+span נרשם בהיסטוגרמה של השלבים וגם במעקב של הבקשה הנוכחית (ContextVar, כך
+שהוא עובר גם ל־asyncio.to_thread); בסוף בקשה איטית מ־SLOW_REQUEST_SECONDS
+נרשמת שורת לוג עם הזמנים לפי שלב, לדגימה של SLOW_REQUEST_SAMPLE מהבקשות.
+הלוג והמדדים לא כוללים טקסט של הודעות או מזהי מטופלים.
+
+המדדים הם לכל תהליך - עם כמה workers כל אחד מחזיק ומציג את שלו.
+"""
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import random
+import threading
+import time
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', '2.0'))
+SLOW_REQUEST_SAMPLE = float(os.environ.get('SLOW_REQUEST_SAMPLE', '1.0'))
+
+logger = logging.getLogger(__name__)
+
+_trace = contextvars.ContextVar('metrics_trace', default=None)
+
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(f"expected labels {labelnames}, got {tuple(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs)
+    return '{' + body + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.type = 'counter'
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge:
+    """מדד שערכו נקרא בזמן ה־scrape מפונקציה"""
+
+    def __init__(self, name, help, read):
+        self.name, self.help, self.read = name, help, read
+        self.type = 'gauge'
+
+    def samples(self):
+        yield f"{self.name} {_format_value(self.read())}"
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.type = 'histogram'
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # key -> [count per bucket..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def count(self, **labels):
+        counts = self._values.get(_label_key(self.labelnames, labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, list(counts)) for key, counts in self._values.items())
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _format_value(bound)
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(counts[-1])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, read):
+        return self._add(Gauge(name, help, read))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        """כל המדדים בפורמט הטקסט של Prometheus"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram('chatbot_request_seconds', 'Time to produce a response, by endpoint', ['endpoint'])
+STAGE_SECONDS = registry.histogram('chatbot_stage_seconds', 'Time spent in each request stage', ['stage'])
+REQUESTS = registry.counter('chatbot_requests_total', 'Requests by endpoint and status code', ['endpoint', 'status'])
+SESSIONS = registry.counter('chatbot_sessions_total', 'Chat sessions opened')
+LOGINS = registry.counter('chatbot_logins_total', 'Login attempts by result', ['result'])
+ANSWERS = registry.counter('chatbot_answers_total', 'Chat answers by source (intent, cache, sql, analytics, model)', ['source'])
+ERRORS = registry.counter('chatbot_errors_total', 'Errors by kind', ['kind'])
+DATA_UPDATES = registry.counter('chatbot_user_data_updates_total',
+                                'Patient data changes picked up mid-session and sent to the model as a delta')
+PROMPT_TOKENS = registry.histogram('chatbot_prompt_tokens', 'Prompt tokens per model call', buckets=TOKEN_BUCKETS)
+RESPONSE_TOKENS = registry.histogram('chatbot_response_tokens', 'Response tokens per model call', buckets=TOKEN_BUCKETS)
+
+
+class Trace:
+    """זמני השלבים של בקשה אחת"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+def begin_request(endpoint):
+    """פתיחת מעקב לבקשה הנוכחית"""
+    trace = Trace(endpoint)
+    _trace.set(trace)
+    return trace
+
+
+def end_request(trace, status):
+    """רישום זמן הבקשה, ושורת לוג מדוגמת אם היא איטית"""
+    elapsed = time.perf_counter() - trace.start
+    REQUEST_SECONDS.observe(elapsed, endpoint=trace.endpoint)
+    REQUESTS.inc(endpoint=trace.endpoint, status=status)
+    if elapsed >= SLOW_REQUEST_SECONDS and random.random() < SLOW_REQUEST_SAMPLE:
+        stages = " ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in trace.stages.items())
+        logger.warning("slow request endpoint=%s status=%s total=%.1fms %s",
+                       trace.endpoint, status, elapsed * 1000, stages)
+    return elapsed
+
+
+@contextlib.contextmanager
+def span(stage):
+    """תזמון שלב - נרשם בהיסטוגרמה ובמעקב של הבקשה הנוכחית"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        trace = _trace.get()
+        if trace is not None:
+            trace.add(stage, elapsed)
+
+
+def timed(stage):
+    """דקורטור שמריץ את הפונקציה בתוך span"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def observe_usage(usage):
+    """ספירת הטוקנים מ־usage_metadata של Gemini, אם יש"""
+    prompt = getattr(usage, 'prompt_token_count', None)
+    response = getattr(usage, 'candidates_token_count', None)
+    if prompt is not None:
+        PROMPT_TOKENS.observe(prompt)
+    if response is not None:
+        RESPONSE_TOKENS.observe(response)
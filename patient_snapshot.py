@@ -0,0 +1,50 @@
+"""צילום של נתוני המטופל לכל שיחה, עם זיהוי שינויים זול.
+
+בכניסה נשמר בשיחה צילום של התורים בקידוד הדחוס של context_builder, יחד עם
+accounts.data_version - גרסה שמתחלפת בכל כתיבה לתורים של המטופל. בכל תור
+בשיחה נבדקת רק הגרסה (קריאה אחת לפי מפתח ראשי); הנתונים נשלפים מחדש רק
+כשהיא השתנתה, ולהקשר של המודל נוסף רק ההפרש מהצילום הקודם.
+"""
+from context_builder import encode_appointment, encode_site, encode_update
+
+UPDATE_REPLY = "הבנתי."
+
+
+def take(user_data):
+    """צילום מנתוני המטופל - גרסה, תורים מקודדים לפי row_id ואתרים"""
+    appointments = {}
+    sites = {}
+    for row in user_data:
+        appointment = appointments[row['row_id']] = encode_appointment(row)
+        if 'site' in appointment:
+            sites.setdefault(appointment['site'], encode_site(row))
+    return {
+        'version': user_data[0].get('data_version') if user_data else None,
+        'appointments': appointments,
+        'sites': sites,
+    }
+
+
+def diff(old, new):
+    """ההפרש בין שני צילומים - רק המפתחות שיש בהם שינוי; {} אם הנתונים זהים"""
+    before, after = old['appointments'], new['appointments']
+    delta = {
+        'added': [after[row_id] for row_id in after if row_id not in before],
+        'changed': [
+            {'before': before[row_id], 'after': after[row_id]}
+            for row_id in after if row_id in before and before[row_id] != after[row_id]
+        ],
+        'removed': [before[row_id] for row_id in before if row_id not in after],
+    }
+    # Sites the model hasn't seen yet, for appointments at a new location
+    used = {appt.get('site') for appt in delta['added']} | {change['after'].get('site') for change in delta['changed']}
+    delta['sites'] = {site: new['sites'][site] for site in sorted(used - old['sites'].keys() - {None})}
+    return {key: value for key, value in delta.items() if value}
+
+
+def update_records(delta):
+    """זוג תורות להיסטוריה שמביא את ההפרש להקשר של המודל"""
+    return [
+        {'role': 'user', 'text': encode_update(delta), 'update': True},
+        {'role': 'model', 'text': UPDATE_REPLY, 'update': True},
+    ]
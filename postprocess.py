@@ -0,0 +1,154 @@
+"""עיבוד תשובות המודל לפני שהן נשלחות למטופל.
+
+ניקוי (הסרת ברכה עם שם המטופל ושאלות המשך שהמודל הוסיף בעצמו), עיצוב
+רשימות ל־HTML ובחירת שאלת המשך. הביטויים ורשימות מילות המפתח נבנים פעם אחת
+בטעינת המודול, השורות נסרקות פעם אחת, וכל טקסט מומר לאותיות קטנות פעם אחת.
+"""
+import functools
+import re
+
+# שאלות המשך שהמודל נוטה להוסיף בעצמו - מסירים אותן כי אנחנו מוסיפים שאלת המשך בנפרד
+FOLLOWUP_PATTERNS = [
+    "האם תרצה פרטים נוספים על אחד מהתורים?",
+    "יש לך שאלות על ההכנות לבדיקה או הנחיות הגעה?",
+    "האם תרצה לדעת מה להביא לבדיקה או איך להגיע?",
+    "האם תרצה הנחיות הגעה למתקן?",
+    "האם תרצה לקבוע תור חדש או לבדוק תורים בתאריך אחר?",
+    "יש לך שאלות על ההכנות לבדיקה?",
+    "האם תרצה פרטים נוספים על",
+    "יש לך עוד שאלות?",
+    "מה עוד אוכל לעזור לך?"
+]
+FOLLOWUP_HOLDBACK = max(len(p) for p in FOLLOWUP_PATTERNS)
+FOLLOWUP_TRAIL = "?📝🗺️📋📅"
+
+GREETING_TEMPLATES = ("שלום {}", "שלום {}!", "{} שלום")
+
+FOLLOWUP_QUESTIONS = {
+    'pick_appointment': "האם תרצה פרטים נוספים על אחד מהתורים? 📝",
+    'bring_or_arrive': "האם תרצה לדעת מה להביא לבדיקה או איך להגיע? 📋",
+    'prepare_or_arrive': "יש לך שאלות על ההכנות לבדיקה או הנחיות הגעה? 🗺️",
+    'new_appointment': "האם תרצה לקבוע תור חדש או לבדוק תורים בתאריך אחר? 📅",
+    'more_questions': "יש לך עוד שאלות על הבדיקה? 🤔",
+}
+
+# Keyword lists for the follow-up decision, as tuples so they are built once. They
+# are matched against lower-cased text, so the upper-case 'CT'/'MRI' entries never
+# match - kept that way so replies keep getting the follow-ups they always did.
+APPOINTMENT_KEYWORDS = ('תור', 'תורים', 'בדיקה', 'בדיקות', 'appointment', 'המטולוג', 'עיניים', 'גסטרו', 'CT', 'MRI')
+SPECIFIC_QUESTIONS = ('איך', 'מה', 'מתי', 'איפה', 'כמה', 'האם', 'הגעה', 'להביא', 'צום', 'הכנה')
+NEXT_APPOINTMENT_PHRASES = ('תור הבא', 'תור קרוב')
+FOUND_WORD = 'מצאתי'
+LIST_MARKERS = ('1.', 'רופא')
+DETAIL_WORDS = ('המטולוג', 'עיניים', 'שינה', 'ct', 'mri', 'בדיקת')
+NOT_FOUND_PHRASE = 'לא מצאתי תורים'
+PREPARATION_WORDS = ('הצטייד', 'להביא', 'הכנה', 'הנחיות', 'צום')
+
+NUM_RE = re.compile(r'\d+[\.\)]\s+')
+BULLET_RE = re.compile(r'[\-•]\s+')
+
+
+def greeting_patterns(user_name):
+    """ברכות פתיחה עם שם המשתמש שלא רוצים לחזור עליהן"""
+    return [t.format(user_name) for t in GREETING_TEMPLATES]
+
+
+@functools.lru_cache(maxsize=1024)
+def _greetings(user_name):
+    return tuple(greeting_patterns(user_name))
+
+
+def strip_greeting(user_name, response_text):
+    """הסרת ברכה חוזרת עם שם המשתמש מתחילת התשובה"""
+    if not user_name:
+        return response_text
+    for pattern in _greetings(user_name):
+        if response_text.startswith(pattern):
+            response_text = response_text[len(pattern):].strip()
+            if response_text[:1] in ('!', ','):
+                response_text = response_text[1:].strip()
+            break
+    return response_text
+
+
+def strip_followups(response_text):
+    """הסרת שאלת המשך שהמודל הוסיף בעצמו"""
+    # The first listed pattern found anywhere in the reply is the one removed
+    pattern = next((p for p in FOLLOWUP_PATTERNS if p in response_text), None)
+    if pattern is None:
+        return response_text
+    # Remove the follow-up question and any trailing punctuation/line breaks
+    response_text = response_text.replace(pattern, "").strip()
+    response_text = response_text.rstrip(FOLLOWUP_TRAIL).strip()
+    return response_text.rstrip("<br>").rstrip("\n").strip()
+
+
+def clean_reply(user_name, response_text):
+    """ניקוי תשובת המודל לפני העיצוב"""
+    return strip_followups(strip_greeting(user_name, response_text))
+
+
+def format_bot_text(text):
+    """המרת טקסט רגיל עם מספור/נקודות ל־HTML <ol>/<ul> עם ניקוי כוכביות"""
+    if not text:
+        return ""
+    if "<ol" in text or "<ul" in text or "<li" in text:
+        return text
+
+    # One pass over the lines: keep the non-empty ones and collect list items as we go
+    lines, numbered, bullets = [], [], []
+    for line in text.replace('*', '').splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        lines.append(line)
+        m = NUM_RE.match(line)
+        if m:
+            numbered.append(line[m.end():])
+            continue
+        m = BULLET_RE.match(line)
+        if m:
+            bullets.append(line[m.end():])
+
+    if not lines:
+        return ""
+    threshold = max(2, len(lines) // 2)
+    if len(numbered) >= threshold:
+        return "<ol>" + "".join(f"<li>{it}</li>" for it in numbered) + "</ol>"
+    if len(bullets) >= threshold:
+        return "<ul>" + "".join(f"<li>{it}</li>" for it in bullets) + "</ul>"
+    return "<br>".join(lines)
+
+
+def followup_question(user_message, response_text):
+    """שאלת המשך מתאימה לתשובה, או None אם לא צריך להוסיף"""
+    user_lower = user_message.lower()
+    # לא מוסיפים שאלת המשך אם המטופל כבר שאל שאלה ספציפית
+    if any(q in user_lower for q in SPECIFIC_QUESTIONS):
+        return None
+    response_lower = response_text.lower()
+    # ורק לשאלות/תשובות שקשורות לתורים
+    if not any(k in user_lower or k in response_lower for k in APPOINTMENT_KEYWORDS):
+        return None
+
+    if 'תור' in response_lower:
+        if FOUND_WORD in response_lower and any(m in response_text for m in LIST_MARKERS):
+            return FOLLOWUP_QUESTIONS['pick_appointment']
+        if any(w in response_lower for w in DETAIL_WORDS):
+            return FOLLOWUP_QUESTIONS['bring_or_arrive']
+        if any(p in user_lower for p in NEXT_APPOINTMENT_PHRASES):
+            return FOLLOWUP_QUESTIONS['prepare_or_arrive']
+    if NOT_FOUND_PHRASE in response_lower:
+        return FOLLOWUP_QUESTIONS['new_appointment']
+    if any(w in response_lower for w in PREPARATION_WORDS):
+        return FOLLOWUP_QUESTIONS['more_questions']
+    return None
+
+
+def build_reply(user_message, response_text):
+    """עיצוב התשובה והוספת שאלת המשך - מחזיר את גוף התשובה ל־JSON"""
+    formatted_response = format_bot_text(response_text)
+    followup = followup_question(user_message, response_text)
+    if followup is None:
+        return {'response': formatted_response}
+    return {'responses': [formatted_response, followup]}
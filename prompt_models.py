@@ -0,0 +1,150 @@
+"""הנחיית המערכת והמודל המשותף שנבנה ממנה.
+
+הקובץ נקרא פעם אחת ונקרא מחדש רק כשה־mtime שלו משתנה (ה־stat נעשה לכל
+היותר פעם ב־check_interval שניות). לכל גרסה של ההנחיה - hash של הטקסט -
+נבנה מודל אחד שמשותף לכל השיחות, כך שעריכת הקובץ נכנסת לתוקף בתור הבא של
+כל שיחה בלי הפעלה מחדש.
+
+כש־cache_ttl מוגדר, ההנחיה נשמרת ב־context cache של Gemini (CachedContent)
+והמודל נבנה ממנו, כך שבכל תור נשלחים ומעובדים רק ההיסטוריה וההודעה. ל־
+context cache יש מינימום טוקנים שתלוי במודל; אם יצירת ה־cache נכשלת חוזרים
+למודל רגיל עם system_instruction.
+
+ה־SDK של Gemini מיובא ומוגדר רק בשימוש הראשון (gemini()) - הייבוא שלו הוא
+רוב זמן העלייה של האפליקציה, ובקשות שלא מגיעות למודל לא צריכות אותו.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from llm_dispatch import model_errors
+
+DEFAULT_MODEL = 'gemini-1.5-flash'
+DEFAULT_CHECK_INTERVAL = 1.0
+# Versions kept around so chats that started on the previous prompt can finish their turn
+MAX_VERSIONS = 2
+# Context caches are recreated this long before they expire on the server
+CACHE_REFRESH_MARGIN = 60
+
+logger = logging.getLogger(__name__)
+
+_genai = None
+_genai_lock = threading.Lock()
+
+
+def gemini():
+    """המודול google.generativeai, מוגדר עם GEMINI_API_KEY - מיובא בקריאה הראשונה"""
+    global _genai
+    if _genai is None:
+        with _genai_lock:
+            if _genai is None:
+                import google.generativeai as genai
+                genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
+                _genai = genai
+    return _genai
+
+
+class SystemPrompt:
+    """טקסט ההנחיה מהקובץ, עם טעינה מחדש כשה־mtime משתנה"""
+
+    def __init__(self, path, check_interval=DEFAULT_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0.0
+        self._current = None
+        self.reloads = 0
+
+    def load(self):
+        """(טקסט, גרסה) - FileNotFoundError אם הקובץ מעולם לא נטען בהצלחה"""
+        now = time.monotonic()
+        if self._current is not None and now - self._checked_at < self.check_interval:
+            return self._current
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime != self._mtime:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        text = f.read()
+                    version = hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]
+                    if self._current is not None and version != self._current[1]:
+                        self.reloads += 1
+                        logger.info("system prompt reloaded: %s -> %s", self._current[1], version)
+                    self._mtime, self._current = mtime, (text, version)
+            except FileNotFoundError:
+                # Keep serving the last good prompt if the file disappears mid-deploy
+                if self._current is None:
+                    raise
+                logger.warning("system prompt %s is missing, keeping version %s", self.path, self._current[1])
+            return self._current
+
+
+class ModelRegistry:
+    """מודל Gemini אחד לכל גרסת הנחיה, עם context cache אופציונלי"""
+
+    def __init__(self, prompt, model_name=DEFAULT_MODEL, cache_ttl=0):
+        self.prompt = prompt
+        self.model_name = model_name
+        self.cache_ttl = cache_ttl
+        self._models = OrderedDict()  # version -> (model, cached_content or None, refresh_at)
+        self._lock = threading.Lock()
+        self.builds = 0
+
+    def get(self):
+        """המודל של הגרסה הנוכחית - FileNotFoundError אם קובץ ההנחיה חסר"""
+        text, version = self.prompt.load()
+        entry = self._models.get(version)
+        if entry is not None and entry[2] > time.time():
+            return entry[0]
+        with self._lock:
+            entry = self._models.get(version)
+            if entry is None or entry[2] <= time.time():
+                entry = self._models[version] = self._build(text, version)
+                self._models.move_to_end(version)
+                while len(self._models) > MAX_VERSIONS:
+                    _, (_, cached, _) = self._models.popitem(last=False)
+                    self._drop_cache(cached)
+            return entry[0]
+
+    def _build(self, text, version):
+        self.builds += 1
+        genai = gemini()
+        if self.cache_ttl:
+            try:
+                cached = genai.caching.CachedContent.create(
+                    model=f"models/{self.model_name}",
+                    display_name=f"system-prompt-{version}",
+                    system_instruction=text,
+                    ttl=timedelta(seconds=self.cache_ttl),
+                )
+                model = genai.GenerativeModel.from_cached_content(cached_content=cached)
+                refresh_at = time.time() + max(self.cache_ttl - CACHE_REFRESH_MARGIN, self.cache_ttl / 2)
+                return model, cached, refresh_at
+            except model_errors() as e:
+                logger.warning("context cache unavailable, using a plain model: %s", e)
+        return genai.GenerativeModel(self.model_name, system_instruction=text), None, float('inf')
+
+    @staticmethod
+    def _drop_cache(cached):
+        if cached is None:
+            return
+        try:
+            cached.delete()
+        except model_errors() as e:
+            logger.warning("failed to delete context cache: %s", e)
+
+    def stats(self):
+        with self._lock:
+            version = next(reversed(self._models), None)
+            return {
+                'prompt_version': version,
+                'prompt_reloads': self.prompt.reloads,
+                'model_builds': self.builds,
+                'context_cache': bool(version and self._models[version][1] is not None),
+            }
@@ -0,0 +1,106 @@
+"""מטמון תשובות של המודל לפי שאלה מנורמלת ונתוני המטופל.
+
+המפתח מורכב מהשאלה אחרי נרמול (ניקוד, פיסוק ורווחים) וגרסת הנחיית המערכת.
+הודעה קצרה ("כן", "תודה", "ומה עם השני?") היא תשובה למה שהמודל אמר קודם, ולכן
+במפתח שלה נכללת גם טביעה של תשובת המודל הקודמת בשיחה.
+לצד התשובות של כל מטופל נשמר ה־accounts.data_version שלו - גרסה שמתחלפת בכל
+כתיבה לתורים שלו (ראו db_setup). כשבקשה מגיעה עם גרסה אחרת, כל התשובות
+השמורות שלו נמחקות. גרסה נשמרת רק למטופלים שיש להם תשובות במטמון.
+"""
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 2048
+DEFAULT_TTL = 10 * 60
+# Messages this short only make sense together with the reply they answer
+CONTEXTUAL_MAX_WORDS = 3
+
+# Hebrew points and cantillation marks (U+0591-U+05C7), except maqaf/paseq/sof pasuq,
+# which are word separators and are folded like any other punctuation below
+NIQQUD_RE = re.compile('[\u0591-\u05BD\u05BF\u05C1\u05C2\u05C4\u05C5\u05C7]')
+PUNCT_RE = re.compile(r'[^\w\s]|_')
+SPACE_RE = re.compile(r'\s+')
+
+
+def normalize_question(text):
+    """נרמול שאלה: הסרת ניקוד ופיסוק, אותיות קטנות ורווח יחיד בין מילים"""
+    text = unicodedata.normalize('NFKC', text)
+    text = NIQQUD_RE.sub('', text).lower()
+    text = PUNCT_RE.sub(' ', text)
+    return SPACE_RE.sub(' ', text).strip()
+
+
+class ResponseCache:
+    """LRU עם TTL ותקרת גודל, עם מחיקה של כל רשומות המטופל כשהנתונים שלו משתנים"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._user_keys = {}
+        self._user_fingerprints = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(user_id, question, prompt_version, context):
+        question = normalize_question(question)
+        context_hash = None
+        if len(question.split()) <= CONTEXTUAL_MAX_WORDS:
+            context_hash = hashlib.sha1((context or '').encode()).hexdigest()[:16]
+        return (user_id, question, prompt_version, context_hash)
+
+    def _check_fingerprint(self, user_id, fingerprint):
+        # Data changed since these answers were cached: everything for this patient is stale.
+        # Only patients with entries are tracked, so misses alone don't grow the map.
+        cached = self._user_fingerprints.get(user_id)
+        if cached is not None and cached != fingerprint:
+            for key in self._user_keys.pop(user_id, ()):
+                self._entries.pop(key, None)
+            del self._user_fingerprints[user_id]
+
+    def get(self, user_id, question, fingerprint, prompt_version, context=None):
+        key = self._key(user_id, question, prompt_version, context)
+        with self._lock:
+            self._check_fingerprint(user_id, fingerprint)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id, question, fingerprint, prompt_version, response_text, context=None):
+        key = self._key(user_id, question, prompt_version, context)
+        with self._lock:
+            self._check_fingerprint(user_id, fingerprint)
+            self._entries[key] = (time.time() + self.ttl, response_text)
+            self._entries.move_to_end(key)
+            self._user_keys.setdefault(user_id, set()).add(key)
+            self._user_fingerprints[user_id] = fingerprint
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        self._entries.pop(key, None)
+        keys = self._user_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[key[0]]
+                self._user_fingerprints.pop(key[0], None)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._entries)
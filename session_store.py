@@ -0,0 +1,135 @@
+"""אחסון שיחות - בזיכרון עם LRU+TTL, או בקובץ SQLite משותף לכמה workers.
+
+שיחה נשמרת כ־dict פשוט שניתן להמיר ל־JSON: state, user_id, user_name
+והיסטוריה כרשומות {"role", "text"}. אובייקט המודל לא נשמר - הוא נבנה מחדש
+לפי הצורך (ראו app.get_model).
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 60 * 60
+DEFAULT_MAX_SESSIONS = 10000
+
+
+def history_to_records(history):
+    """המרת היסטוריית Gemini (protos או dicts) לרשומות role/text"""
+    records = []
+    for content in history:
+        if isinstance(content, dict):
+            role = content['role']
+            parts = content.get('parts', [])
+        else:
+            role = content.role
+            parts = content.parts
+        text = ''.join(part if isinstance(part, str) else part.text for part in parts)
+        records.append({'role': role, 'text': text})
+    return records
+
+
+def records_to_history(records):
+    """המרת רשומות role/text חזרה לפורמט ש־start_chat מקבל"""
+    return [{'role': record['role'], 'parts': [record['text']]} for record in records]
+
+
+class MemorySessionStore:
+    """שיחות בזיכרון התהליך, עם תפוגה לפי TTL ופינוי הישנה ביותר מעבר לתקרה"""
+
+    def __init__(self, max_sessions=DEFAULT_MAX_SESSIONS, ttl=DEFAULT_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            expires_at, session = entry
+            if expires_at <= time.time():
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def put(self, session_id, session):
+        with self._lock:
+            self._sessions[session_id] = (time.time() + self.ttl, session)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SQLiteSessionStore:
+    """שיחות בקובץ SQLite, כך שכל ה־workers והמופעים רואים את אותן שיחות"""
+
+    # Expired rows are swept every this many writes rather than on each one
+    PURGE_EVERY = 100
+
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''')
+        self._conn.commit()
+
+    def get(self, session_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM sessions WHERE session_id=? AND expires_at>?",
+                (session_id, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, session_id, session):
+        data = json.dumps(session, ensure_ascii=False, separators=(',', ':'))
+        now = time.time()
+        with self._lock:
+            self._conn.execute('''
+            INSERT INTO sessions (session_id, data, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET data=excluded.data, expires_at=excluded.expires_at
+            ''', (session_id, data, now + self.ttl))
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY == 0:
+                self._conn.execute("DELETE FROM sessions WHERE expires_at<=?", (now,))
+            self._conn.commit()
+
+    def delete(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE session_id=?", (session_id,))
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM sessions WHERE expires_at>?", (time.time(),)
+            ).fetchone()[0]
+
+
+def create_session_store():
+    """בחירת מאגר לפי SESSION_STORE (memory / sqlite) ומשתני הסביבה הנלווים"""
+    ttl = int(os.environ.get('SESSION_TTL', str(DEFAULT_TTL)))
+    if os.environ.get('SESSION_STORE', 'memory') == 'sqlite':
+        return SQLiteSessionStore(os.environ.get('SESSION_DB_PATH', 'sessions.db'), ttl=ttl)
+    max_sessions = int(os.environ.get('SESSION_MAX', str(DEFAULT_MAX_SESSIONS)))
+    return MemorySessionStore(max_sessions=max_sessions, ttl=ttl)
@@ -0,0 +1,13 @@
+import pytest
+
+import db
+import db_setup
+
+
+@pytest.fixture(scope='module')
+def db_path(tmp_path_factory):
+    """A database built from the bundled CSV, shared by the tests of one module"""
+    path = str(tmp_path_factory.mktemp('db') / 'app_database.db')
+    db_setup.setup_database(db_path=path)
+    yield path
+    db.close_connections()
@@ -0,0 +1,38 @@
+import pytest
+
+import analytics
+import db
+from text_to_sql import TextToSQL, UnsafeSQL
+
+
+def test_aggregate_matches_appointment_counts(db_path):
+    """Test that grouped rollup counts equal the same count over the appointments table."""
+    rows = analytics.aggregate(db_path, 'site_day_status', ['site_id'], start='2021-01-01', end='2023-01-01',
+                               filters={'appointment_status': 'Canceled'})
+    expected = db.get_connection(db_path).execute(
+        "SELECT site_id, COUNT(*) FROM appointments WHERE appointment_status='Canceled' "
+        "AND appointment_epoch >= strftime('%s', '2021-01-01') AND appointment_epoch < strftime('%s', '2023-01-01') "
+        "GROUP BY site_id"
+    ).fetchall()
+    assert rows and all(row['site_name'] for row in rows)
+    assert {row['site_id']: row['appointments'] for row in rows} == dict(map(tuple, expected))
+    assert [row['appointments'] for row in rows] == sorted((row['appointments'] for row in rows), reverse=True)
+
+
+def test_aggregate_rejects_unknown_names(db_path):
+    """Test that only known rollups and their own columns can be queried."""
+    with pytest.raises(ValueError):
+        analytics.aggregate(db_path, 'appointments', ['user_id'])
+    with pytest.raises(ValueError):
+        analytics.aggregate(db_path, 'cancel_reasons', ['appointment_type'])
+
+
+def test_staff_sql_sees_only_rollups(db_path):
+    """Test that text-to-SQL in analytics scope can sum the rollups but not read patient tables."""
+    engine = TextToSQL(lambda prompt: "SELECT SUM(appointments) AS total FROM rollup_type_load", scope=analytics.SCOPE)
+    _, rows = engine.run(db_path, None, 'כמה תורים יש בסך הכל')
+    assert rows == [{'total': len(db.get_connection(db_path).execute("SELECT 1 FROM appointments").fetchall())}]
+
+    engine = TextToSQL(lambda prompt: "SELECT user_id FROM appointments", scope=analytics.SCOPE)
+    with pytest.raises(UnsafeSQL):
+        engine.run(db_path, None, 'רשימת מטופלים')
@@ -1,5 +1,19 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+
 import pytest
-from app import app
+
+import app as app_module
+import db
+import db_setup
+from app import app, chat_sessions
+from bench.fake_llm import FakeChunk, FakeModel, FakeServiceUnavailable
+from llm_dispatch import TRY_AGAIN_REPLY, Dispatcher
+
 
 @pytest.fixture
 def client():
@@ -27,3 +41,212 @@ def test_chat_invalid_session(client):
     json_data = rv.get_json()
     assert 'error' in json_data
     assert json_data['error'] == 'Invalid session ID.'
+
+def make_session(monkeypatch, reply):
+    monkeypatch.setattr(app_module, 'get_model', lambda: FakeModel(reply=reply, latency=0))
+    monkeypatch.setattr(app_module, 'get_user_data', lambda user_id: [])
+    monkeypatch.setattr(app_module, 'get_user_version', lambda user_id: None)
+    session_id = os.urandom(8).hex()
+    chat_sessions.put(session_id, {'state': 'chatting', 'user_id': session_id, 'user_name': 'יוסי', 'history': []})
+    return session_id
+
+def parse_sse(body):
+    events = []
+    for frame in body.strip().split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in frame.split('\n'))
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+def test_chat_stream_matches_chat(client, monkeypatch):
+    """Test that the streamed final reply is identical to the /chat reply."""
+    reply = "שלום יוסי! מצאתי 2 תורים:\n1. בדיקת שינה\n2. בדיקת עיניים\nהאם תרצה פרטים נוספים על אחד מהתורים?"
+    message = 'ספר לי על הבדיקות שלי'
+    expected = client.post('/chat', json={'session_id': make_session(monkeypatch, reply), 'message': message}).get_json()
+
+    rv = client.post('/chat/stream', json={'session_id': make_session(monkeypatch, reply), 'message': message})
+    assert rv.mimetype == 'text/event-stream'
+    events = parse_sse(rv.get_data(as_text=True))
+    assert events[-1] == ('done', expected)
+
+    streamed = ''.join(data['text'] for event, data in events if event == 'token')
+    assert streamed and not streamed.startswith('שלום')
+    assert 'האם תרצה פרטים נוספים' not in streamed
+
+def test_repeated_question_is_served_from_cache(client, monkeypatch):
+    """Test that a repeated question skips the model but still gets the follow-up logic."""
+    session_id = make_session(monkeypatch, "מצאתי תור לבדיקת עיניים")
+    first = client.post('/chat', json={'session_id': session_id, 'message': 'ספר לי על התור שלי'}).get_json()
+
+    monkeypatch.setattr(app_module, 'get_model', lambda: pytest.fail('model called on a cache hit'))
+    again = client.post('/chat', json={'session_id': session_id, 'message': 'ספר לי, על התור שלי?'}).get_json()
+    assert again == first
+    assert len(chat_sessions.get(session_id)['history']) == 4
+
+def test_short_reply_is_not_replayed_for_a_different_question(client, monkeypatch):
+    """Test that a second "כן" after a different model turn goes to the model, not the cache."""
+    session_id = make_session(monkeypatch, "האם תרצה הנחיות הגעה?")
+    client.post('/chat', json={'session_id': session_id, 'message': 'מה עם הבדיקה שלי'})
+    monkeypatch.setattr(app_module, 'get_model', lambda: FakeModel(reply="הכתובת: יגאל אלון 96", latency=0))
+    first = client.post('/chat', json={'session_id': session_id, 'message': 'כן'}).get_json()
+
+    monkeypatch.setattr(app_module, 'get_model', lambda: FakeModel(reply="האם תרצה לשמוע על ההכנות לבדיקה?", latency=0))
+    client.post('/chat', json={'session_id': session_id, 'message': 'ספר לי על הבדיקה שלי'})
+    monkeypatch.setattr(app_module, 'get_model', lambda: FakeModel(reply="יש לצום 4 שעות", latency=0))
+    second = client.post('/chat', json={'session_id': session_id, 'message': 'כן'}).get_json()
+    assert second != first
+
+def test_metrics_endpoint_reports_model_turn(client, monkeypatch, capsys):
+    """Test that a model turn shows up in /metrics and prints nothing to stdout."""
+    session_id = make_session(monkeypatch, "מצאתי תור לבדיקת שינה")
+    answers = app_module.metrics.ANSWERS.value(source='model')
+    rv = client.post('/chat', json={'session_id': session_id, 'message': 'מה עם הבדיקה שלי'})
+    assert rv.status_code == 200
+    assert capsys.readouterr().out == ''
+
+    rv = client.get('/metrics')
+    assert rv.status_code == 200
+    assert rv.content_type.startswith('text/plain; version=0.0.4')
+    text = rv.get_data(as_text=True)
+    assert 'chatbot_stage_seconds_count{stage="model"}' in text
+    assert 'chatbot_stage_seconds_count{stage="postprocess"}' in text
+    assert 'chatbot_requests_total{endpoint="/chat",status="200"}' in text
+    assert 'chatbot_active_sessions ' in text
+    assert app_module.metrics.ANSWERS.value(source='model') == answers + 1
+
+def test_serverless_start_does_not_load_gemini_sdk(tmp_path):
+    """Test that /, /start and login in serverless mode never import the Gemini SDK."""
+    db_path = str(tmp_path / 'app_database.db')
+    db_setup.setup_database(db_path=db_path)
+    probe = (
+        "import sys, app, db\n"
+        "assert app.DB_PATH == app.os.path.join(app.os.path.dirname(app.__file__), 'app_database.db')\n"
+        "app.DB_PATH = sys.argv[1]\n"
+        "db.mark_immutable(app.DB_PATH)\n"
+        "client = app.app.test_client()\n"
+        "assert client.get('/').status_code == 200\n"
+        "session_id = client.post('/start').get_json()['session_id']\n"
+        "assert client.post('/chat', json={'session_id': session_id, 'message': '0014J00000JAuIGQA1'}).status_code == 200\n"
+        "assert app.chat_sessions.get(session_id)['state'] == 'chatting'\n"
+        "print('google.generativeai' in sys.modules)\n"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, SERVERLESS='1')
+    out = subprocess.run([sys.executable, '-c', probe, db_path], cwd=root, env=env,
+                         capture_output=True, text=True, check=True)
+    assert out.stdout.strip().splitlines()[-1] == 'False'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['app_database.db']
+
+def test_model_outage_returns_try_again_reply(client, monkeypatch):
+    """Test that a model that keeps failing gets a canned 503 reply instead of a 500."""
+    session_id = make_session(monkeypatch, '')
+    monkeypatch.setattr(app_module, 'get_model', lambda: FakeModel(latency=0, fail_every=1))
+    monkeypatch.setattr(app_module, 'dispatcher', Dispatcher(max_retries=1, backoff_base=0.001))
+    rv = client.post('/chat', json={'session_id': session_id, 'message': 'מה התוצאות שלי'})
+    assert rv.status_code == 503
+    assert rv.get_json() == {'response': TRY_AGAIN_REPLY}
+    assert chat_sessions.get(session_id)['history'] == []
+
+def test_concurrent_turns_on_one_session_are_serialized(monkeypatch):
+    """Test that two simultaneous turns on the same session both land in the history."""
+    session_id = make_session(monkeypatch, '')
+    monkeypatch.setattr(app_module, 'get_model', lambda: FakeModel(reply=lambda message: 'תשובה ל' + message, latency=0.1))
+
+    def turn(message):
+        with app.test_client() as client:
+            assert client.post('/chat', json={'session_id': session_id, 'message': message}).status_code == 200
+
+    threads = [threading.Thread(target=turn, args=(message,)) for message in ('שאלה א', 'שאלה ב')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    history = chat_sessions.get(session_id)['history']
+    assert [record['role'] for record in history] == ['user', 'model', 'user', 'model']
+    assert {history[0]['text'], history[2]['text']} == {'שאלה א', 'שאלה ב'}
+    assert app_module.session_locks._locks == {}
+
+def test_stream_releases_session_lock(monkeypatch):
+    """Test that the session lock is held while streaming and released when the stream ends."""
+    session_id = make_session(monkeypatch, "מצאתי תור לבדיקת שינה")
+    # Outside a `with` block the test client doesn't keep the request context alive
+    rv = app.test_client().post('/chat/stream', json={'session_id': session_id, 'message': 'מה עם הבדיקה'})
+    assert parse_sse(rv.get_data(as_text=True))[-1][0] == 'done'
+    rv.close()
+    assert app_module.session_locks._locks == {}
+
+def test_stream_reports_model_errors_but_not_bugs(monkeypatch):
+    """Test that a model error mid-stream becomes an error event, while a bug in the stream propagates."""
+    def failing_turn(error):
+        def chunks():
+            yield FakeChunk('מצאתי ')
+            raise error
+        return lambda session, user_message, stream=False: (None, chunks())
+
+    session_id = make_session(monkeypatch, "מצאתי תור")
+    monkeypatch.setattr(app_module, 'model_turn', failing_turn(FakeServiceUnavailable('503')))
+    rv = app.test_client().post('/chat/stream', json={'session_id': session_id, 'message': 'מה עם הבדיקה'})
+    assert parse_sse(rv.get_data(as_text=True))[-1] == ('error', {'error': 'Streaming failed.'})
+    rv.close()
+
+    monkeypatch.setattr(app_module, 'model_turn', failing_turn(TypeError('bug')))
+    with pytest.raises(TypeError):
+        app.test_client().post('/chat/stream', json={'session_id': session_id, 'message': 'מה עם הבדיקה'}).get_data()
+    assert app_module.session_locks._locks == {}
+
+def test_changed_appointments_reach_the_model_as_a_delta(client, monkeypatch, tmp_path):
+    """Test that patient data is re-read only after it changes, and only the change is added to the history."""
+    db_path = str(tmp_path / 'app_database.db')
+    db_setup.setup_database(db_path=db_path)
+    monkeypatch.setattr(app_module, 'DB_PATH', db_path)
+    monkeypatch.setattr(app_module, 'get_model', lambda: FakeModel(reply='מצאתי תור', latency=0))
+    fetches = []
+    monkeypatch.setattr(app_module, 'get_user_data', lambda user_id: fetches.append(user_id) or db.fetch_user_data(db_path, user_id))
+    user_id = '0014J00000JAuIGQA1'
+
+    session_id = client.post('/start').get_json()['session_id']
+    client.post('/chat', json={'session_id': session_id, 'message': user_id})
+    client.post('/chat', json={'session_id': session_id, 'message': 'ספר לי על הבדיקות שלי'})
+    assert len(fetches) == 1
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE appointments SET appointment_status='Canceled' WHERE row_id=("
+                 "SELECT row_id FROM appointments WHERE user_id=? AND appointment_status!='Canceled' LIMIT 1)", (user_id,))
+    conn.commit()
+    conn.close()
+    client.post('/chat', json={'session_id': session_id, 'message': 'ומה עם התור הבא?'})
+    assert len(fetches) == 2
+
+    updates = [record for record in chat_sessions.get(session_id)['history'] if record.get('update')]
+    assert [record['role'] for record in updates] == ['user', 'model']
+    assert '"changed":[{"before"' in updates[0]['text'] and '"s":"Canceled"' in updates[0]['text']
+    assert '"added"' not in updates[0]['text']
+
+def test_analytics_endpoint_requires_token(client, monkeypatch, db_path):
+    """Test that /analytics is off without a token, rejects a wrong one and returns grouped rollup rows."""
+    monkeypatch.setattr(app_module, 'DB_PATH', db_path)
+    url = '/analytics/site_day_status?group_by=site_id&appointment_status=Canceled'
+    assert client.get(url).status_code == 404
+
+    monkeypatch.setattr(app_module, 'ANALYTICS_TOKEN', 'staff-secret')
+    assert client.get(url, headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    rv = client.get(url, headers={'Authorization': 'Bearer staff-secret'})
+    assert rv.status_code == 200
+    rows = rv.get_json()['rows']
+    assert rows and set(rows[0]) == {'site_id', 'site_name', 'appointments'}
+    rv = client.get('/analytics/site_day_status?group_by=user_id', headers={'Authorization': 'Bearer staff-secret'})
+    assert rv.status_code == 400
+
+def test_staff_token_opens_analytics_chat(client, monkeypatch, db_path):
+    """Test that entering the staff token instead of an ID answers aggregate questions from the rollups."""
+    monkeypatch.setattr(app_module, 'DB_PATH', db_path)
+    monkeypatch.setattr(app_module, 'ANALYTICS_TOKEN', 'staff-secret')
+    monkeypatch.setattr(app_module.analytics_engine, 'generate',
+                        lambda prompt: "SELECT appointment_status, SUM(appointments) AS total FROM rollup_site_day_status "
+                                       "GROUP BY appointment_status ORDER BY total DESC LIMIT 1")
+    monkeypatch.setattr(app_module, 'get_model', lambda: pytest.fail('chat model called in analytics mode'))
+
+    session_id = client.post('/start').get_json()['session_id']
+    rv = client.post('/chat', json={'session_id': session_id, 'message': 'staff-secret'})
+    assert rv.get_json()['response'] == app_module.ANALYTICS_HELP
+    rv = client.post('/chat', json={'session_id': session_id, 'message': 'מה הסטטוס הנפוץ ביותר?'})
+    assert rv.get_json()['response'].startswith('appointment_status | total<br>')
@@ -0,0 +1,130 @@
+import asyncio
+import os
+
+import pytest
+
+import app as app_module
+import asgi_app
+from app import chat_sessions
+from asgi_app import app
+from bench.fake_llm import FakeChunk, FakeModel, FakeServiceUnavailable
+from llm_dispatch import TRY_AGAIN_REPLY, Dispatcher
+
+
+def post(path, json=None):
+    async def run():
+        client = app.test_client()
+        rv = await client.post(path, json=json)
+        return rv.status_code, await rv.get_json()
+    return asyncio.run(run())
+
+
+def test_start_chat():
+    """Test the start chat endpoint."""
+    status, json_data = post('/start')
+    assert status == 200
+    assert 'session_id' in json_data
+    assert 'responses' in json_data
+
+
+def test_chat_invalid_session():
+    """Test the chat endpoint with an invalid session ID."""
+    status, json_data = post('/chat', json={'session_id': 'invalid', 'message': 'hello'})
+    assert status == 400
+    assert json_data['error'] == 'Invalid session ID.'
+
+
+def test_chat_uses_async_model_call(monkeypatch):
+    """Test that a chat turn goes through send_message_async and updates history."""
+    model = FakeModel(reply='שלום יוסי! מצאתי תור אחד.', latency=0)
+    monkeypatch.setattr(app_module, 'get_model', lambda: model)
+    monkeypatch.setattr(app_module, 'get_user_data', lambda user_id: [])
+    session_id = os.urandom(8).hex()
+    chat_sessions.put(session_id, {'state': 'chatting', 'user_id': session_id, 'user_name': 'יוסי', 'history': []})
+    status, json_data = post('/chat', json={'session_id': session_id, 'message': 'מה יש לי'})
+    assert status == 200
+    assert json_data == {'response': 'מצאתי תור אחד.'}
+    assert chat_sessions.get(session_id)['history'] == [
+        {'role': 'user', 'text': 'מה יש לי'},
+        {'role': 'model', 'text': 'שלום יוסי! מצאתי תור אחד.'},
+    ]
+
+
+def test_model_outage_returns_try_again_reply(monkeypatch):
+    """Test that a failing async model call is retried, then answered with a canned 503 reply."""
+    model = FakeModel(latency=0, fail_every=1)
+    monkeypatch.setattr(app_module, 'get_model', lambda: model)
+    monkeypatch.setattr(app_module, 'get_user_data', lambda user_id: [])
+    monkeypatch.setattr(asgi_app, 'dispatcher', Dispatcher(max_retries=1, backoff_base=0.001))
+    session_id = os.urandom(8).hex()
+    chat_sessions.put(session_id, {'state': 'chatting', 'user_id': session_id, 'user_name': 'יוסי', 'history': []})
+    status, json_data = post('/chat', json={'session_id': session_id, 'message': 'מה יש לי'})
+    assert status == 503
+    assert json_data == {'response': TRY_AGAIN_REPLY}
+    assert model.calls == 2
+    assert app_module.session_locks._locks == {}
+
+
+def test_stream_lock_is_released_when_body_is_never_sent(monkeypatch):
+    """Test that a streamed reply's session lock is freed whether its body is closed unread or never sent at all."""
+    monkeypatch.setattr(asgi_app, 'SESSION_LOCK_TIMEOUT', 0.05)
+
+    async def body():
+        yield 'never sent'
+
+    async def run():
+        for session_id in ('closed', 'dropped'):
+            await app_module.session_locks.acquire_async(session_id, 1)
+        closed = asgi_app.LockedStream('closed', body())
+        dropped = asgi_app.LockedStream('dropped', body())
+        await closed.aclose()
+        assert 'closed' not in app_module.session_locks._locks
+        await asyncio.sleep(0.1)
+        assert dropped.released and [chunk async for chunk in dropped] == []
+
+    asyncio.run(run())
+    assert app_module.session_locks._locks == {}
+
+
+def test_stream_releases_session_lock(monkeypatch):
+    """Test that a completed /chat/stream reply releases the session lock."""
+    monkeypatch.setattr(app_module, 'get_model', lambda: FakeModel(reply='מצאתי תור אחד.', latency=0))
+    monkeypatch.setattr(app_module, 'get_user_data', lambda user_id: [])
+    session_id = os.urandom(8).hex()
+    chat_sessions.put(session_id, {'state': 'chatting', 'user_id': session_id, 'user_name': 'יוסי', 'history': []})
+
+    async def run():
+        rv = await app.test_client().post('/chat/stream', json={'session_id': session_id, 'message': 'מה יש לי'})
+        return await rv.get_data(as_text=True)
+
+    assert 'event: done' in asyncio.run(run())
+    assert app_module.session_locks._locks == {}
+
+
+def test_stream_reports_model_errors_but_not_bugs(monkeypatch):
+    """Test that a model error mid-stream becomes an error event, while a bug in the stream propagates."""
+    def failing_turn(error):
+        async def chunks():
+            yield FakeChunk('מצאתי ')
+            raise error
+
+        async def model_turn(session, user_message, stream=False):
+            return None, chunks()
+        return model_turn
+
+    monkeypatch.setattr(app_module, 'get_user_data', lambda user_id: [])
+    monkeypatch.setattr(app_module, 'get_user_version', lambda user_id: None)
+    session_id = os.urandom(8).hex()
+    chat_sessions.put(session_id, {'state': 'chatting', 'user_id': session_id, 'user_name': 'יוסי', 'history': []})
+
+    async def run():
+        rv = await app.test_client().post('/chat/stream', json={'session_id': session_id, 'message': 'מה יש לי'})
+        assert rv.status_code == 200
+        return await rv.get_data(as_text=True)
+
+    monkeypatch.setattr(asgi_app, 'model_turn', failing_turn(FakeServiceUnavailable('503')))
+    assert 'event: error' in asyncio.run(run())
+    monkeypatch.setattr(asgi_app, 'model_turn', failing_turn(TypeError('bug')))
+    with pytest.raises(TypeError):
+        asyncio.run(run())
+    assert app_module.session_locks._locks == {}
@@ -0,0 +1,86 @@
+import io
+import json
+
+import app as app_module
+import chatbot
+import db
+from bench.fake_llm import FakeModel
+from llm_dispatch import Dispatcher
+
+USER_ID = '0014J00000JAuIGQA1'
+
+
+def write_questions(path, items):
+    path.write_text(''.join(json.dumps(item, ensure_ascii=False) + '\n' for item in items), encoding='utf-8')
+
+
+def read_results(path):
+    return [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+
+
+def run(questions, output, model, db_path, version='v1', **kwargs):
+    dispatcher = Dispatcher(max_concurrency=4, backoff_base=0.001, max_retries=0)
+    return chatbot.run_batch(str(questions), str(output), model, version, db_path=db_path, concurrency=4,
+                             dispatcher=dispatcher, log=io.StringIO(), **kwargs)
+
+
+def test_batch_answers_every_question_once_per_patient(tmp_path, db_path):
+    """Test that each question gets a result and each patient is fetched once."""
+    questions = tmp_path / 'questions.jsonl'
+    write_questions(questions, [{'id': f'q{i}', 'user_id': USER_ID, 'question': f'שאלה {i}'} for i in range(10)]
+                    + [{'id': 'nobody', 'user_id': 'no-such-user', 'question': 'שלום'}])
+    output = tmp_path / 'results.jsonl'
+    name = db.fetch_user_data(db_path, USER_ID)[0]['user_name']
+    stats = run(questions, output, FakeModel(reply=f'שלום {name}! מצאתי תור אחד.', latency=0), db_path, window=4)
+
+    assert stats['answered'] == 10 and stats['unknown_users'] == 1 and stats['errors'] == 0
+    assert stats['patients_fetched'] == 2
+    results = {result['id']: result for result in read_results(output)}
+    assert set(results) == {f'q{i}' for i in range(10)} | {'nobody'}
+    assert results['q3']['answer'] == f'שלום {name}! מצאתי תור אחד.'
+    assert results['q3']['reply'] == {'response': 'מצאתי תור אחד.'}
+    assert results['q3']['prompt_tokens'] > 0 and results['q3']['prompt_version'] == 'v1'
+    assert results['nobody']['error'] == 'unknown_user'
+
+
+def test_resume_skips_answered_and_retries_failed(tmp_path, db_path):
+    """Test that a resumed run drops a torn last line and only re-asks what has no answer."""
+    questions = tmp_path / 'questions.jsonl'
+    write_questions(questions, [{'id': f'q{i}', 'user_id': USER_ID, 'question': f'שאלה {i}'} for i in range(6)])
+    output = tmp_path / 'results.jsonl'
+    output.write_text(
+        json.dumps({'id': 'q0', 'prompt_version': 'v1', 'answer': 'ישן'}) + '\n'
+        + json.dumps({'id': 'q1', 'prompt_version': 'v1', 'error': 'model call failed'}) + '\n'
+        + json.dumps({'id': 'q2', 'prompt_version': 'v0', 'answer': 'גרסה קודמת'}) + '\n'
+        + '{"id": "q3", "prompt_ver',
+        encoding='utf-8',
+    )
+    model = FakeModel(reply='תשובה', latency=0)
+    stats = run(questions, output, model, db_path)
+
+    assert stats['skipped'] == 1 and stats['answered'] == 5
+    assert model.calls == 5
+    answered = [result['id'] for result in read_results(output)[3:]]
+    assert sorted(answered) == ['q1', 'q2', 'q3', 'q4', 'q5']
+    assert run(questions, output, model, db_path)['skipped'] == 6
+
+
+def test_failed_calls_are_recorded_as_errors(tmp_path, db_path):
+    """Test that a model failure is written as an error line instead of stopping the run."""
+    questions = tmp_path / 'questions.jsonl'
+    write_questions(questions, [{'user_id': USER_ID, 'question': 'שאלה'}, {'user_id': USER_ID, 'question': 'עוד'}])
+    output = tmp_path / 'results.jsonl'
+    stats = run(questions, output, FakeModel(reply='תשובה', latency=0, fail_every=2), db_path)
+    assert stats['answered'] == 1 and stats['errors'] == 1
+    errors = [result for result in read_results(output) if result.get('error')]
+    assert len(errors) == 1 and 'FakeServiceUnavailable' in errors[0]['error']
+
+
+def test_patient_context_matches_app_login(db_path, monkeypatch):
+    """Test that a batch question starts from the same login history as a chat in the app."""
+    monkeypatch.setattr(app_module, 'TEXT_TO_SQL', False)
+    monkeypatch.setattr(app_module, 'get_user_data', lambda user_id: db.fetch_user_data(db_path, user_id))
+    session = {}
+    assert app_module.login(session, USER_ID)[1] == 200
+    records, first_name = chatbot.PatientContexts(db_path).get(USER_ID)
+    assert records == session['history'] and first_name == session['user_name']
@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+import db
+from context_builder import (
+    LEGEND,
+    encode_user_data,
+    estimate_tokens,
+    history_tokens,
+    window_history,
+)
+
+USER_ID = '0014J00000JAuIGQA1'
+
+
+@pytest.fixture(scope='module')
+def user_data(db_path):
+    return db.fetch_user_data(db_path, USER_ID)
+
+
+def test_encode_user_data_deduplicates_sites(user_data):
+    """Test that each site is encoded once and appointments point at it."""
+    legend, data = encode_user_data(user_data).split('\n', 1)
+    decoded = json.loads(data)
+    assert legend == LEGEND
+    assert len(decoded['appointments']) == len(user_data)
+    assert len(decoded['sites']) == len({row['site_name'] for row in user_data})
+    assert all(appt['site'] in decoded['sites'] for appt in decoded['appointments'])
+    assert all(set(site) <= {'name', 'address'} for site in decoded['sites'].values())
+
+
+def test_encode_user_data_is_smaller_than_repr(user_data):
+    """Test that the compact encoding is a fraction of the old str(user_data)."""
+    assert estimate_tokens(encode_user_data(user_data)) < estimate_tokens(str(user_data)) / 2
+
+
+def test_window_history_keeps_budget_and_summarizes():
+    """Test that old turns are folded into a summary and recent ones are kept."""
+    records = [{'role': 'user', 'text': 'הקשר'}, {'role': 'model', 'text': 'שלום'}]
+    for i in range(20):
+        records += [{'role': 'user', 'text': f'שאלה {i} ' + 'א' * 60}, {'role': 'model', 'text': 'ב' * 150}]
+
+    windowed = window_history(records, budget=300)
+    assert history_tokens(windowed) <= 300
+    assert windowed[:2] == records[:2]
+    assert windowed[2]['summary'] and 'שאלה 17' in windowed[2]['text']
+    assert windowed[-2:] == records[-2:]
+
+    # A second pass folds the earlier summary into the new one
+    again = window_history(windowed + records[-2:], budget=300)
+    assert sum(1 for record in again if record.get('summary')) == 1
+
+
+def test_window_history_keeps_data_updates():
+    """Test that a data update turn survives when the turns around it are summarized."""
+    records = [{'role': 'user', 'text': 'הקשר'}, {'role': 'model', 'text': 'שלום'}]
+    records += [{'role': 'user', 'text': 'עדכון', 'update': True}, {'role': 'model', 'text': 'הבנתי.', 'update': True}]
+    for i in range(20):
+        records += [{'role': 'user', 'text': f'שאלה {i} ' + 'א' * 60}, {'role': 'model', 'text': 'ב' * 150}]
+
+    windowed = window_history(records, budget=300)
+    assert windowed[2].get('summary')
+    assert windowed[4:6] == records[2:4]
+    assert not any('עדכון' in topic for topic in windowed[2]['topics'])
+
+
+def test_window_history_keeps_last_exchange_behind_a_large_login_context():
+    """Test that a login context bigger than the budget neither counts against it nor evicts the last exchange."""
+    records = [{'role': 'user', 'text': 'א' * 15000}, {'role': 'model', 'text': 'שלום'}]
+    records += [{'role': 'user', 'text': 'מתי התור?'}, {'role': 'model', 'text': 'ביום ראשון. האם תרצה הנחיות הגעה?'}]
+    assert window_history(records, budget=300) == records
+
+    records += [{'role': 'user', 'text': 'ב' * 600}, {'role': 'model', 'text': 'ג' * 600}]
+    windowed = window_history(records, budget=300)
+    assert windowed[:2] == records[:2]
+    assert windowed[2]['summary'] and windowed[-2:] == records[-2:]
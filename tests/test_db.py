@@ -0,0 +1,87 @@
+import sqlite3
+
+import pytest
+
+import db
+import db_setup
+
+USER_ID = '0014J00000JAuIGQA1'
+
+
+def test_fetch_user_data(db_path):
+    """Test that a patient's appointments are joined with the account row."""
+    rows = db.fetch_user_data(db_path, USER_ID)
+    assert rows
+    assert all(row['user_id'] == USER_ID for row in rows)
+    assert 'user_name' in rows[0] and 'age' in rows[0]
+
+
+def test_fetch_unknown_user(db_path):
+    """Test that an unknown user_id returns no rows."""
+    assert db.fetch_user_data(db_path, 'no-such-user') == []
+
+
+def test_connection_is_reused_and_read_only(db_path):
+    """Test that the per-thread connection is long-lived and rejects writes."""
+    conn = db.get_connection(db_path)
+    assert db.get_connection(db_path) is conn
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("DELETE FROM appointments")
+
+
+def test_immutable_database_opens_without_side_files(tmp_path):
+    """Test that an immutable database is read in place without creating -wal/-shm files."""
+    path = tmp_path / 'bundled.db'
+    db_setup.setup_database(db_path=str(path))
+    db.mark_immutable(path)
+    conn = db.connect_readonly(path)
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM appointments").fetchone()[0] > 0
+        assert sorted(p.name for p in tmp_path.iterdir()) == ['bundled.db']
+    finally:
+        conn.close()
+
+
+def test_user_lookup_uses_index(db_path):
+    """Test that the user_id lookup is an index search, not a table scan."""
+    plan = [row[3] for row in db.get_connection(db_path).execute(
+        "EXPLAIN QUERY PLAN " + db.USER_DATA_SQL, (USER_ID,))]
+    assert any('idx_appointments_user_epoch' in step for step in plan)
+
+
+def test_date_queries_use_index_without_sorting(db_path):
+    """Test that the date lookups seek the (user_id, epoch) index and need no sort step."""
+    conn = db.get_connection(db_path)
+    for sql, params in [
+        (db.NEXT_APPOINTMENT_SQL, (USER_ID, 0)),
+        (db.APPOINTMENTS_BETWEEN_SQL, (USER_ID, 0, 2 ** 40, 5)),
+        (db.PAST_APPOINTMENTS_SQL, (USER_ID, 2 ** 40, 5)),
+    ]:
+        plan = " ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+        assert 'idx_appointments_user_epoch' in plan
+        assert 'TEMP B-TREE' not in plan
+
+
+def test_next_and_past_appointments(db_path):
+    """Test that next/past/range lookups agree with a scan of the patient's rows."""
+    rows = [row for row in db.fetch_user_data(db_path, USER_ID) if row['appointment_epoch'] is not None]
+    epochs = sorted(row['appointment_epoch'] for row in rows)
+    middle = epochs[len(epochs) // 2]
+
+    assert db.next_appointment(db_path, USER_ID, middle)['appointment_epoch'] == middle
+    assert db.next_appointment(db_path, USER_ID, epochs[-1] + 1) is None
+
+    past = db.past_appointments(db_path, USER_ID, middle, limit=3)
+    assert [row['appointment_epoch'] for row in past] == sorted((e for e in epochs if e < middle), reverse=True)[:3]
+
+    between = db.appointments_between(db_path, USER_ID, epochs[0], middle, limit=100)
+    assert [row['appointment_epoch'] for row in between] == [e for e in epochs if e < middle]
+
+
+def test_next_appointments_batch(db_path):
+    """Test that the batched lookup matches per-user lookups and skips users without appointments."""
+    user_ids = [row[0] for row in db.get_connection(db_path).execute("SELECT user_id FROM accounts")]
+    batch = db.next_appointments(db_path, user_ids + ['no-such-user'], 0)
+    assert 'no-such-user' not in batch
+    for user_id in user_ids:
+        assert batch.get(user_id) == db.next_appointment(db_path, user_id, 0)
@@ -0,0 +1,157 @@
+import sqlite3
+
+import pytest
+
+import db_setup
+
+
+@pytest.fixture()
+def db_path(tmp_path):
+    path = str(tmp_path / 'app_database.db')
+    db_setup.setup_database(db_path=path)
+    return path
+
+
+def test_full_load_populates_derived_columns(db_path):
+    """Test that every dated row gets an epoch and ISO timestamp matching its text date."""
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute(
+        "SELECT appointment_date_time, appointment_epoch, appointment_ts FROM appointments"
+    ).fetchall()
+    conn.close()
+    assert rows
+    for text, epoch, ts in rows:
+        if text == 'NaT':
+            assert epoch is None and ts is None
+        else:
+            assert ts == text[:10] + 'T' + text[11:19] + 'Z'
+            assert isinstance(epoch, int)
+
+
+def test_incremental_rerun_changes_nothing(db_path):
+    """Test that re-ingesting the same export in incremental mode rewrites no rows."""
+    total, changed = db_setup.setup_database(db_path=db_path, incremental=True)
+    assert total > 0
+    assert changed == 0
+
+
+def test_incremental_updates_changed_rows(db_path):
+    """Test that a row edited in the database is restored by the next incremental load."""
+    conn = sqlite3.connect(db_path)
+    row_id, = conn.execute("SELECT row_id FROM appointments LIMIT 1").fetchone()
+    conn.execute("UPDATE appointments SET appointment_status='X', content_hash='stale' WHERE row_id=?", (row_id,))
+    conn.commit()
+    conn.close()
+
+    _, changed = db_setup.setup_database(db_path=db_path, incremental=True)
+    assert changed == 1
+    conn = sqlite3.connect(db_path)
+    status, = conn.execute("SELECT appointment_status FROM appointments WHERE row_id=?", (row_id,)).fetchone()
+    conn.close()
+    assert status != 'X'
+
+
+def test_sites_are_stored_once_with_clean_instructions(db_path):
+    """Test that each site is one row with decoded plain-text instructions, referenced by id from appointments."""
+    conn = sqlite3.connect(db_path)
+    names = [name for name, in conn.execute("SELECT site_name FROM sites")]
+    texts = [text for text, in conn.execute("SELECT instructions FROM sites WHERE instructions IS NOT NULL")]
+    orphans, = conn.execute(
+        "SELECT COUNT(*) FROM appointments a LEFT JOIN sites s USING (site_id) WHERE s.site_id IS NULL"
+    ).fetchone()
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(appointments)")}
+    conn.close()
+    assert len(names) == len(set(names)) == 11
+    assert texts and not any('&quot;' in text or '<' in text for text in texts)
+    assert orphans == 0
+    assert 'site_id' in columns and not columns & set(db_setup.LEGACY_SITE_COLUMNS)
+
+
+def test_html_instructions_are_split_into_sections():
+    """Test that HTML instructions lose their markup and their lines are grouped under the right section."""
+    raw = (
+        '<p><b style="font-size: 14px;">דרכי הגעה בתחבורה ציבורית</b></p>'
+        '<ul><li><span>למגיעים מחולון קו 7</span></li><li>תחנת &quot;השלום&quot;</li></ul>'
+        '<p><b>דרכי הגעה ברכב פרטי</b></p><ul><li>יש לפנות ימינה לחניון &quot;אלקטרה&quot;.</li></ul>'
+    )
+    text = db_setup.clean_instructions(raw)
+    assert text.splitlines() == [
+        'דרכי הגעה בתחבורה ציבורית', 'למגיעים מחולון קו 7', 'תחנת "השלום"',
+        'דרכי הגעה ברכב פרטי', 'יש לפנות ימינה לחניון "אלקטרה".',
+    ]
+    assert db_setup.split_sections(text) == {
+        'transport': 'למגיעים מחולון קו 7\nתחנת "השלום"',
+        'car': 'יש לפנות ימינה לחניון "אלקטרה".',
+        'parking': None,
+        'accessibility': None,
+    }
+
+
+@pytest.mark.parametrize('csv_path', ['data/db.csv', 'data/appointments_cleaned_for_bigquery.csv'])
+def test_bundled_sites_keep_directions_out_of_parking(csv_path):
+    """Test that driving directions mentioning a car park stay in `car`, and glued sentences are split."""
+    sites = {}
+    for chunk in db_setup.read_chunks(csv_path, chunksize=5000):
+        for name, (_, raw) in db_setup.chunk_sites(chunk).items():
+            sites[name] = db_setup.clean_instructions(raw) or sites.get(name)
+    sections = {name: db_setup.split_sections(text) for name, text in sites.items()}
+
+    assert 'יש להחנות בסמוך לשער 2.' in sections['אסותא אשדוד']['car']
+    assert sections['אסותא אשדוד']['parking'] is None
+    assert sections['אסותא השלום']['parking'] is None
+    assert 'מנחם בגין\nיש לרדת' in sections['אסותא אשדוד']['transport']
+
+    ramat_hachayal = sections['אסותא רמת החייל בדיקות ETL']
+    assert 'WAZE' not in ramat_hachayal['parking']
+    assert ramat_hachayal['parking'].splitlines()[-2:] == [
+        'החניון פתוח 24/7', ramat_hachayal['accessibility'],
+    ]
+    assert ramat_hachayal['accessibility'].startswith('חנייה חינם') and 'נכים' in ramat_hachayal['accessibility']
+
+
+def test_incremental_load_migrates_site_columns(tmp_path):
+    """Test that a database with site text on every appointment row is moved to the sites table in place."""
+    path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE appointments (row_id TEXT PRIMARY KEY, user_id TEXT, appointment_type TEXT, "
+        "appointment_date_time TEXT, appointment_status TEXT, cancel_reason_code TEXT, record_type TEXT, "
+        "site_name TEXT, site_address TEXT, site_instructions TEXT)"
+    )
+    conn.execute("INSERT INTO appointments (row_id, user_id, site_name, site_address, site_instructions) "
+                 "VALUES ('old-1', 'u1', 'אסותא בדיקה', 'רחוב 1', '<p>דרכי הגעה ברכב פרטי</p><p>ישר</p>')")
+    conn.commit()
+    conn.close()
+
+    db_setup.setup_database(db_path=path, incremental=True)
+    conn = sqlite3.connect(path)
+    site = conn.execute(
+        "SELECT s.site_name, s.site_address, s.car FROM appointments a JOIN sites s USING (site_id) WHERE row_id='old-1'"
+    ).fetchone()
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(appointments)")}
+    conn.close()
+    assert site == ('אסותא בדיקה', 'רחוב 1', 'ישר')
+    assert not columns & set(db_setup.LEGACY_SITE_COLUMNS)
+
+
+def test_rollups_follow_incremental_changes(db_path):
+    """Test that the rollup tables match a fresh aggregate of appointments after rows change, move or disappear."""
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE appointments SET content_hash='stale' WHERE rowid IN (1, 2, 3)")
+    conn.execute("UPDATE appointments SET appointment_status='Canceled', cancel_reason_code='99', site_id=1 "
+                 "WHERE rowid IN (4, 5)")
+    conn.execute("DELETE FROM appointments WHERE rowid=6")
+    conn.commit()
+    conn.close()
+    db_setup.setup_database(db_path=db_path, incremental=True)
+
+    conn = sqlite3.connect(db_path)
+    for table, (keys, condition) in db_setup.ROLLUPS.items():
+        values = ", ".join(f"{expression.format(row='appointments')} AS {key}" for key, expression in keys.items())
+        expected = conn.execute(
+            f"SELECT {values}, COUNT(*) FROM appointments WHERE {condition.format(row='appointments')} "
+            f"GROUP BY {', '.join(keys)} ORDER BY {', '.join(keys)}"
+        ).fetchall()
+        stored = conn.execute(f"SELECT * FROM {table} ORDER BY {', '.join(keys)}").fetchall()
+        assert stored == expected, table
+    conn.close()
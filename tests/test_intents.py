@@ -0,0 +1,95 @@
+import sqlite3
+
+import pytest
+
+from intents import IntentRouter, format_date, router
+
+USER_ID = '0014J00000JAuIGQA1'
+# 102 appointments, 33 of them canceled
+BUSY_USER_ID = '0014J00000PJjXKQA1'
+
+
+@pytest.mark.parametrize('message, intent', [
+    ('מתי התור הבא שלי?', 'next_appointment'),
+    ('what is my next appointment', 'next_appointment'),
+    ('אילו תורים יש לי החודש?', 'list_appointments'),
+    ('list my appointments', 'list_appointments'),
+    ('איך מגיעים לאסותא השלום?', 'site_directions'),
+    ('where is my test', 'site_directions'),
+    ('what is the status of my appointment', 'appointment_status'),
+    ('למה התור בוטל?', 'appointment_status'),
+    ('מה צריך להביא לבדיקת דם?', None),
+    ('אני רוצה לבטל את התור הבא', None),
+    ('can I change my next appointment?', None),
+    ('I need to reschedule my next appointment', None),
+    ('האם צריך לצום לפני התור הקרוב?', None),
+    ('מה צריך להביא לתור הבא?', None),
+    ('איפה אפשר לראות את תוצאות הבדיקה?', None),
+    ('מה הכתובת למשלוח מסמכים?', None),
+    ('what is the status of my lab results', None),
+    ('מה הכתובת של אסותא השלום?', 'site_directions'),
+])
+def test_match(message, intent):
+    """Test that common Hebrew and English questions map to the right intent."""
+    assert router.match(message) == intent
+
+
+def test_site_directions_by_english_name(db_path):
+    """Test that an English site name picks that site's address."""
+    intent, text = router.answer('how do I get to Assuta HaShalom', db_path, USER_ID)
+    assert intent == 'site_directions'
+    assert text.startswith('אסותא השלום: יגאל אלון 96')
+    assert '&quot;' not in text
+
+
+def test_site_directions_answers_only_the_asked_section(db_path):
+    """Test that a parking question gets the site's parking lines and not its bus routes."""
+    _, full = router.answer('how do I get to ramat hachayal', db_path, USER_ID)
+    _, parking = router.answer('where is the parking at ramat hachayal', db_path, USER_ID)
+    assert parking.startswith('אסותא רמת החייל')
+    assert 'חניון תת קרקעי' in parking
+    assert 'קווים 12, 33' in full and 'קווים 12, 33' not in parking
+
+
+def test_question_about_one_appointment_type_goes_to_the_model(db_path):
+    """Test that a next-appointment question naming a type is not answered with the next appointment of any type."""
+    assert router.match('מתי התור שלי לרופא עיניים?') == 'next_appointment'
+    assert router.answer('מתי התור שלי לרופא עיניים?', db_path, USER_ID) == (None, None)
+    assert router.answer('next appointment with the eye doctor', db_path, USER_ID) == (None, None)
+
+
+def test_cancellation_question_reports_the_latest_canceled_appointment(db_path):
+    """Test that "why was it canceled" describes the last canceled appointment, not the next one."""
+    conn = sqlite3.connect(db_path)
+    date, = conn.execute(
+        "SELECT appointment_date_time FROM appointments WHERE user_id=? AND appointment_status='Canceled' "
+        "ORDER BY appointment_epoch DESC LIMIT 1", (BUSY_USER_ID,)
+    ).fetchone()
+    conn.close()
+    intent, text = router.answer('למה התור בוטל?', db_path, BUSY_USER_ID)
+    assert intent == 'appointment_status'
+    assert text.startswith('התור האחרון שבוטל:') and format_date(date) in text
+
+
+def test_format_date_shows_israel_time():
+    """Test that stored UTC times are shown in Israel time, winter and summer."""
+    assert format_date('2020-01-16 07:00:00+00:00') == '16/01/2020 09:00'
+    assert format_date('2022-06-14 05:30:00+00:00') == '14/06/2022 08:30'
+    assert format_date('NaT') == 'NaT'
+
+
+def test_list_appointments(db_path):
+    """Test that listing without a date range returns the latest appointments as a numbered list."""
+    _, text = router.answer('התורים שלי', db_path, USER_ID)
+    lines = text.splitlines()
+    assert lines[0].startswith('מצאתי')
+    assert lines[1].startswith('1. ')
+
+
+def test_stats_count_fast_path_share():
+    """Test that the router reports the share of requests it answered."""
+    local = IntentRouter()
+    local.intent('ping', [r'ping'])(lambda db_path, user_id, message: 'pong')
+    assert local.answer('ping', None, None) == ('ping', 'pong')
+    assert local.answer('hello', None, None) == (None, None)
+    assert local.stats() == {'requests': 2, 'fast_path_hits': 1, 'fast_path_ratio': 0.5, 'by_intent': {'ping': 1}}
@@ -0,0 +1,170 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import llm_dispatch
+from bench.fake_llm import FakeServiceUnavailable
+from llm_dispatch import Dispatcher, Overloaded, SessionLocks, Unavailable
+
+
+def flaky(failures, result='ok'):
+    """An attempt that raises a transient error the first `failures` times."""
+    calls = []
+
+    def attempt(timeout):
+        calls.append(timeout)
+        if len(calls) <= failures:
+            raise FakeServiceUnavailable('503')
+        return result
+    return attempt, calls
+
+
+def test_transient_errors_are_retried():
+    """Test that a transient error is retried with the remaining deadline as timeout."""
+    dispatcher = Dispatcher(max_retries=2, backoff_base=0.001, deadline=10)
+    attempt, calls = flaky(2)
+    retries = llm_dispatch.RETRIES.value()
+    assert dispatcher.call(attempt) == 'ok'
+    assert len(calls) == 3
+    assert 0 < calls[-1] <= 10
+    assert llm_dispatch.RETRIES.value() == retries + 2
+    assert dispatcher.in_flight == 0
+
+
+def test_exhausted_retries_raise_unavailable():
+    """Test that a call still failing after its retries raises Unavailable with the cause."""
+    dispatcher = Dispatcher(max_retries=1, backoff_base=0.001)
+    attempt, calls = flaky(5)
+    with pytest.raises(Unavailable) as info:
+        dispatcher.call(attempt)
+    assert len(calls) == 2
+    assert isinstance(info.value.__cause__, FakeServiceUnavailable)
+
+
+def test_non_transient_errors_are_not_retried():
+    """Test that errors without a retryable status propagate on the first attempt."""
+    dispatcher = Dispatcher(max_retries=3)
+    calls = []
+
+    def attempt(timeout):
+        calls.append(timeout)
+        raise ValueError('bad request')
+
+    with pytest.raises(ValueError):
+        dispatcher.call(attempt)
+    assert len(calls) == 1
+
+
+def test_saturated_dispatcher_sheds_load():
+    """Test that a call that cannot get a slot within queue_timeout raises Overloaded."""
+    dispatcher = Dispatcher(max_concurrency=1, queue_timeout=0.05)
+    started, release = threading.Event(), threading.Event()
+
+    def slow(timeout):
+        started.set()
+        release.wait(5)
+        return 'slow'
+
+    worker = threading.Thread(target=dispatcher.call, args=(slow,))
+    worker.start()
+    started.wait(5)
+    try:
+        with pytest.raises(Overloaded):
+            dispatcher.call(lambda timeout: 'fast')
+    finally:
+        release.set()
+        worker.join()
+    assert dispatcher.call(lambda timeout: 'fast') == 'fast'
+
+
+def test_rate_limit_sheds_load():
+    """Test that calls beyond the per-minute budget are shed once the bucket is empty."""
+    dispatcher = Dispatcher(rpm=1, queue_timeout=0.05)
+    assert dispatcher.call(lambda timeout: 'first') == 'first'
+    with pytest.raises(Overloaded):
+        dispatcher.call(lambda timeout: 'second')
+
+
+def test_slow_call_is_hedged():
+    """Test that a duplicate is sent after hedge_after and the first reply wins."""
+    dispatcher = Dispatcher(hedge_after=0.05)
+    calls = []
+
+    def attempt(timeout):
+        calls.append(timeout)
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return 'slow'
+        return 'fast'
+
+    start = time.perf_counter()
+    assert dispatcher.call(attempt) == 'fast'
+    assert time.perf_counter() - start < 0.4
+    assert len(calls) == 2
+    assert dispatcher.call(attempt, hedge=False) == 'fast'
+
+
+def test_async_call_retries_and_hedges():
+    """Test that call_async retries transient errors and hedges slow attempts."""
+    dispatcher = Dispatcher(backoff_base=0.001, hedge_after=0.05)
+    calls = []
+
+    async def attempt(timeout):
+        calls.append(timeout)
+        if len(calls) == 1:
+            raise FakeServiceUnavailable('503')
+        if len(calls) == 2:
+            await asyncio.sleep(0.5)
+            return 'slow'
+        return 'fast'
+
+    assert asyncio.run(dispatcher.call_async(attempt)) == 'fast'
+    assert len(calls) == 3
+    assert dispatcher.in_flight == 0
+
+
+def test_session_lock_serializes_turns():
+    """Test that a second turn on a busy session waits, then gives up with Overloaded."""
+    locks = SessionLocks()
+    locks.acquire('s1', timeout=1)
+    with pytest.raises(Overloaded):
+        locks.acquire('s1', timeout=0.05)
+    with locks.hold('s2', timeout=0.05):
+        pass
+    locks.release('s1')
+    with locks.hold('s1', timeout=0.05):
+        pass
+    assert locks._locks == {}
+
+
+def test_async_waiters_are_woken_by_releases_from_any_thread():
+    """Test that queued coroutines get freed slots and session locks without polling, even from a sync release."""
+    dispatcher = Dispatcher(max_concurrency=2, queue_timeout=5)
+    locks = SessionLocks()
+    done = []
+
+    async def attempt(timeout):
+        await asyncio.sleep(0.02)
+        return 'ok'
+
+    async def turn(i):
+        await locks.acquire_async('s1', timeout=5)
+        try:
+            done.append(await dispatcher.call_async(attempt))
+        finally:
+            locks.release('s1')
+
+    async def main():
+        locks.acquire('s1', timeout=1)
+        threading.Timer(0.05, locks.release, args=('s1',)).start()
+        await asyncio.gather(*(turn(i) for i in range(10)))
+        # With the session free, twenty calls share the two slots
+        await asyncio.gather(*(dispatcher.call_async(attempt) for _ in range(20)))
+
+    start = time.monotonic()
+    asyncio.run(main())
+    assert done == ['ok'] * 10
+    assert time.monotonic() - start < 2
+    assert dispatcher.in_flight == 0 and locks._locks == {}
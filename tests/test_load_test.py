@@ -0,0 +1,32 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+from bench.fake_llm import FakeModel, hashed_reply
+
+
+@pytest.mark.parametrize('extra', [[], ['--stream', '--no-cache']])
+def test_load_test_runs_offline(tmp_path, extra):
+    """Test that the load test completes without failures and reports every endpoint."""
+    out = tmp_path / 'report.json'
+    subprocess.run(
+        [sys.executable, '-m', 'bench.load_test', '--patients', '3', '--concurrency', '2', '--turns', '3',
+         '--latency', '0', '--json', str(out)] + extra,
+        capture_output=True, text=True, timeout=120, check=True,
+    )
+    report = json.loads(out.read_text(encoding='utf-8'))
+    assert report['requests'] == 3 * (1 + 1 + 3) and report['failures'] == 0
+    assert {'/start', '/chat (login)'} <= set(report['endpoints'])
+    assert 'local_answer' in report['stages']
+
+
+def test_fake_model_is_deterministic_and_streams():
+    """Test that the fake model's replies depend only on the message and stream in order."""
+    model = FakeModel(reply=None, latency=0)
+    chat = model.start_chat([])
+    response = chat.send_message('שאלה', stream=True)
+    assert response.text == hashed_reply('שאלה')
+    assert ''.join(chunk.text for chunk in response) == response.text
+    assert model.calls == 1 and len(chat.history) == 2
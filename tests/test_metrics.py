@@ -0,0 +1,92 @@
+import logging
+
+import pytest
+
+import metrics
+
+
+def test_counter_renders_labels():
+    """Test that counters render one sample per label set, with escaped values."""
+    registry = metrics.Registry()
+    counter = registry.counter('demo_total', 'Demo counter', ['kind'])
+    counter.inc(kind='a')
+    counter.inc(2, kind='a')
+    counter.inc(kind='say "hi"')
+    text = registry.render()
+    assert '# TYPE demo_total counter' in text
+    assert 'demo_total{kind="a"} 3' in text
+    assert 'demo_total{kind="say \\"hi\\""} 1' in text
+    with pytest.raises(ValueError):
+        counter.inc(other='x')
+
+
+def test_histogram_buckets_are_cumulative():
+    """Test that histogram buckets are cumulative and end with +Inf, _sum and _count."""
+    registry = metrics.Registry()
+    histogram = registry.histogram('demo_seconds', 'Demo histogram', buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 3):
+        histogram.observe(value)
+    lines = registry.render().splitlines()
+    assert 'demo_seconds_bucket{le="0.1"} 1' in lines
+    assert 'demo_seconds_bucket{le="1"} 3' in lines
+    assert 'demo_seconds_bucket{le="+Inf"} 4' in lines
+    assert 'demo_seconds_sum 4.05' in lines
+    assert 'demo_seconds_count 4' in lines
+    assert histogram.count() == 4
+
+
+def test_gauge_reads_at_render_time():
+    """Test that a gauge calls its read function on every render."""
+    registry = metrics.Registry()
+    items = []
+    registry.gauge('demo_items', 'Demo gauge', lambda: len(items))
+    assert 'demo_items 0' in registry.render()
+    items.append(1)
+    assert 'demo_items 1' in registry.render()
+
+
+def test_span_records_stage_in_trace():
+    """Test that spans feed both the stage histogram and the current request trace."""
+    before = metrics.STAGE_SECONDS.count(stage='unit_test')
+    trace = metrics.begin_request('/unit')
+
+    @metrics.timed('unit_test')
+    def work():
+        return 42
+
+    assert work() == 42
+    with metrics.span('unit_test'):
+        pass
+    assert metrics.STAGE_SECONDS.count(stage='unit_test') == before + 2
+    assert set(trace.stages) == {'unit_test'}
+
+
+def test_slow_request_is_logged_without_payload(monkeypatch, caplog):
+    """Test that a slow request logs its per-stage timings and only when sampled."""
+    monkeypatch.setattr(metrics, 'SLOW_REQUEST_SECONDS', 0.0)
+    trace = metrics.begin_request('/chat')
+    trace.add('model', 0.25)
+    with caplog.at_level(logging.WARNING, logger='metrics'):
+        metrics.end_request(trace, 200)
+    assert 'slow request endpoint=/chat status=200' in caplog.text
+    assert 'model=250.0ms' in caplog.text
+    assert metrics.REQUESTS.value(endpoint='/chat', status=200) >= 1
+
+    caplog.clear()
+    monkeypatch.setattr(metrics, 'SLOW_REQUEST_SAMPLE', 0.0)
+    with caplog.at_level(logging.WARNING, logger='metrics'):
+        metrics.end_request(metrics.begin_request('/chat'), 200)
+    assert caplog.text == ''
+
+
+def test_observe_usage_skips_missing_counts():
+    """Test that token histograms only record the counts Gemini reported."""
+    class Usage:
+        prompt_token_count = 1200
+        candidates_token_count = None
+
+    prompt, response = metrics.PROMPT_TOKENS.count(), metrics.RESPONSE_TOKENS.count()
+    metrics.observe_usage(Usage())
+    metrics.observe_usage(None)
+    assert metrics.PROMPT_TOKENS.count() == prompt + 1
+    assert metrics.RESPONSE_TOKENS.count() == response
@@ -0,0 +1,24 @@
+import patient_snapshot
+
+ROW = {'row_id': 'r1', 'appointment_type': 'בדיקת דם', 'appointment_date_time': '2030-01-01 08:00:00+00:00',
+       'appointment_status': 'NewAppointment', 'site_id': 3, 'site_name': 'אסותא השלום',
+       'site_address': 'יגאל אלון 96', 'data_version': 'v1'}
+
+
+def test_unchanged_data_has_no_delta():
+    """Test that two snapshots of the same rows produce an empty delta."""
+    assert patient_snapshot.diff(patient_snapshot.take([ROW]), patient_snapshot.take([dict(ROW)])) == {}
+
+
+def test_delta_lists_only_what_changed():
+    """Test that the delta has the changed row before and after, the new row, and only the sites not seen before."""
+    old = patient_snapshot.take([ROW])
+    canceled = {**ROW, 'appointment_status': 'Canceled', 'data_version': 'v2'}
+    added = {**ROW, 'row_id': 'r2', 'site_id': 4, 'site_name': 'אסותא חיפה', 'site_address': 'חיפה'}
+    new = patient_snapshot.take([canceled, added])
+    assert new['version'] == 'v2'
+    assert patient_snapshot.diff(old, new) == {
+        'added': [{**old['appointments']['r1'], 'site': 'S4'}],
+        'changed': [{'before': old['appointments']['r1'], 'after': {**old['appointments']['r1'], 's': 'Canceled'}}],
+        'sites': {'S4': {'name': 'אסותא חיפה', 'address': 'חיפה'}},
+    }
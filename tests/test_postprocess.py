@@ -0,0 +1,52 @@
+import random
+
+import pytest
+
+import postprocess
+from bench import legacy_postprocess
+from bench.postprocess_bench import load_corpus
+
+CORPUS = load_corpus()
+
+# Pieces that exercise every branch of the old code, glued together at random below
+FRAGMENTS = [
+    'שלום יוסי', 'יוסי שלום', '!', ',', ' ', '\n', '\n\n', '*', '**', '1. ', '2) ', '- ', '• ', '<br>', 'br', 'MRI', 'ct',
+    'תור', 'תורים', 'תור הבא', 'מצאתי', 'לא מצאתי תורים', 'רופא', 'בדיקה', 'בדיקת', 'שינה', 'הכנה', 'צום', 'להביא',
+    'appointment', 'Appointment', 'איך', 'מתי', '📝', '🗺️', '<li>', 'טקסט רגיל',
+] + postprocess.FOLLOWUP_PATTERNS
+
+
+def legacy_pipeline(user_name, message, reply):
+    return legacy_postprocess.build_reply(message, legacy_postprocess.clean_reply(user_name, reply))
+
+
+def pipeline(user_name, message, reply):
+    return postprocess.build_reply(message, postprocess.clean_reply(user_name, reply))
+
+
+@pytest.mark.parametrize('entry', CORPUS, ids=range(len(CORPUS)))
+def test_corpus_output_unchanged(entry):
+    """Test that every corpus reply is processed exactly as before."""
+    args = entry['user_name'], entry['message'], entry['reply']
+    assert pipeline(*args) == legacy_pipeline(*args)
+
+
+def test_random_replies_output_unchanged():
+    """Test that replies stitched from tricky fragments are processed exactly as before."""
+    rng = random.Random(0)
+    for _ in range(3000):
+        reply = ''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 12)))
+        message = ''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 3)))
+        assert pipeline('יוסי', message, reply) == legacy_pipeline('יוסי', message, reply), (message, reply)
+
+
+def test_first_listed_followup_wins():
+    """Test that the follow-up removed is the first one in the list, not the first in the text."""
+    reply = "יש לך עוד שאלות? תודה. האם תרצה פרטים נוספים על אחד מהתורים?"
+    assert postprocess.strip_followups(reply) == "יש לך עוד שאלות? תודה."
+
+
+def test_greeting_removed_with_punctuation():
+    """Test that a repeated greeting and the punctuation after it are stripped."""
+    assert postprocess.strip_greeting('דנה', 'שלום דנה, התור שלך מחר') == 'התור שלך מחר'
+    assert postprocess.strip_greeting(None, 'שלום דנה') == 'שלום דנה'
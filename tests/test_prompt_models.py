@@ -0,0 +1,88 @@
+import os
+
+import google.generativeai as genai
+import pytest
+from google.api_core.exceptions import InvalidArgument
+
+from prompt_models import ModelRegistry, SystemPrompt
+
+
+@pytest.fixture()
+def prompt_file(tmp_path):
+    path = tmp_path / 'system_prompt.txt'
+    path.write_text('הנחיה ראשונה', encoding='utf-8')
+    return path
+
+
+def touch(path, text):
+    """Rewrite the prompt and move its mtime forward so the change is visible."""
+    stat = os.stat(path)
+    path.write_text(text, encoding='utf-8')
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_prompt_reloads_on_mtime_change(prompt_file):
+    """Test that the prompt is re-read only after the file's mtime changes."""
+    prompt = SystemPrompt(str(prompt_file), check_interval=0)
+    text, version = prompt.load()
+    assert text == 'הנחיה ראשונה'
+    assert prompt.load() == (text, version)
+
+    touch(prompt_file, 'הנחיה שנייה')
+    new_text, new_version = prompt.load()
+    assert new_text == 'הנחיה שנייה' and new_version != version
+    assert prompt.reloads == 1
+
+
+def test_missing_prompt_keeps_last_version(prompt_file):
+    """Test that a prompt that disappears after loading keeps serving the last version."""
+    prompt = SystemPrompt(str(prompt_file), check_interval=0)
+    loaded = prompt.load()
+    prompt_file.unlink()
+    assert prompt.load() == loaded
+    with pytest.raises(FileNotFoundError):
+        SystemPrompt(str(prompt_file)).load()
+
+
+def test_one_model_per_prompt_version(prompt_file):
+    """Test that the model is shared until the prompt changes."""
+    models = ModelRegistry(SystemPrompt(str(prompt_file), check_interval=0))
+    model = models.get()
+    assert models.get() is model
+    touch(prompt_file, 'הנחיה שנייה')
+    assert models.get() is not model
+    assert models.stats()['model_builds'] == 2
+
+
+def test_context_cache_falls_back_to_plain_model(prompt_file, monkeypatch):
+    """Test that a failed CachedContent.create still yields a working model."""
+    def fail(**kwargs):
+        raise InvalidArgument('prompt below the minimum cached token count')
+
+    monkeypatch.setattr(genai.caching.CachedContent, 'create', fail)
+    models = ModelRegistry(SystemPrompt(str(prompt_file)), cache_ttl=3600)
+    assert isinstance(models.get(), genai.GenerativeModel)
+    assert models.stats()['context_cache'] is False
+
+
+def test_context_cache_bug_is_not_swallowed(prompt_file, monkeypatch):
+    """Test that only API and network errors fall back; a bug in the cache call propagates."""
+    def broken(**kwargs):
+        raise TypeError('unexpected keyword argument')
+
+    monkeypatch.setattr(genai.caching.CachedContent, 'create', broken)
+    models = ModelRegistry(SystemPrompt(str(prompt_file)), cache_ttl=3600)
+    with pytest.raises(TypeError):
+        models.get()
+
+
+def test_context_cache_model_is_built_once(prompt_file, monkeypatch):
+    """Test that with a TTL the prompt is cached once and the model is built from the cache."""
+    created = []
+    monkeypatch.setattr(genai.caching.CachedContent, 'create', lambda **kwargs: created.append(kwargs) or 'cache')
+    monkeypatch.setattr(genai.GenerativeModel, 'from_cached_content', lambda cached_content: ('model', cached_content))
+    models = ModelRegistry(SystemPrompt(str(prompt_file)), cache_ttl=3600)
+    assert models.get() == ('model', 'cache')
+    assert models.get() == ('model', 'cache')
+    assert len(created) == 1 and created[0]['system_instruction'] == 'הנחיה ראשונה'
+    assert models.stats()['context_cache'] is True
@@ -0,0 +1,48 @@
+from response_cache import ResponseCache, normalize_question
+
+
+def test_normalize_question_folds_niqqud_punctuation_and_spaces():
+    """Test that spelling variants of the same question normalize equally."""
+    assert normalize_question('  מָתַי   התור הבא שלי?! ') == normalize_question('מתי התור הבא שלי')
+    assert normalize_question('בדיקת־דם, CT.') == 'בדיקת דם ct'
+
+
+def test_cache_invalidates_when_data_version_changes():
+    """Test that a patient's cached answers disappear once their data_version changes."""
+    cache = ResponseCache()
+    cache.put('u1', 'מתי התור?', 'data-1', 'v1', 'ביום ראשון')
+    assert cache.get('u1', 'מתי  התור', 'data-1', 'v1') == 'ביום ראשון'
+    assert cache.get('u1', 'מתי התור?', 'data-2', 'v1') is None
+    assert len(cache) == 0
+
+
+def test_cache_tracks_versions_only_for_cached_patients():
+    """Test that patients who only ever miss leave nothing behind, and evicted ones are forgotten."""
+    cache = ResponseCache(max_entries=1)
+    for i in range(100):
+        assert cache.get(f'u{i}', 'שאלה', 'data-1', 'v1') is None
+    cache.put('u1', 'a', 'data-1', 'v1', '1')
+    cache.put('u2', 'a', 'data-1', 'v1', '2')
+    assert cache._user_fingerprints == {'u2': 'data-1'}
+
+
+def test_cache_respects_prompt_version_and_size_cap():
+    """Test that a new prompt version misses and the LRU cap holds."""
+    cache = ResponseCache(max_entries=2)
+    cache.put('u1', 'a', 'fp', 'v1', '1')
+    assert cache.get('u1', 'a', 'fp', 'v2') is None
+    cache.put('u1', 'b', 'fp', 'v1', '2')
+    cache.put('u1', 'c', 'fp', 'v1', '3')
+    assert len(cache) == 2
+    assert cache.get('u1', 'a', 'fp', 'v1') is None
+
+
+def test_short_reply_is_keyed_by_the_previous_answer():
+    """Test that the same short reply to different model turns is cached separately."""
+    cache = ResponseCache()
+    cache.put('u1', 'כן', 'data-1', 'v1', 'הכתובת: יגאל אלון 96', context='האם תרצה הנחיות הגעה?')
+    assert cache.get('u1', 'כן', 'data-1', 'v1', context='האם תרצה לשמוע על ההכנות?') is None
+    assert cache.get('u1', 'כן!', 'data-1', 'v1', context='האם תרצה הנחיות הגעה?') == 'הכתובת: יגאל אלון 96'
+    # A standalone question doesn't depend on what came before it
+    cache.put('u1', 'מה ההכנות לבדיקת MRI?', 'data-1', 'v1', 'אין צורך בצום', context='שלום')
+    assert cache.get('u1', 'מה ההכנות לבדיקת MRI', 'data-1', 'v1', context='משהו אחר') == 'אין צורך בצום'
@@ -0,0 +1,44 @@
+import time
+
+from session_store import (
+    MemorySessionStore,
+    SQLiteSessionStore,
+    history_to_records,
+    records_to_history,
+)
+
+
+def test_memory_store_evicts_least_recently_used():
+    """Test that the memory store stays under its cap by dropping the LRU session."""
+    store = MemorySessionStore(max_sessions=2)
+    store.put('a', {'state': 'chatting'})
+    store.put('b', {'state': 'chatting'})
+    store.get('a')
+    store.put('c', {'state': 'chatting'})
+    assert len(store) == 2
+    assert store.get('b') is None
+    assert store.get('a') is not None
+
+
+def test_memory_store_expires_sessions():
+    """Test that sessions older than the TTL are gone."""
+    store = MemorySessionStore(ttl=0.01)
+    store.put('a', {'state': 'chatting'})
+    time.sleep(0.02)
+    assert store.get('a') is None
+
+
+def test_sqlite_store_is_shared_between_instances(tmp_path):
+    """Test that two stores on the same file (two workers) see the same sessions."""
+    path = str(tmp_path / 'sessions.db')
+    session = {'state': 'chatting', 'user_id': 'u1', 'history': [{'role': 'user', 'text': 'שלום'}]}
+    SQLiteSessionStore(path).put('a', session)
+    assert SQLiteSessionStore(path).get('a') == session
+
+
+def test_history_round_trip():
+    """Test that history converts to compact records and back."""
+    history = [{'role': 'user', 'parts': ['שלום']}, {'role': 'model', 'parts': ['היי', '!']}]
+    records = history_to_records(history)
+    assert records == [{'role': 'user', 'text': 'שלום'}, {'role': 'model', 'text': 'היי!'}]
+    assert records_to_history(records) == [{'role': 'user', 'parts': ['שלום']}, {'role': 'model', 'parts': ['היי!']}]
@@ -0,0 +1,80 @@
+import pytest
+
+from text_to_sql import TextToSQL, UnsafeSQL, parameterize, validate_sql
+
+USER_ID = '0014J00000JAuIGQA1'
+
+
+@pytest.mark.parametrize('sql', [
+    "DELETE FROM appointments",
+    "SELECT 1; DROP TABLE accounts",
+    "SELECT * FROM main.appointments",
+    "SELECT name FROM sqlite_master",
+    "PRAGMA table_info(appointments)",
+    'SELECT DISTINCT user_id FROM "main".appointments',
+    "SELECT DISTINCT user_id FROM [main].appointments",
+    "SELECT DISTINCT user_id FROM `main`.appointments",
+    'SELECT user_name FROM "main"."accounts"',
+])
+def test_validate_rejects_unsafe_sql(sql):
+    """Test that anything but a single plain SELECT is rejected."""
+    with pytest.raises(UnsafeSQL):
+        validate_sql(sql)
+
+
+def test_validate_strips_fences():
+    """Test that markdown fences and a trailing semicolon are removed."""
+    assert validate_sql("```sql\nSELECT 1;\n```") == "SELECT 1"
+
+
+def test_query_is_scoped_to_session_user(db_path):
+    """Test that even an unfiltered query only sees the session user's rows."""
+    engine = TextToSQL(lambda prompt: "SELECT DISTINCT user_id FROM appointments")
+    sql, rows = engine.run(db_path, USER_ID, 'כל המטופלים')
+    assert sql == "SELECT DISTINCT user_id FROM appointments"
+    assert rows == [{'user_id': USER_ID}]
+    # Same engine and connection, next session: the views follow the new scope
+    other = engine.execute(db_path, 'no-such-user', sql, {})
+    assert other == []
+
+
+@pytest.mark.parametrize('sql', [
+    'SELECT DISTINCT user_id FROM "main".appointments',
+    "SELECT DISTINCT user_id FROM [main].appointments",
+    "SELECT DISTINCT user_id FROM `main`.appointments",
+    'SELECT user_name FROM "main"."accounts"',
+])
+def test_base_tables_are_unreadable_even_past_validation(db_path, sql):
+    """Test that the authorizer denies direct reads of per-patient tables, without relying on validate_sql."""
+    with pytest.raises(UnsafeSQL):
+        TextToSQL(lambda prompt: sql).execute(db_path, USER_ID, sql, {})
+
+
+def test_plan_cache_reuses_sql_for_same_question_shape(db_path):
+    """Test that questions differing only in literals share one generated plan."""
+    prompts = []
+
+    def generate(prompt):
+        prompts.append(prompt)
+        return "SELECT COUNT(*) AS n FROM appointments WHERE appointment_date_time LIKE :p0 || '%'"
+
+    engine = TextToSQL(generate)
+    _, rows_2020 = engine.run(db_path, USER_ID, 'כמה תורים היו לי ב־2020?')
+    _, rows_2023 = engine.run(db_path, USER_ID, 'כמה תורים היו לי ב־2023?')
+    assert len(prompts) == 1
+    assert rows_2020[0]['n'] > 0 and rows_2020 != rows_2023
+    assert parameterize('כמה תורים היו לי ב־2020?') == ('כמה תורים היו לי ב {p0}', {'p0': '2020'})
+
+
+def test_authorizer_blocks_other_tables(db_path):
+    """Test that tables outside the scope cannot be read."""
+    engine = TextToSQL(lambda prompt: "SELECT * FROM appointments", scope={'accounts': 'user_id'})
+    with pytest.raises(UnsafeSQL):
+        engine.run(db_path, USER_ID, 'תורים')
+
+
+def test_sites_table_is_shared_across_patients(db_path):
+    """Test that the sites table is readable in full, unlike the per-patient tables."""
+    engine = TextToSQL(lambda prompt: "SELECT COUNT(*) AS n FROM sites")
+    _, rows = engine.run(db_path, USER_ID, 'כמה אתרים יש?')
+    assert rows == [{'n': 11}]
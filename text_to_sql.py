@@ -0,0 +1,217 @@
+"""Text-to-SQL: המודל כותב SELECT, אנחנו מאמתים, מגבילים למטופל ומריצים.
+
+השאילתה שהמודל מחזיר עוברת בדיקה שהיא משפט SELECT יחיד לקריאה בלבד. בכל
+חיבור של המנוע כל טבלה מותרת מוסתרת מאחורי TEMP VIEW באותו שם, שמסונן לפי
+ה־user_id של השיחה (הפונקציה scope_id()), וה־authorizer מתיר לקרוא טבלה
+פרטית רק דרך ה־view שלה - כך שגם שאילתה שגויה או זדונית לא יכולה לראות
+נתונים של מטופל אחר. ההרצה נעשית על חיבור קריאה בלבד ועם מגבלת זמן.
+
+מספרים ותאריכים בשאלה מוחלפים בפרמטרים (:p0, :p1, ...), כך ששאלות באותה
+תבנית משתמשות בתוכנית SQL שמורה במקום קריאה נוספת למודל.
+"""
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import db
+from response_cache import normalize_question
+
+DEFAULT_TIMEOUT = 2.0
+DEFAULT_PLAN_CACHE_SIZE = 512
+MAX_ROWS = 50
+
+SCHEMA = """
+appointments(
+    row_id TEXT PRIMARY KEY,
+    user_id TEXT,
+    appointment_type TEXT,        -- תיאור הבדיקה/הביקור, לעתים עם תאריך בטקסט
+    appointment_date_time TEXT,   -- 'YYYY-MM-DD HH:MM:SS+00:00' (UTC)
+    appointment_status TEXT,      -- Canceled, TookPlace, RescheduleByAssuta, NewAppointment, WaitingForAppointment, ...
+    cancel_reason_code TEXT,
+    record_type TEXT,             -- בדיקה / ניתוח / ייעוץ
+    site_id INTEGER,              -- sites.site_id
+    appointment_epoch INTEGER,    -- אותו מועד בשניות UTC (NULL כשאין תאריך); מאונדקס יחד עם user_id
+    appointment_ts TEXT           -- אותו מועד כ־'YYYY-MM-DDTHH:MM:SSZ'
+)
+accounts(user_id TEXT PRIMARY KEY, user_name TEXT, age INTEGER)
+sites(
+    site_id INTEGER PRIMARY KEY,
+    site_name TEXT,
+    site_address TEXT,
+    instructions TEXT,            -- הנחיות הגעה מלאות
+    transport TEXT,               -- הגעה בתחבורה ציבורית
+    car TEXT,                     -- הגעה ברכב פרטי
+    parking TEXT,                 -- חניה
+    accessibility TEXT            -- נגישות
+)
+"""
+
+SQL_SYSTEM_PROMPT = f"""אתה ממיר שאלות של מטופלים באסותא לשאילתת SQLite אחת.
+הסכמה:
+{SCHEMA}
+כללים:
+- החזר משפט SELECT יחיד בלבד, בלי הסברים ובלי ```.
+- הטבלאות כבר מסוננות למטופל הנוכחי - אין צורך לסנן לפי user_id.
+- ערכים שמופיעים בשאלה כ־{{p0}}, {{p1}} וכו' יש להעביר כפרמטרים :p0, :p1 ולא כטקסט.
+- להשוואות ולמיון לפי זמן העדף את appointment_epoch, ולזמן הנוכחי השתמש ב־CAST(strftime('%s','now') AS INTEGER).
+- אם אין צורך בנתונים כדי לענות על השאלה, החזר בדיוק NONE.
+"""
+
+LITERAL_RE = re.compile(r'\d+(?:[./:-]\d+)*')
+FENCE_RE = re.compile(r'^```(?:sql)?\s*|\s*```$', re.IGNORECASE)
+# Only single quotes delimit string literals; "x", [x] and `x` are identifiers, and
+# their quotes are dropped before the check so "main".t is caught like main.t
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+IDENTIFIER_QUOTES_RE = re.compile(r'["`\[\]]')
+FORBIDDEN_RE = re.compile(r'\b(?:main|temp|sqlite_\w*)\s*\.|\bsqlite_\w+|\bpragma\b|\battach\b', re.IGNORECASE)
+
+
+class UnsafeSQL(ValueError):
+    """השאילתה שהמודל החזיר לא עברה אימות"""
+
+
+def parameterize(question):
+    """תבנית השאלה המנורמלת וערכי הפרמטרים שהוצאו ממנה"""
+    params = {}
+
+    def replace(match):
+        name = f"p{len(params)}"
+        params[name] = match.group(0)
+        return f"{{{name}}}"
+
+    return LITERAL_RE.sub(replace, normalize_question(question)), params
+
+
+def validate_sql(sql):
+    """ניקוי ואימות שהשאילתה היא SELECT יחיד - מחזיר את ה־SQL הנקי או זורק UnsafeSQL"""
+    sql = FENCE_RE.sub('', sql.strip()).strip().rstrip(';').strip()
+    code = IDENTIFIER_QUOTES_RE.sub('', STRING_RE.sub("''", sql))
+    if ';' in code:
+        raise UnsafeSQL('multiple statements')
+    if not re.match(r'(?:select|with)\b', code, re.IGNORECASE):
+        raise UnsafeSQL('not a SELECT')
+    if FORBIDDEN_RE.search(code):
+        raise UnsafeSQL('schema-qualified or system object')
+    if not sqlite3.complete_statement(sql + ';'):
+        raise UnsafeSQL('incomplete statement')
+    return sql
+
+
+class TextToSQL:
+    """צינור שאלה -> SQL -> שורות, עם מטמון תוכניות לפי תבנית שאלה.
+
+    generate(prompt) מחזיר את טקסט ה־SQL מהמודל. scope ממפה כל טבלה מותרת
+    לעמודה שלפיה היא מסוננת לבעל השיחה, או ל־None בטבלה משותפת (sites).
+    """
+
+    def __init__(self, generate, scope=None, timeout=DEFAULT_TIMEOUT, plan_cache_size=DEFAULT_PLAN_CACHE_SIZE):
+        self.generate = generate
+        self.scope = scope or {'appointments': 'user_id', 'accounts': 'user_id', 'sites': None}
+        self.timeout = timeout
+        self.plan_cache_size = plan_cache_size
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.plan_hits = 0
+        self.plan_misses = 0
+
+    def plan(self, question):
+        """(sql, פרמטרים, תבנית) לשאלה - מהמטמון או מהמודל; sql הוא None אם אין צורך בנתונים"""
+        shape, params = parameterize(question)
+        with self._lock:
+            if shape in self._plans:
+                self._plans.move_to_end(shape)
+                self.plan_hits += 1
+                return self._plans[shape], params, shape
+            self.plan_misses += 1
+
+        prompt = f"שאלה: {shape}\n" + "".join(f"{name} = {value!r}\n" for name, value in params.items())
+        text = self.generate(prompt).strip()
+        sql = None if text.upper() == 'NONE' else validate_sql(text)
+        return sql, params, shape
+
+    def _remember(self, shape, sql):
+        with self._lock:
+            self._plans[shape] = sql
+            self._plans.move_to_end(shape)
+            while len(self._plans) > self.plan_cache_size:
+                self._plans.popitem(last=False)
+
+    def _authorize(self, action, arg1, arg2, db_name, view):
+        if action == sqlite3.SQLITE_SELECT:
+            return sqlite3.SQLITE_OK
+        if action == sqlite3.SQLITE_READ:
+            # The scope views' own columns, a table read from inside its view, or a shared
+            # table; a per-patient table in main is never read directly
+            if db_name == 'temp':
+                allowed = arg1 in self.scope
+            else:
+                allowed = view in self.scope or (arg1 in self.scope and self.scope[arg1] is None)
+            return sqlite3.SQLITE_OK if allowed else sqlite3.SQLITE_DENY
+        if action == sqlite3.SQLITE_FUNCTION:
+            return sqlite3.SQLITE_DENY if arg2 == 'load_extension' else sqlite3.SQLITE_OK
+        return sqlite3.SQLITE_DENY
+
+    def _connection(self, db_path):
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get(db_path)
+        if conn is None:
+            conn = db.connect_readonly(db_path)
+            self._create_views(conn)
+            conn.set_authorizer(self._authorize)
+            conns[db_path] = conn
+        return conn
+
+    def _create_views(self, conn):
+        """TEMP VIEW לכל טבלה מותרת, באותו שם ומסונן לבעל השיחה הנוכחית"""
+        # Unqualified names resolve to temp before main, so the views shadow the tables
+        conn.create_function('scope_id', 0, lambda: self._local.scope_id)
+        conn.execute("PRAGMA query_only=OFF")  # TEMP objects live outside the read-only file
+        for table, column in self.scope.items():
+            conn.execute(
+                f"CREATE TEMP VIEW {table} AS SELECT * FROM main.{table}"
+                + (f" WHERE {column} = scope_id()" if column else "")
+            )
+        conn.execute("PRAGMA query_only=ON")
+
+    def execute(self, db_path, scope_id, sql, params):
+        """הרצת השאילתה על ה־views של בעל השיחה, עם מגבלת זמן - רשימת dicts"""
+        conn = self._connection(db_path)
+        self._local.scope_id = scope_id
+        deadline = time.monotonic() + self.timeout
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+        try:
+            rows = conn.execute(f"SELECT * FROM ({sql}) LIMIT {MAX_ROWS}", params).fetchall()
+        except sqlite3.DatabaseError as e:
+            raise UnsafeSQL(str(e)) from e
+        finally:
+            conn.set_progress_handler(None, 1000)
+        return [dict(row) for row in rows]
+
+    def run(self, db_path, scope_id, question):
+        """שאלה -> (sql, שורות); sql הוא None כשהשאלה לא דורשת נתונים"""
+        sql, params, shape = self.plan(question)
+        if sql is None:
+            self._remember(shape, None)
+            return None, []
+        rows = self.execute(db_path, scope_id, sql, params)
+        self._remember(shape, sql)
+        return sql, rows
+
+    def stats(self):
+        with self._lock:
+            return {'plans': len(self._plans), 'plan_hits': self.plan_hits, 'plan_misses': self.plan_misses}
+
+
+def verbalize_prompt(question, rows):
+    """פרומפט לניסוח תשובה למטופל מתוצאות השאילתה"""
+    return (
+        f"שאלת המטופל: {question}\n"
+        f"תוצאות מה־DB (JSON, עד {MAX_ROWS} שורות): {json.dumps(rows, ensure_ascii=False, default=str)}\n"
+        "ענה למטופל בעברית על סמך התוצאות בלבד, בקצרה."
+    )